@@ -0,0 +1,13 @@
+"""
+Counters stored on the user row, reconciled by `core.tasks.reconcile_counters`
+"""
+from account.models import Follower, User
+from blog.models import Blog
+from core.reconcile import Counter, register
+
+register(Counter("user.follower_count", User, "follower_count", Follower, "following"))
+register(Counter("user.following_count", User, "following_count", Follower, "user"))
+register(Counter(
+    "user.blog_count", User, "blog_count", Blog, "author",
+    filters={"is_archived": False, "is_draft": False, "is_banned": False, "is_deleted": False}
+))
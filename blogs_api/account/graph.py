@@ -0,0 +1,287 @@
+"""
+Follower and following id sets of every user mirrored in redis, so mutual follows,
+"follows you" flags and counts are set operations instead of self joins on Follower.
+Sets of large accounts spill over into SOCIAL_GRAPH_SHARDS shards, a member lives in shard member % shards.
+Keys are namespaced by a generation, `rebuild` fills a new generation and switches to it when done
+"""
+import logging
+from collections import defaultdict
+from typing import Iterable
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from redis import Redis, RedisError
+
+from lib.cache import get_redis, make_key
+
+logger = logging.getLogger(__name__)
+
+FOLLOWERS = "followers"
+FOLLOWING = "following"
+
+# Adds or removes a member, routed to its shard. An unsharded set growing past the threshold is split
+UPDATE_SCRIPT = """
+local shards = tonumber(redis.call('hget', KEYS[1], ARGV[1]) or '0')
+local key = KEYS[2]
+if shards > 0 then
+    key = key .. ':' .. (tonumber(ARGV[2]) % shards)
+end
+if ARGV[3] == 'add' then
+    redis.call('sadd', key, ARGV[2])
+else
+    redis.call('srem', key, ARGV[2])
+    return
+end
+if shards == 0 and redis.call('scard', key) > tonumber(ARGV[4]) then
+    local count = tonumber(ARGV[5])
+    for _, member in ipairs(redis.call('smembers', key)) do
+        redis.call('sadd', key .. ':' .. (tonumber(member) % count), member)
+    end
+    redis.call('del', key)
+    redis.call('hset', KEYS[1], ARGV[1], count)
+end
+"""
+
+
+def generation_key() -> str:
+    return make_key("graph", "generation")
+
+
+def building_key() -> str:
+    """
+    Generation being filled by `rebuild`, live updates are applied to it as well
+    """
+    return make_key("graph", "building")
+
+
+def get_generation(redis: Redis) -> int:
+    return int(redis.get(generation_key()) or 0)
+
+
+def shards_key(generation: int) -> str:
+    """
+    Hash of shard counts of sharded sets, field is "<kind>:<user id>"
+    """
+    return make_key("graph", generation, "shards")
+
+
+def set_key(generation: int, kind: str, user_id: int) -> str:
+    return make_key("graph", generation, kind, user_id)
+
+
+def get_shard_counts(redis: Redis, generation: int, sets: list[tuple[str, int]]) -> list[int]:
+    if not sets:
+        return []
+    values = redis.hmget(shards_key(generation), [f"{kind}:{user_id}" for kind, user_id in sets])
+    return [int(value or 0) for value in values]
+
+
+def get_set_keys(generation: int, kind: str, user_id: int, shards: int) -> list[str]:
+    key = set_key(generation, kind, user_id)
+    if not shards:
+        return [key]
+    return [f"{key}:{shard}" for shard in range(shards)]
+
+
+def apply(user_id: int, following_ids: Iterable[int], operation: str):
+    """
+    Mirrors created or deleted follow relationships in the current generation,
+    and in the generation being rebuilt if any
+    Redis errors are logged, a rebuild brings the graph back in sync
+    :param user_id: Follower
+    :param following_ids: Followed users
+    :param operation: add or remove
+    """
+    following_ids = list(following_ids)
+    if not following_ids:
+        return
+    try:
+        redis = get_redis()
+        generations = {get_generation(redis)}
+        building = redis.get(building_key())
+        if building is not None:
+            generations.add(int(building))
+        script = redis.register_script(UPDATE_SCRIPT)
+        pipeline = redis.pipeline(transaction=False)
+        for generation in generations:
+            for owner, kind, member in [
+                *((user_id, FOLLOWING, following_id) for following_id in following_ids),
+                *((following_id, FOLLOWERS, user_id) for following_id in following_ids),
+            ]:
+                script(
+                    keys=[shards_key(generation), set_key(generation, kind, owner)],
+                    args=[
+                        f"{kind}:{owner}", member, operation,
+                        settings.SOCIAL_GRAPH_SHARD_THRESHOLD, settings.SOCIAL_GRAPH_SHARDS
+                    ],
+                    client=pipeline
+                )
+        pipeline.execute()
+    except RedisError:
+        logger.warning("Could not update social graph of user %s", user_id, exc_info=True)
+
+
+def add_follows(user_id: int, following_ids: Iterable[int]):
+    """
+    Mirrors new follow relationships once the transaction creating them commits
+    """
+    following_ids = list(following_ids)
+    transaction.on_commit(lambda: apply(user_id, following_ids, "add"))
+
+
+def remove_follows(user_id: int, following_ids: Iterable[int]):
+    """
+    Mirrors deleted follow relationships once the transaction deleting them commits
+    """
+    following_ids = list(following_ids)
+    transaction.on_commit(lambda: apply(user_id, following_ids, "remove"))
+
+
+def count(user_id: int, kind: str) -> int:
+    """
+    Number of followers or followings of the user
+    """
+    redis = get_redis()
+    generation = get_generation(redis)
+    shards, = get_shard_counts(redis, generation, [(kind, user_id)])
+    pipeline = redis.pipeline(transaction=False)
+    for key in get_set_keys(generation, kind, user_id, shards):
+        pipeline.scard(key)
+    return sum(pipeline.execute())
+
+
+def contains(user_id: int, kind: str, member_ids: list[int]) -> list[bool]:
+    """
+    Whether each member is in the followers or followings of the user, EG: "follows you" flags of a page
+    :return: list[bool] In the order of member_ids
+    """
+    if not member_ids:
+        return []
+    redis = get_redis()
+    generation = get_generation(redis)
+    shards, = get_shard_counts(redis, generation, [(kind, user_id)])
+    keys = get_set_keys(generation, kind, user_id, shards)
+    by_key = defaultdict(list)
+    for member in member_ids:
+        by_key[keys[member % len(keys)]].append(member)
+    found = set()
+    for key, members in by_key.items():
+        found.update(member for member, is_member in zip(members, redis.smismember(key, members)) if is_member)
+    return [member in found for member in member_ids]
+
+
+def members(user_id: int, kind: str) -> set[int]:
+    redis = get_redis()
+    generation = get_generation(redis)
+    shards, = get_shard_counts(redis, generation, [(kind, user_id)])
+    return {
+        int(member)
+        for key in get_set_keys(generation, kind, user_id, shards)
+        for member in redis.sscan_iter(key, count=1000)
+    }
+
+
+def intersect(first: tuple[int, str], second: tuple[int, str]) -> set[int]:
+    """
+    Members of both sets
+    Sets sharded alike are intersected shard by shard in redis, otherwise members of the
+    smaller set are looked up in the larger one
+    :param first: User id and kind of the first set
+    :param second: User id and kind of the second set
+    :return: set[int]
+    """
+    redis = get_redis()
+    generation = get_generation(redis)
+    (first_user, first_kind), (second_user, second_kind) = first, second
+    first_shards, second_shards = get_shard_counts(
+        redis, generation, [(first_kind, first_user), (second_kind, second_user)]
+    )
+    if first_shards == second_shards:
+        pipeline = redis.pipeline(transaction=False)
+        for first_key, second_key in zip(
+                get_set_keys(generation, first_kind, first_user, first_shards),
+                get_set_keys(generation, second_kind, second_user, second_shards)
+        ):
+            pipeline.sinter(first_key, second_key)
+        return {int(member) for result in pipeline.execute() for member in result}
+    if count(first_user, first_kind) > count(second_user, second_kind):
+        first, second = second, first
+    candidates = list(members(*first))
+    return {member for member, found in zip(candidates, contains(*second, candidates)) if found}
+
+
+def mutuals(user_id: int) -> set[int]:
+    """
+    Users the user follows that follow the user back
+    """
+    return intersect((user_id, FOLLOWING), (user_id, FOLLOWERS))
+
+
+def followed_by_followings(user_id: int, target_id: int) -> set[int]:
+    """
+    Users the user follows that follow the target, "followed by people you follow"
+    """
+    return intersect((user_id, FOLLOWING), (target_id, FOLLOWERS))
+
+
+def rebuild(chunk_size: int = 10000) -> int:
+    """
+    Fills a new generation from the Follower table and switches to it, then deletes the old one
+    Sets of users whose stored counts pass the threshold are sharded up front.
+    Follows made meanwhile are applied to both generations
+    :param chunk_size: Rows read and written per round trip
+    :return: int | Number of relationships loaded
+    """
+    from account.models import Follower, User
+
+    redis = get_redis()
+    previous = get_generation(redis)
+    generation = previous + 1
+    threshold, shard_count = settings.SOCIAL_GRAPH_SHARD_THRESHOLD, settings.SOCIAL_GRAPH_SHARDS
+    redis.set(building_key(), generation)
+    try:
+        shards = {}
+        for user_id, follower_count, following_count in User.objects.filter(
+                Q(follower_count__gt=threshold) | Q(following_count__gt=threshold)
+        ).values_list("pk", "follower_count", "following_count").iterator():
+            if follower_count > threshold:
+                shards[(FOLLOWERS, user_id)] = shard_count
+            if following_count > threshold:
+                shards[(FOLLOWING, user_id)] = shard_count
+        if shards:
+            redis.hset(shards_key(generation), mapping={f"{kind}:{user_id}": n for (kind, user_id), n in shards.items()})
+
+        def get_key(kind: str, owner: int, member: int) -> str:
+            n = shards.get((kind, owner))
+            key = set_key(generation, kind, owner)
+            return f"{key}:{member % n}" if n else key
+
+        loaded = 0
+        pipeline = redis.pipeline(transaction=False)
+        for user_id, following_id in Follower.objects.values_list("user_id", "following_id").iterator(
+                chunk_size=chunk_size
+        ):
+            pipeline.sadd(get_key(FOLLOWING, user_id, following_id), following_id)
+            pipeline.sadd(get_key(FOLLOWERS, following_id, user_id), user_id)
+            loaded += 1
+            if loaded % chunk_size == 0:
+                pipeline.execute()
+        pipeline.execute()
+        redis.set(generation_key(), generation)
+    except BaseException:
+        delete_generation(redis, generation)
+        raise
+    finally:
+        redis.delete(building_key())
+    delete_generation(redis, previous)
+    return loaded
+
+
+def delete_generation(redis: Redis, generation: int):
+    pipeline = redis.pipeline(transaction=False)
+    for index, key in enumerate(redis.scan_iter(match=make_key("graph", generation, "*"), count=1000), 1):
+        pipeline.unlink(key)
+        if index % 1000 == 0:
+            pipeline.execute()
+    pipeline.execute()
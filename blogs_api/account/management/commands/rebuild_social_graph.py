@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from account.graph import rebuild
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the redis follower and following sets of every user from the Follower table. "
+        "Run after deploying or when redis lost its data, reads keep using the old sets until it is done"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        loaded = rebuild(options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS(f"Loaded {loaded} follow relationships into the social graph"))
@@ -0,0 +1,42 @@
+# Generated by Django 4.1.7 on 2026-10-19 05:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0004_alter_user_managers_alter_follower_user'),
+        ('blog', '0003_blog_search_vector_tag_trigram'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='blog_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='follower_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='following_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunSQL(
+            sql="""
+                UPDATE account_user u SET
+                    follower_count = (SELECT COUNT(*) FROM account_follower f WHERE f.following_id = u.id),
+                    following_count = (SELECT COUNT(*) FROM account_follower f WHERE f.user_id = u.id),
+                    blog_count = (
+                        SELECT COUNT(*) FROM blog_blog b
+                        WHERE b.author_id = u.id
+                        AND NOT b.is_archived AND NOT b.is_draft AND NOT b.is_banned AND NOT b.is_deleted
+                    );
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
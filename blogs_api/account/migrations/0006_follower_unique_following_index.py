@@ -0,0 +1,44 @@
+# Generated by Django 4.1.7 on 2026-10-19 05:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0005_user_counters'),
+    ]
+
+    operations = [
+        # Duplicates inserted by concurrent follows would fail the unique constraint, the oldest row is kept
+        migrations.RunSQL(
+            sql="""
+                DELETE FROM account_follower a USING account_follower b
+                WHERE a.user_id = b.user_id AND a.following_id = b.following_id AND a.id > b.id;
+                UPDATE account_user u SET
+                    follower_count = (SELECT COUNT(*) FROM account_follower f WHERE f.following_id = u.id),
+                    following_count = (SELECT COUNT(*) FROM account_follower f WHERE f.user_id = u.id);
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='follower',
+            constraint=models.UniqueConstraint(fields=('user', 'following'), name='account_follower_user_following_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='follower',
+            index=models.Index(fields=['following', 'user'], name='account_follower_following_idx'),
+        ),
+        migrations.AlterField(
+            model_name='follower',
+            name='following',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='following_user', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='follower',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='follow_user_owner', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
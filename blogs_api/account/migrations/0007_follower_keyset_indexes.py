@@ -0,0 +1,21 @@
+# Generated by Django 4.1.7 on 2026-10-19 05:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0006_follower_unique_following_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='follower',
+            index=models.Index(fields=['following', '-created_at', '-id'], name='account_followers_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='follower',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='account_followings_page_idx'),
+        ),
+    ]
@@ -1,35 +1,56 @@
+from __future__ import annotations
 import json
-import mimetypes
-import os.path
 from uuid import uuid4
 
 from cryptography.fernet import InvalidToken
 from django.contrib.auth.models import AbstractUser, UserManager as BaseUserManager
 from django.core.files import File
-from django.db.models import Count
+from django.db.models import F, QuerySet
+from django.db.models.functions import Greatest
 from rest_framework.exceptions import ValidationError
 
-from django.db import models
+from django.db import connection, models, transaction
 from django.http import HttpRequest
+from django.utils import timezone
 
 from django_countries.fields import CountryField
 from phonenumber_field.modelfields import PhoneNumberField
 
+from account import graph
 from blogs_api import settings
 from blogs_api.config.base import ENCRYPTION
-from lib.backends import StorageService
+from lib.cache import get_redis, make_key
+from lib.images import CONTENT_TYPES, make_variants
 from lib.models import TimeStampedModel
-from core.tasks import send_email
+from core.storage import store_file
+from core import mail
 
 
 class UserManager(BaseUserManager):
 
-    def details_queryset(self):
-        return self.get_queryset().annotate(
-            follower_count=Count("follow_root_user"),
-            following_count=Count("following_user"),
-            blog_count=Count("blog")
-        )
+    def details_queryset(self) -> QuerySet[User]:
+        """
+        Users for the public details view, counts are stored on the user row
+        :return: QuerySet[User]
+        """
+        return self.get_queryset()
+
+    def update_follow_counts(self, user_id: int, following_ids: list[int], delta: int):
+        """
+        Adds delta per relationship to following_count of user and follower_count of every followed user
+        Must run in the transaction that created or deleted the Follower rows
+        :param user_id: Id of the follower
+        :param following_ids: Ids of the followed users whose relationship was created or deleted
+        :param delta: 1 for created, -1 for deleted
+        """
+        if not following_ids:
+            return
+        self.filter(pk=user_id).update(following_count=F("following_count") + delta * len(following_ids))
+        self.filter(pk__in=following_ids).update(follower_count=F("follower_count") + delta)
+
+    def update_blog_count(self, user_id: int, delta: int):
+        # Never below zero, a drifted count is corrected by the counter reconciliation
+        self.filter(pk=user_id).update(blog_count=Greatest(F("blog_count") + delta, 0))
 
 
 class User(AbstractUser, TimeStampedModel):
@@ -38,39 +59,64 @@ class User(AbstractUser, TimeStampedModel):
     """
     name = models.CharField(max_length=256, null=False, blank=True)
     profile_picture_url = models.URLField(max_length=1024, null=False, blank=True)
+    # Resized pictures by size and format, EG: {"small": {"webp": url, "jpeg": url}}
+    profile_picture_variants = models.JSONField(default=dict, blank=True)
     is_verified = models.BooleanField(default=False)
     phone_number = PhoneNumberField(blank=True, null=False)
     bio = models.CharField(max_length=256, blank=True)
+    # Maintained with the rows they count, reconciled by account.counters
+    follower_count = models.PositiveIntegerField(default=0, editable=False)
+    following_count = models.PositiveIntegerField(default=0, editable=False)
+    blog_count = models.PositiveIntegerField(default=0, editable=False)
     objects = UserManager()
 
     def __str__(self):
         return self.name
 
-    def build_profile_picture_url(self, file_name: str) -> str:
-        """
-        Builds profile picture url from file name and user id
-        :param file_name: str | Name of the file uploaded
-        :return: str | Full unique filename
-        """
-        return f"{self.id}-{uuid4()}{os.path.splitext(file_name)[1]}"
-
     def upload_profile_picture(self, validated_data: dict[str, File]) -> str:
         """
-        Uploads profile picture to cloud storage and gets image url
-        and stores the image url
+        Stages the uploaded profile picture in redis and hands it to
+        `account.tasks.process_profile_picture`, which resizes and uploads it
         :param validated_data: Contains validated profile_picture data
-        :return:
+        :return: str | Key of the staged upload
         """
+        from account.tasks import process_profile_picture
+
         file = validated_data["profile_picture"]
-        file_name = file.name
-        url = StorageService.upload_file(
-            file,
-            file_name=self.build_profile_picture_url(file_name),
-            content_type=mimetypes.guess_type(file_name)[0]
-        )
+        key = make_key("uploads", "profile_picture", self.id, uuid4())
+        get_redis().set(key, file.read(), ex=settings.IMAGE_UPLOAD_STAGING_TTL)
+        transaction.on_commit(lambda: process_profile_picture.delay(self.id, key, file.name))
+        return key
+
+    def attach_profile_picture(self, key: str, url: str):
+        """
+        Links a picture uploaded straight to the bucket, the original is shown until
+        `account.tasks.process_profile_picture` has made the resized variants from it
+        :param key: Bucket key of the confirmed upload
+        :param url: URL of the confirmed upload
+        """
+        from account.tasks import process_profile_picture
+
         self.profile_picture_url = url
-        self.save()
-        return url
+        self.profile_picture_variants = {}
+        self.save(update_fields=["profile_picture_url", "profile_picture_variants", "updated_at"])
+        transaction.on_commit(lambda: process_profile_picture.delay(self.id, key, key, source="storage"))
+
+    def set_profile_picture(self, data: bytes):
+        """
+        Resizes the picture to every PROFILE_PICTURE_SIZES variant in webp and jpeg,
+        stores them under their content digest and stores their urls
+        :param data: Uploaded file
+        """
+        variants = {}
+        for name, encoded in make_variants(data, settings.PROFILE_PICTURE_SIZES).items():
+            variants[name] = {
+                image_format: store_file(content, CONTENT_TYPES[image_format])
+                for image_format, content in encoded.items()
+            }
+        self.profile_picture_variants = variants
+        self.profile_picture_url = variants[settings.PROFILE_PICTURE_DEFAULT_SIZE]["jpeg"]
+        self.save(update_fields=["profile_picture_url", "profile_picture_variants", "updated_at"])
 
     def send_verification_email(self, request: HttpRequest):
         """
@@ -92,7 +138,7 @@ class User(AbstractUser, TimeStampedModel):
                     Verify account for Blogs
                 </a>
             """
-            send_email.delay(
+            mail.enqueue(
                 "Verify account",
                 "",
                 settings.DEFAULT_FROM_EMAIL,
@@ -141,12 +187,127 @@ class UserDetails(TimeStampedModel):
         return self.user_id
 
 
+class FollowerManager(models.Manager):
+
+    def follow_many(self, user: User, following_ids: list[int]) -> list[int]:
+        """
+        Follows every existing user of following_ids with a single idempotent insert,
+        and updates the counters of the users whose relationship was created, in one transaction
+        :param user: Follower
+        :param following_ids: Ids of the users to follow
+        :return: list[int] Ids of the users that were not followed before
+        """
+        now = timezone.now()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {self.model._meta.db_table} (user_id, following_id, created_at, updated_at)
+                SELECT %s, u.id, %s, %s FROM {User._meta.db_table} u WHERE u.id = ANY(%s)
+                ON CONFLICT (user_id, following_id) DO NOTHING
+                RETURNING following_id
+                """,
+                [user.pk, now, now, list(set(following_ids))]
+            )
+            created = [row[0] for row in cursor.fetchall()]
+            User.objects.update_follow_counts(user.pk, created, 1)
+            graph.add_follows(user.pk, created)
+        return created
+
+    def unfollow_many(self, user: User, following_ids: list[int]) -> list[int]:
+        """
+        Unfollows every user of following_ids with a single delete,
+        and updates the counters of the users whose relationship was deleted, in one transaction
+        :param user: Follower
+        :param following_ids: Ids of the users to unfollow
+        :return: list[int] Ids of the users that were followed before
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                DELETE FROM {self.model._meta.db_table}
+                WHERE user_id = %s AND following_id = ANY(%s)
+                RETURNING following_id
+                """,
+                [user.pk, list(set(following_ids))]
+            )
+            deleted = [row[0] for row in cursor.fetchall()]
+            User.objects.update_follow_counts(user.pk, deleted, -1)
+            graph.remove_follows(user.pk, deleted)
+        return deleted
+
+    def get_following_ids(self, user: User, user_ids: list[int]) -> set[int]:
+        """
+        Which of user_ids the user follows, in one query
+        :param user: Follower
+        :param user_ids: Ids to check
+        :return: set[int]
+        """
+        if not user.is_authenticated or not user_ids:
+            return set()
+        return set(self.filter(user=user, following_id__in=user_ids).values_list("following_id", flat=True))
+
+    def follow(self, user: User, following: User) -> tuple[Follower, bool]:
+        """
+        Follows a user, concurrent calls never create duplicates
+        :param user: Follower
+        :param following: Followed user
+        :return: Follower and whether it was created
+        """
+        created = bool(self.follow_many(user, [following.pk]))
+        return self.get(user=user, following=following), created
+
+    def unfollow(self, user: User, following: User) -> int:
+        """
+        Unfollows a user
+        :param user: Follower
+        :param following: Followed user
+        :return: int | Number of deleted relationships
+        """
+        return len(self.unfollow_many(user, [following.pk]))
+
+
 class Follower(TimeStampedModel):
     """
     User follower relationship
     """
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="follow_user_owner")
-    following = models.ForeignKey(User, on_delete=models.CASCADE, related_name="following_user")
+    # Single column indexes are covered by the leading columns of the composite ones
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="follow_user_owner", db_index=False)
+    following = models.ForeignKey(User, on_delete=models.CASCADE, related_name="following_user", db_index=False)
+    objects = FollowerManager()
+
+    class Meta(TimeStampedModel.Meta):
+        constraints = [
+            # Also serves lookups of who a user follows
+            models.UniqueConstraint(fields=["user", "following"], name="account_follower_user_following_uniq"),
+        ]
+        indexes = [
+            # Who follows a user
+            models.Index(fields=["following", "user"], name="account_follower_following_idx"),
+            # Keyset pages of followers and followings, newest first
+            models.Index(fields=["following", "-created_at", "-id"], name="account_followers_page_idx"),
+            models.Index(fields=["user", "-created_at", "-id"], name="account_followings_page_idx"),
+        ]
 
     def __str__(self):
         return f"{self.user_id} - {self.following_id}"
+
+
+class FollowSuggestion(TimeStampedModel):
+    """
+    Precomputed "who to follow" suggestion, see account.suggestions
+    mutual_score: Weighted number of followings that follow the suggested user
+    interest_score: Overlap of tags the user reads and the suggested user writes about
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="follow_suggestions")
+    suggested = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    score = models.FloatField()
+    mutual_score = models.FloatField(default=0)
+    interest_score = models.FloatField(default=0)
+
+    class Meta(TimeStampedModel.Meta):
+        indexes = [
+            models.Index(fields=["user", "-score"], name="account_suggestion_score_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.suggested_id}"
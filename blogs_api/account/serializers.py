@@ -1,6 +1,7 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
 # rest framework imports
-from rest_framework.fields import EmailField, ImageField, CurrentUserDefault, IntegerField, BooleanField
+from rest_framework.fields import EmailField, ImageField, CurrentUserDefault, BooleanField, IntegerField, ListField
 from rest_framework.relations import PrimaryKeyRelatedField
 from rest_framework.serializers import (
     Serializer,
@@ -14,7 +15,7 @@ from rest_framework.validators import UniqueValidator
 from phonenumber_field.serializerfields import PhoneNumberField
 from rest_framework_extensions.serializers import PartialUpdateSerializerMixin
 
-from account.models import UserDetails, Follower
+from account.models import UserDetails, Follower, FollowSuggestion
 from lib.serializers import RequestUserCreateMixin
 
 User = get_user_model()
@@ -56,9 +57,10 @@ class UserSerializer(PartialUpdateSerializerMixin, ModelSerializer):
         # Model User
         model = User
         # Fields
-        fields = ["id", "phone_number", "name", "password", "username", "email", "profile_picture_url"]
+        fields = ["id", "phone_number", "name", "password", "username", "email", "profile_picture_url",
+                  "profile_picture_variants"]
         # Read only Fields
-        read_only_fields = ["id", "profile_picture_url"]
+        read_only_fields = ["id", "profile_picture_url", "profile_picture_variants"]
         # Example
         swagger_example = {
             "phone_number": "+41524204242"
@@ -83,23 +85,23 @@ class UserPublicBaseSerializer(ModelSerializer):
             "id",
             "username",
             "name",
-            "profile_picture_url"
+            "profile_picture_url",
+            "profile_picture_variants"
         ]
         read_only_fields = [
             "id",
             "username",
             "name",
-            "profile_picture_url"
+            "profile_picture_url",
+            "profile_picture_variants"
         ]
 
 
 class UserPublicDetailsSerializer(ModelSerializer):
     """
     Class User profile serializer containing user's details
+    Counts are the values stored on the user
     """
-    follower_count = IntegerField(read_only=True)
-    following_count = IntegerField(read_only=True)
-    blog_count = IntegerField(read_only=True)
 
     class Meta:
         model = User
@@ -108,6 +110,7 @@ class UserPublicDetailsSerializer(ModelSerializer):
             "username",
             "name",
             "profile_picture_url",
+            "profile_picture_variants",
             "follower_count",
             "following_count",
             "blog_count"
@@ -166,20 +169,21 @@ class ProfilePictureUploadSerializer(Serializer):
     Upload profile picture handler
     """
     profile_picture = ImageField(write_only=True)
-    profile_picture_url = CharField(read_only=True)
+
+    def validate_profile_picture(self, value):
+        if value.size > settings.IMAGE_UPLOAD_MAX_SIZE:
+            raise ValidationError(f"Image must be smaller than {settings.IMAGE_UPLOAD_MAX_SIZE // 2 ** 20}MB")
+        return value
 
     def create(self, validated_data):
         """
-        Get file and upload to S3 Storage and get url
-        Store the url in db as profile picture
+        Hands the file to the image pipeline, the resized pictures are stored when it is done
         """
         return self.instance.upload_profile_picture(validated_data)
 
     def save(self, **kwargs):
         self.is_valid(raise_exception=True)
-        return {
-            "profile_picture_url": self.create(self.validated_data)
-        }
+        return self.create(self.validated_data)
 
     def update(self, instance, validated_data):
         ...
@@ -216,17 +220,40 @@ class FollowerSerializer(ModelSerializer):
         user_key = "user"
 
     def create(self, validated_data):
-        validated_data[self.Meta.user_key] = self.context.get("request").user
-        return self.Meta.model.objects.get_or_create(
-            **validated_data
+        return self.Meta.model.objects.follow(
+            self.context.get("request").user, validated_data["following"]
         )[0]
 
     def delete(self):
-        validated_data = self.validated_data
-        validated_data[self.Meta.user_key] = self.context.get("request").user
-        return self.Meta.model.objects.filter(
-            **validated_data
-        ).delete()
+        return self.Meta.model.objects.unfollow(
+            self.context.get("request").user, self.validated_data["following"]
+        )
+
+
+class FollowManySerializer(Serializer):
+    """
+    Follow or unfollow many users at once, EG: users found in imported contacts
+    Unknown ids are ignored
+    """
+    following = ListField(
+        child=IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.FOLLOW_MANY_MAX_IDS,
+        write_only=True
+    )
+    changed = ListField(child=IntegerField(), read_only=True)
+
+    def create(self, validated_data):
+        return {
+            "changed": Follower.objects.follow_many(self.context.get("request").user, validated_data["following"])
+        }
+
+    def delete(self):
+        return {
+            "changed": Follower.objects.unfollow_many(
+                self.context.get("request").user, self.validated_data["following"]
+            )
+        }
 
 
 class FollowerDetailsSerializer(ModelSerializer):
@@ -237,4 +264,34 @@ class FollowerDetailsSerializer(ModelSerializer):
 
     class Meta:
         model = User
-        fields = ["id", "name", "username", "profile_picture_url", "is_following"]
+        fields = ["id", "name", "username", "profile_picture_url", "profile_picture_variants", "is_following"]
+
+
+class RelationshipSerializer(Serializer):
+    """
+    Relationship of the requesting user with another user
+    """
+    following = BooleanField(read_only=True)
+    follows_you = BooleanField(read_only=True)
+    is_mutual = BooleanField(read_only=True)
+    followed_by = UserPublicBaseSerializer(many=True, read_only=True)
+    followed_by_count = IntegerField(read_only=True)
+    follower_count = IntegerField(read_only=True)
+    following_count = IntegerField(read_only=True)
+
+    def create(self, validated_data):
+        pass
+
+    def update(self, instance, validated_data):
+        pass
+
+
+class FollowSuggestionSerializer(ModelSerializer):
+    """
+    Suggested user with its scores
+    """
+    suggested = UserPublicBaseSerializer(read_only=True)
+
+    class Meta:
+        model = FollowSuggestion
+        fields = ["suggested", "score", "mutual_score", "interest_score"]
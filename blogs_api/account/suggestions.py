@@ -0,0 +1,142 @@
+"""
+Offline "who to follow" scoring, run in chunks of users by `account.tasks.compute_follow_suggestions`.
+Scores are sparse co-occurrence products kept in dicts, only non zero entries are ever materialized:
+friends of friends: (A @ A)[u, c], A being the follow matrix, every hop through v weighted by 1 / log(2 + |A[v]|)
+so accounts following everyone say little.
+shared interests: (T @ Sᵀ)[u, c], T the tags of blogs a user up voted or wrote, S the tags of blogs c wrote
+"""
+import heapq
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+from account.models import Follower, FollowSuggestion, User
+from blog.models import TagContent, VoteChoice
+
+SparseMatrix = dict[int, dict[int, float]]
+
+
+def get_followings(user_ids: set[int]) -> dict[int, set[int]]:
+    followings = defaultdict(set)
+    for user_id, following_id in Follower.objects.filter(user_id__in=user_ids).values_list(
+            "user_id", "following_id"
+    ):
+        followings[user_id].add(following_id)
+    return followings
+
+
+def score_friends_of_friends(followings: dict[int, set[int]]) -> SparseMatrix:
+    """
+    Weighted two hop paths u -> v -> c from every chunk user u
+    Intermediates following more than SUGGESTION_MAX_FANOUT users are skipped
+    """
+    intermediates = set().union(*followings.values()) if followings else set()
+    intermediates = set(
+        User.objects.filter(
+            pk__in=intermediates, following_count__gt=0, following_count__lte=settings.SUGGESTION_MAX_FANOUT
+        ).values_list("pk", flat=True)
+    )
+    second_hop = get_followings(intermediates)
+    scores = defaultdict(lambda: defaultdict(float))
+    for user_id, direct in followings.items():
+        for intermediate in direct & intermediates:
+            targets = second_hop.get(intermediate, ())
+            weight = 1 / math.log(2 + len(targets))
+            row = scores[user_id]
+            for target in targets:
+                row[target] += weight
+    return scores
+
+
+def get_interests(user_ids: set[int]) -> SparseMatrix:
+    """
+    Tag weights of each user from the blogs they up voted and wrote, rows sum to one
+    """
+    counts = defaultdict(lambda: defaultdict(float))
+    for user_key, filters in (
+            ("content__vote__author_id", {"content__vote__author_id__in": user_ids,
+                                          "content__vote__state": VoteChoice.UP_VOTE}),
+            ("content__author_id", {"content__author_id__in": user_ids}),
+    ):
+        for user_id, tag_id, count in TagContent.objects.filter(**filters).values(
+                user_key, "tag_id"
+        ).annotate(count=Count("id")).values_list(user_key, "tag_id", "count"):
+            counts[user_id][tag_id] += count
+    return {
+        user_id: {tag_id: count / sum(row.values()) for tag_id, count in row.items()}
+        for user_id, row in counts.items()
+    }
+
+
+def get_tag_authors(tag_ids: set[int]) -> SparseMatrix:
+    """
+    Top SUGGESTION_AUTHORS_PER_TAG authors of public blogs of each tag, weighted by log of their blog count
+    """
+    authors = defaultdict(dict)
+    for tag_id, author_id, count in TagContent.objects.filter(
+            tag_id__in=tag_ids,
+            content__is_archived=False,
+            content__is_draft=False,
+            content__is_banned=False,
+            content__is_deleted=False,
+    ).values("tag_id", "content__author_id").annotate(count=Count("id")).order_by("-count").values_list(
+        "tag_id", "content__author_id", "count"
+    ):
+        if len(authors[tag_id]) < settings.SUGGESTION_AUTHORS_PER_TAG:
+            authors[tag_id][author_id] = math.log1p(count)
+    return authors
+
+
+def score_shared_interests(interests: SparseMatrix) -> SparseMatrix:
+    tag_authors = get_tag_authors(set().union(*interests.values()) if interests else set())
+    scores = defaultdict(lambda: defaultdict(float))
+    for user_id, tags in interests.items():
+        row = scores[user_id]
+        for tag_id, weight in tags.items():
+            for author_id, author_weight in tag_authors.get(tag_id, {}).items():
+                row[author_id] += weight * author_weight
+    return scores
+
+
+def compute_suggestions(user_ids: list[int]) -> int:
+    """
+    Scores candidates of the users and replaces their stored top SUGGESTION_TOP_K suggestions
+    Users and accounts they already follow are never suggested
+    :param user_ids: Chunk of user ids
+    :return: int | Number of stored suggestions
+    """
+    user_ids = set(user_ids)
+    followings = get_followings(user_ids)
+    mutual = score_friends_of_friends(followings)
+    shared = score_shared_interests(get_interests(user_ids))
+
+    suggestions = []
+    for user_id in user_ids:
+        excluded = followings.get(user_id, set()) | {user_id}
+        mutual_row, shared_row = mutual.get(user_id, {}), shared.get(user_id, {})
+        scores = {
+            candidate: settings.SUGGESTION_MUTUAL_WEIGHT * mutual_row.get(candidate, 0)
+            + settings.SUGGESTION_INTEREST_WEIGHT * shared_row.get(candidate, 0)
+            for candidate in mutual_row.keys() | shared_row.keys()
+            if candidate not in excluded
+        }
+        suggestions.extend(
+            FollowSuggestion(
+                user_id=user_id,
+                suggested_id=candidate,
+                score=score,
+                mutual_score=mutual_row.get(candidate, 0),
+                interest_score=shared_row.get(candidate, 0),
+            )
+            for candidate, score in heapq.nlargest(
+                settings.SUGGESTION_TOP_K, scores.items(), key=lambda item: item[1]
+            )
+        )
+
+    with transaction.atomic():
+        FollowSuggestion.objects.filter(user_id__in=user_ids).delete()
+        FollowSuggestion.objects.bulk_create(suggestions, batch_size=1000)
+    return len(suggestions)
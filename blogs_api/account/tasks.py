@@ -0,0 +1,62 @@
+import logging
+
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+
+from blogs_api.celery import app
+from account.models import User
+from account.suggestions import compute_suggestions
+from lib.backends import StorageError, StorageFileNotFound, StorageService
+from lib.cache import get_redis
+from lib.images import ImageProcessingError
+
+logger = logging.getLogger(__name__)
+
+
+@app.task(ignore_result=True)
+def compute_follow_suggestions(after_id: int = 0):
+    """
+    Recomputes follow suggestions of a chunk of active users, then schedules the next chunk
+    :param after_id: Id of the last user of the previous chunk
+    """
+    ids = list(
+        User.objects.filter(pk__gt=after_id, is_active=True).order_by("pk").values_list("pk", flat=True)[
+            :settings.SUGGESTION_CHUNK_SIZE
+        ]
+    )
+    if not ids:
+        return
+    compute_suggestions(ids)
+    if len(ids) == settings.SUGGESTION_CHUNK_SIZE:
+        compute_follow_suggestions.delay(ids[-1])
+
+
+@app.task(bind=True, max_retries=3, ignore_result=True)
+def process_profile_picture(self, user_id: int, key: str, file_name: str, source: str = "cache"):
+    """
+    Resizes a profile picture and uploads the variants
+    The picture is either staged in redis by `User.upload_profile_picture` or uploaded straight to the bucket
+    Storage errors are retried, a staged file is kept until it succeeds or expires, a missing file is not
+    :param user_id: Id of the user
+    :param key: Redis key of the staged upload or bucket key of the uploaded file
+    :param file_name: Name of the uploaded file
+    :param source: cache or storage
+    """
+    user = User.objects.filter(pk=user_id).first()
+    try:
+        data = get_redis().get(key) if source == "cache" else StorageService.download_file(key)
+    except StorageFileNotFound:
+        data = None
+    except (BotoCoreError, ClientError, StorageError) as exc:
+        raise self.retry(exc=exc, countdown=10 * 2 ** self.request.retries)
+    if data is None or user is None:
+        logger.warning("Profile picture %s of user %s is gone", key, user_id)
+        return
+    try:
+        user.set_profile_picture(data)
+    except ImageProcessingError:
+        logger.warning("Profile picture %s (%s) of user %s is not a valid image", key, file_name, user_id)
+    except (BotoCoreError, ClientError, StorageError) as exc:
+        raise self.retry(exc=exc, countdown=10 * 2 ** self.request.retries)
+    if source == "cache":
+        get_redis().delete(key)
@@ -1,3 +1,28 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from account import tasks
+from account.models import User
+from lib.backends import StorageError, StorageFileNotFound
+
+
+@mock.patch.object(User, "objects")
+@mock.patch("account.tasks.StorageService")
+class ProcessProfilePictureTestCase(SimpleTestCase):
+
+    def test_missing_upload_is_gone(self, storage, users):
+        storage.download_file.side_effect = StorageFileNotFound("content/uploads/users/1/a.png")
+        with mock.patch.object(tasks.process_profile_picture, "retry") as retry, \
+                self.assertLogs("account.tasks", "WARNING") as logs:
+            tasks.process_profile_picture(1, "content/uploads/users/1/a.png", "a.png", source="storage")
+        retry.assert_not_called()
+        self.assertIn("is gone", logs.output[0])
+        users.filter.return_value.first.return_value.set_profile_picture.assert_not_called()
+
+    def test_storage_errors_are_retried(self, storage, users):
+        storage.download_file.side_effect = StorageError("Disk unavailable")
+        with mock.patch.object(tasks.process_profile_picture, "retry", side_effect=RuntimeError) as retry:
+            with self.assertRaises(RuntimeError):
+                tasks.process_profile_picture(1, "content/uploads/users/1/a.png", "a.png", source="storage")
+        retry.assert_called_once()
@@ -1,21 +1,29 @@
-from django.db.models import Case, F, Exists, OuterRef
+from django.conf import settings
+from django.db.models import QuerySet
 from django.shortcuts import get_object_or_404
 from drf_yasg.openapi import Parameter, IN_QUERY, Schema
 from drf_yasg.utils import swagger_auto_schema, no_body
 from rest_framework import viewsets, parsers, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
 
-from account.models import User, UserDetails, Follower
+from account import graph
+from account.models import User, UserDetails, Follower, FollowSuggestion
 from account.permissions import UserViewPermissionClass
 from account.serializers import (UserSerializer, UserPublicBaseSerializer, ProfilePictureUploadSerializer,
                                  UserDetailsSerializer,
                                  PasswordChangeSerializer, UserDetailsSerializer, UserPublicDetailsSerializer,
-                                 FollowerSerializer, FollowerDetailsSerializer)
+                                 FollowerSerializer, FollowerDetailsSerializer, FollowManySerializer,
+                                 RelationshipSerializer, FollowSuggestionSerializer)
 from rest_framework_extensions.mixins import DetailSerializerMixin, NestedViewSetMixin
 from rest_framework.permissions import AllowAny, IsAuthenticated
 
+from lib.backends import StorageService
+from lib.pagination import KeysetPagination, SortedIdsPagination
 from lib.response import MessageResponse, MessageResponseSchema
+from lib.serializers import DirectUploadSerializer, DirectUploadConfirmSerializer
+from lib.throttling import SlidingWindowThrottle
 from lib.views import retrieve_api, list_api
 
 
@@ -35,24 +43,60 @@ class UserViewSet(DetailSerializerMixin,
         UserViewPermissionClass
     ]
     lookup_url_kwarg = "id"
+    follow_pagination_class = KeysetPagination
+    # Set per action along with throttle_classes
+    throttle_scope = None
 
     def get_object(self):
         return self.request.user
 
-    @swagger_auto_schema(methods=['post'], request_body=ProfilePictureUploadSerializer)
+    @swagger_auto_schema(methods=['post'], request_body=ProfilePictureUploadSerializer,
+                         responses={
+                             202: MessageResponseSchema("Processing profile picture")
+                         })
     @action(detail=False, parser_classes=(parsers.MultiPartParser,), methods=["post"])
     def upload_profile_picture(self, request, *args, **kwargs):
         """
-        Updates / Uploads user profile picture to Cloud Storage
-        and link the image url to User profile_picture_url
+        Accepts a profile picture, resized versions are uploaded to Cloud Storage in the background
+        and linked to User profile_picture_url and profile_picture_variants
         """
         user = self.get_object()
         serializer = ProfilePictureUploadSerializer(data=request.FILES, instance=user)
-        data = serializer.save()
-        return Response(
-            data,
-            status=status.HTTP_201_CREATED
-        )
+        serializer.save()
+        return MessageResponse(message="Processing profile picture", status=status.HTTP_202_ACCEPTED)
+
+    @swagger_auto_schema(methods=['post'], request_body=DirectUploadSerializer)
+    @action(detail=False, methods=["post"], permission_classes=[IsAuthenticated])
+    def profile_picture_upload_url(self, request, *args, **kwargs):
+        """
+        Presigned upload of a profile picture straight to Cloud Storage,
+        confirm it with confirm_profile_picture_upload once uploaded
+        """
+        serializer = DirectUploadSerializer(data=request.data, context={
+            "key_prefix": StorageService.get_upload_prefix("users", request.user.id),
+            "max_size": settings.IMAGE_UPLOAD_MAX_SIZE,
+        })
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.save(), status=status.HTTP_201_CREATED)
+
+    @swagger_auto_schema(methods=['post'], request_body=DirectUploadConfirmSerializer,
+                         responses={
+                             202: MessageResponseSchema("Processing profile picture")
+                         })
+    @action(detail=False, methods=["post"], permission_classes=[IsAuthenticated])
+    def confirm_profile_picture_upload(self, request, *args, **kwargs):
+        """
+        Links a picture uploaded through profile_picture_upload_url to the user,
+        resized versions are made in the background
+        """
+        user = self.get_object()
+        serializer = DirectUploadConfirmSerializer(data=request.data, context={
+            "key_prefix": StorageService.get_upload_prefix("users", user.id),
+            "max_size": settings.IMAGE_UPLOAD_MAX_SIZE,
+        })
+        serializer.is_valid(raise_exception=True)
+        user.attach_profile_picture(serializer.validated_data["key"], serializer.validated_data["url"])
+        return MessageResponse(message="Processing profile picture", status=status.HTTP_202_ACCEPTED)
 
     @action(methods=["put", "patch"], detail=False)
     def edit(self, request, *args, **kwargs):
@@ -84,7 +128,8 @@ class UserViewSet(DetailSerializerMixin,
                              201: MessageResponseSchema("Sent verification mail")
                          }
                          )
-    @action(detail=False, methods=["post"])
+    @action(detail=False, methods=["post"], throttle_classes=[SlidingWindowThrottle],
+            throttle_scope="send_verification")
     def send_verification(self, request, *args, **kwargs):
         """
         Sends verification mail
@@ -127,7 +172,8 @@ class UserViewSet(DetailSerializerMixin,
             200: FollowerSerializer()
         }
     )
-    @action(methods=["post"], detail=False, permission_classes=[IsAuthenticated])
+    @action(methods=["post"], detail=False, permission_classes=[IsAuthenticated],
+            throttle_classes=[SlidingWindowThrottle], throttle_scope="follow")
     def follow(self, request, *args, **kwargs):
         """
         Follow a user
@@ -143,7 +189,8 @@ class UserViewSet(DetailSerializerMixin,
             200: MessageResponseSchema(message="Unfollowed")
         }
     )
-    @action(methods=["post"], detail=False, permission_classes=[IsAuthenticated])
+    @action(methods=["post"], detail=False, permission_classes=[IsAuthenticated],
+            throttle_classes=[SlidingWindowThrottle], throttle_scope="follow")
     def unfollow(self, request, *args, **kwargs):
         """
         Unfollow a user
@@ -153,36 +200,150 @@ class UserViewSet(DetailSerializerMixin,
         serializer.delete()
         return MessageResponse(message="Unfollowed", status=status.HTTP_204_NO_CONTENT)
 
+    @swagger_auto_schema(
+        request_body=FollowManySerializer(),
+        responses={
+            201: FollowManySerializer()
+        }
+    )
+    @action(methods=["post"], detail=False, permission_classes=[IsAuthenticated],
+            throttle_classes=[SlidingWindowThrottle], throttle_scope="follow_many")
+    def follow_many(self, request, *args, **kwargs):
+        """
+        Follow many users in a single statement, `changed` holds ids of the newly followed users
+        """
+        serializer = FollowManySerializer(context=self.get_serializer_context(), data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.save(), status=status.HTTP_201_CREATED)
+
+    @swagger_auto_schema(
+        request_body=FollowManySerializer(),
+        responses={
+            200: FollowManySerializer()
+        }
+    )
+    @action(methods=["post"], detail=False, permission_classes=[IsAuthenticated],
+            throttle_classes=[SlidingWindowThrottle], throttle_scope="follow_many")
+    def unfollow_many(self, request, *args, **kwargs):
+        """
+        Unfollow many users in a single statement, `changed` holds ids of the unfollowed users
+        """
+        serializer = FollowManySerializer(context=self.get_serializer_context(), data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.delete(), status=status.HTTP_200_OK)
+
+    def list_follows(self, request, queryset: QuerySet[Follower], user_field: str, serializer) -> Response:
+        """
+        Keyset paginated users of follow relationships, newest relationship first
+        Annotates `is_following`, whether the requesting user follows the listed user, for the page only
+        :param request: Request
+        :param queryset: Follower rows to list
+        :param user_field: Relationship side to list, user or following
+        :param serializer: Serializer class of users
+        :return: Response
+        """
+        paginator = self.follow_pagination_class()
+        page = paginator.paginate_queryset(
+            queryset.select_related(user_field).only(
+                "id", "created_at", user_field,
+                *(
+                    f"{user_field}__{field}"
+                    for field in ("id", "username", "name", "profile_picture_url", "profile_picture_variants")
+                )
+            ),
+            request,
+            view=self
+        )
+        users = [getattr(follow, user_field) for follow in page]
+        following_ids = Follower.objects.get_following_ids(request.user, [user.pk for user in users])
+        for user in users:
+            user.is_following = user.pk in following_ids
+        return paginator.get_paginated_response(serializer(users, many=True).data)
+
     @action(methods=["get"], detail=True)
     def followers(self, request, *args, **kwargs):
         """
-        List of followers paginated
+        Followers of a user, newest first, paginated
         """
-        return list_api(
+        return self.list_follows(
             request,
-            self,
-            queryset=User.objects.filter(
-                follow_user_owner__following=kwargs.get("id")
-            ).annotate(
-                is_following=Exists(Follower.objects.filter(user=OuterRef("id"), following=kwargs.get("id")))
-            ),
-            serializer=FollowerDetailsSerializer,
-            paginator=self.paginator
+            Follower.objects.filter(following=kwargs.get("id")),
+            "user",
+            FollowerDetailsSerializer
         )
 
     @action(methods=["get"], detail=False)
     def followings(self, request, *args, **kwargs):
         """
-        List of followers paginated
+        Users the requesting user follows, newest first, paginated
+        """
+        return self.list_follows(
+            request,
+            Follower.objects.filter(user=request.user),
+            "following",
+            self.serializer_detail_class
+        )
+
+    @action(methods=["get"], detail=False, permission_classes=[IsAuthenticated])
+    def mutuals(self, request, *args, **kwargs):
+        """
+        Users the requesting user follows that follow back, paginated by id
+        """
+        paginator = SortedIdsPagination()
+        ids = paginator.paginate_queryset(sorted(graph.mutuals(request.user.pk)), request, view=self)
+        users = User.objects.in_bulk(ids)
+        return paginator.get_paginated_response(
+            self.serializer_detail_class([users[pk] for pk in ids if pk in users], many=True).data
+        )
+
+    @swagger_auto_schema(
+        responses={
+            200: RelationshipSerializer()
+        }
+    )
+    @action(methods=["get"], detail=True, permission_classes=[IsAuthenticated])
+    def relationship(self, request, *args, **kwargs):
+        """
+        Follow state between the requesting user and a user, and who of the requesting user's
+        followings follow that user
+        """
+        if not str(kwargs.get("id")).isdigit():
+            raise NotFound()
+        user_id, target_id = request.user.pk, int(kwargs.get("id"))
+        following, = graph.contains(user_id, graph.FOLLOWING, [target_id])
+        follows_you, = graph.contains(user_id, graph.FOLLOWERS, [target_id])
+        followed_by = sorted(graph.followed_by_followings(user_id, target_id))
+        return retrieve_api(
+            {
+                "following": following,
+                "follows_you": follows_you,
+                "is_mutual": following and follows_you,
+                "followed_by": User.objects.filter(pk__in=followed_by[:settings.SOCIAL_GRAPH_FOLLOWED_BY_PREVIEW]),
+                "followed_by_count": len(followed_by),
+                "follower_count": graph.count(target_id, graph.FOLLOWERS),
+                "following_count": graph.count(target_id, graph.FOLLOWING),
+            },
+            RelationshipSerializer
+        )
+
+    @swagger_auto_schema(
+        responses={
+            200: FollowSuggestionSerializer(many=True)
+        }
+    )
+    @action(methods=["get"], detail=False, permission_classes=[IsAuthenticated])
+    def suggestions(self, request, *args, **kwargs):
+        """
+        Who to follow, precomputed daily from friends of friends and shared tag interests
+        Users followed since the last computation are left out
         """
         return list_api(
             request,
             self,
-            queryset=User.objects.filter(
-                following_user__user=self.request.user
-            ),
-            serializer=self.serializer_detail_class,
-            paginator=self.paginator
+            queryset=FollowSuggestion.objects.filter(user=request.user).exclude(
+                suggested__following_user__user=request.user
+            ).select_related("suggested").order_by("-score"),
+            serializer=FollowSuggestionSerializer
         )
 
 
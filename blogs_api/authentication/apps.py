@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
 
 
 class AuthenticationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'authentication'
+
+    def ready(self):
+        from authentication.authentication import invalidate_user
+
+        def handle_user_change(sender, instance, **kwargs):
+            invalidate_user(instance.pk)
+
+        post_save.connect(handle_user_change, sender=settings.AUTH_USER_MODEL, weak=False,
+                          dispatch_uid="authentication.invalidate_user.save")
+        post_delete.connect(handle_user_change, sender=settings.AUTH_USER_MODEL, weak=False,
+                            dispatch_uid="authentication.invalidate_user.delete")
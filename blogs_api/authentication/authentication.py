@@ -0,0 +1,79 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.translation import gettext_lazy as _
+from django_redis.exceptions import ConnectionInterrupted
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+# Loaded lazily when accessed: counters are kept out of the cache so saving a cached user never
+# overwrites them, and password hashes never leave the database
+DEFERRED_FIELDS = ("password", "follower_count", "following_count", "blog_count")
+
+
+def get_cache_key(user_id) -> str:
+    return f"auth:user:{user_id}"
+
+
+def get_generation_key(user_id) -> str:
+    return f"auth:user:{user_id}:generation"
+
+
+def invalidate_user(user_id):
+    """
+    Bumps the generation of the cached user once the current transaction commits,
+    entries cached under an older generation are never served again.
+    Connected to the User save and delete signals in AuthenticationConfig
+    """
+    def bump():
+        key = get_generation_key(user_id)
+        try:
+            cache.add(key, 0, timeout=None)
+            cache.incr(key)
+        except ConnectionInterrupted:
+            pass
+
+    transaction.on_commit(bump)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication resolving the user from the cache, the database is only read on a miss
+    Users are cached for AUTH_USER_CACHE_TTL seconds with the generation read before the database,
+    saving a user bumps its generation, EG: password change, verification, deactivation.
+    A user read before a concurrent save is cached under the old generation and never served
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        key, generation_key = get_cache_key(user_id), get_generation_key(user_id)
+        try:
+            cached = cache.get_many([key, generation_key])
+        except ConnectionInterrupted:
+            key, cached = None, {}
+        generation = cached.get(generation_key, 0)
+        user = None
+        if key in cached and cached[key][0] == generation:
+            user = cached[key][1]
+        if user is None:
+            try:
+                user = self.user_model.objects.defer(*DEFERRED_FIELDS).get(
+                    **{api_settings.USER_ID_FIELD: user_id}
+                )
+            except self.user_model.DoesNotExist:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found")
+            if key is not None:
+                try:
+                    cache.set(key, (generation, user), settings.AUTH_USER_CACHE_TTL)
+                except ConnectionInterrupted:
+                    pass
+
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        return user
@@ -1,3 +1,54 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from rest_framework_simplejwt.settings import api_settings
+
+from account.models import User
+from authentication.authentication import CachedJWTAuthentication, invalidate_user
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+                   AUTH_USER_CACHE_TTL=60)
+class CachedJWTAuthenticationTestCase(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.authentication = CachedJWTAuthentication()
+        self.users = mock.Mock()
+        self.authentication.user_model = mock.Mock(objects=self.users, DoesNotExist=User.DoesNotExist)
+        self.token = {api_settings.USER_ID_CLAIM: 1}
+        on_commit = mock.patch("authentication.authentication.transaction.on_commit", side_effect=lambda func: func())
+        on_commit.start()
+        self.addCleanup(on_commit.stop)
+
+    def load(self, *rows):
+        """
+        Rows returned by the database in order, callables are called with the lookup
+        """
+        self.rows = list(rows)
+        self.users.defer.return_value.get.side_effect = lambda **kwargs: (
+            self.rows.pop(0)(**kwargs) if callable(self.rows[0]) else self.rows.pop(0)
+        )
+
+    def test_user_is_read_from_the_database_once(self):
+        self.load(User(pk=1, username="first"))
+        self.assertEqual(self.authentication.get_user(self.token).username, "first")
+        self.assertEqual(self.authentication.get_user(self.token).username, "first")
+        self.assertEqual(self.users.defer.return_value.get.call_count, 1)
+
+    def test_saved_user_is_read_again(self):
+        self.load(User(pk=1, username="first"), User(pk=1, username="second"))
+        self.authentication.get_user(self.token)
+        invalidate_user(1)
+        self.assertEqual(self.authentication.get_user(self.token).username, "second")
+
+    def test_user_read_before_a_concurrent_save_is_not_served(self):
+        def read_then_save(**kwargs):
+            # The save commits after this request read the old row and before it is cached
+            invalidate_user(1)
+            return User(pk=1, username="stale")
+
+        self.load(read_then_save, lambda **kwargs: User(pk=1, username="fresh"))
+        self.assertEqual(self.authentication.get_user(self.token).username, "stale")
+        self.assertEqual(self.authentication.get_user(self.token).username, "fresh")
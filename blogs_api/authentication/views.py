@@ -2,6 +2,8 @@ from authentication.serializers import TokenObtainPairSerializer, TokenRefreshSe
 from rest_framework_simplejwt.views import TokenViewBase
 from rest_framework.viewsets import ViewSetMixin
 
+from lib.throttling import SlidingWindowThrottle
+
 
 class TokenObtainPairView(TokenViewBase):
     """
@@ -9,6 +11,8 @@ class TokenObtainPairView(TokenViewBase):
     token pair to prove the authentication of those credentials.
     """
     serializer_class = TokenObtainPairSerializer
+    throttle_classes = [SlidingWindowThrottle]
+    throttle_scope = "token_obtain"
 
 
 token_obtain_pair = TokenObtainPairView.as_view()
@@ -1,8 +1,16 @@
 from django_elasticsearch_dsl import Document, fields
 from django_elasticsearch_dsl.registries import registry
+from elasticsearch_dsl import analyzer, token_filter
 
 from blog.models import Blog, Vote, Comment, Tag, TagContent
 
+# Indexes every prefix of every title word, so typeahead is a plain term match at query time
+title_edge_ngram = analyzer(
+    "title_edge_ngram",
+    tokenizer="standard",
+    filter=["lowercase", token_filter("title_edge_ngram_filter", "edge_ngram", min_gram=1, max_gram=20)]
+)
+
 
 @registry.register_document
 class TagDocument(Document):
@@ -26,8 +34,13 @@ class TagDocument(Document):
             TagContent
         ]
 
+    def get_queryset(self):
+        return Tag.objects.get_active_tags()
+
     @staticmethod
     def prepare_count(obj: Tag):
+        if hasattr(obj, "count"):
+            return obj.count
         return obj.tagcontent_set.count()
 
 
@@ -46,6 +59,14 @@ class BlogDocument(Document):
     up_vote_count = fields.LongField()
     down_vote_count = fields.LongField()
     comment_count = fields.LongField()
+    title = fields.TextField(
+        fields={
+            "edge": fields.TextField(analyzer=title_edge_ngram, search_analyzer="standard"),
+        }
+    )
+    title_suggest = fields.CompletionField(
+        contexts=[{"name": "visibility", "type": "category"}]
+    )
 
     class Index:
         name = "blogs"
@@ -58,7 +79,6 @@ class BlogDocument(Document):
         model = Blog
         fields = [
             "id",
-            "title",
             "text",
             "view_count",
             "is_archived",
@@ -71,25 +91,39 @@ class BlogDocument(Document):
 
         related_models = [
             Vote,
-            Comment
+            Comment,
+            TagContent
         ]
 
+    def get_queryset(self):
+        return Blog.objects.get_indexing_queryset()
+
     @staticmethod
     def prepare_author(obj: Blog):
         return obj.prepare_author()
 
     @staticmethod
     def prepare_up_vote_count(obj: Blog):
+        if hasattr(obj, "up_vote_count"):
+            return obj.up_vote_count
         return obj.get_up_vote_count()
 
     @staticmethod
     def prepare_down_vote_count(obj: Blog):
+        if hasattr(obj, "down_vote_count"):
+            return obj.down_vote_count
         return obj.get_down_vote_count()
 
     @staticmethod
     def prepare_comment_count(obj: Blog):
+        if hasattr(obj, "comment_count"):
+            return obj.comment_count
         return obj.get_comment_count()
 
     @staticmethod
     def prepare_tags(obj: Blog):
         return obj.prepare_tags()
+
+    @staticmethod
+    def prepare_title_suggest(obj: Blog):
+        return obj.prepare_title_suggest()
@@ -0,0 +1,368 @@
+import logging
+from collections import defaultdict
+from typing import Iterable, Type
+
+from django.conf import settings
+from django.db import models, transaction
+from django_elasticsearch_dsl import Document
+from django_elasticsearch_dsl.registries import registry
+from django_elasticsearch_dsl.signals import BaseSignalProcessor
+from elasticsearch_dsl.connections import connections as es_connections
+
+from blog.search import SearchCache
+from lib.cache import get_redis, make_key
+
+logger = logging.getLogger(__name__)
+
+
+def get_document(index_name: str) -> Type[Document]:
+    """
+    Returns registered document class of an index
+    Documents are registered when `blog.documents` is imported
+    :param index_name: str | Name of the index, EG: blogs
+    :return: Document class
+    """
+    for document in registry.get_documents():
+        if document._index._name == index_name:
+            return document
+    raise KeyError(f"No document registered for index '{index_name}'")
+
+
+def dirty_key(index_name: str) -> str:
+    """
+    Redis set holding ids of an index waiting to be re-indexed
+    """
+    return make_key("search", "dirty", index_name)
+
+
+def rebuild_key(index_name: str) -> str:
+    """
+    Redis key holding the name of the index being rebuilt behind the index alias
+    """
+    return make_key("search", "rebuild", index_name)
+
+
+def change_log_key(index_name: str) -> str:
+    """
+    Redis set of ids changed while the index is being rebuilt
+    """
+    return make_key("search", "change_log", index_name)
+
+
+# Adds ids to the dirty set, and to the change log while a rebuild of the index runs
+MARK_DIRTY_SCRIPT = """
+redis.call('sadd', KEYS[1], unpack(ARGV))
+if redis.call('exists', KEYS[2]) == 1 then
+    redis.call('sadd', KEYS[3], unpack(ARGV))
+end
+"""
+
+
+def get_dirty_ids(instance: models.Model) -> dict[str, set[int]]:
+    """
+    Collects document ids affected by a change of the instance, without touching the database.
+    Instance of a document model marks itself, instance of a related model marks the
+    document it points to through its foreign key
+    :param instance: Saved or deleted model instance
+    :return: dict[str, set[int]] Index name and ids
+    """
+    dirty = defaultdict(set)
+    for document in registry.get_documents():
+        index_name = document._index._name
+        if isinstance(instance, document.django.model):
+            dirty[index_name].add(instance.pk)
+            continue
+        for related_model in document.django.related_models:
+            if not isinstance(instance, related_model):
+                continue
+            for field in instance._meta.concrete_fields:
+                if field.is_relation and field.related_model is document.django.model:
+                    value = getattr(instance, field.attname)
+                    if value is not None:
+                        dirty[index_name].add(value)
+    return dirty
+
+
+def mark_dirty(dirty: dict[str, Iterable[int]]):
+    """
+    Records dirty document ids in redis and schedules a debounced flush.
+    Called after the surrounding transaction commits, so the flush never reads uncommitted rows
+    :param dirty: Index name and ids
+    """
+    dirty = {index_name: set(ids) for index_name, ids in dirty.items() if ids}
+    if not dirty:
+        return
+    redis = get_redis()
+    script = redis.register_script(MARK_DIRTY_SCRIPT)
+    pipeline = redis.pipeline(transaction=False)
+    for index_name, ids in dirty.items():
+        script(
+            keys=[dirty_key(index_name), rebuild_key(index_name), change_log_key(index_name)],
+            args=list(ids),
+            client=pipeline
+        )
+    pipeline.execute()
+    schedule_flush()
+
+
+def schedule_flush(countdown: int = None):
+    """
+    Schedules one flush per debounce window, changes made inside the window are picked up by that flush
+    :param countdown: Seconds to wait, defaults to SEARCH_INDEX_DEBOUNCE_SECONDS
+    """
+    from blog.tasks import flush_search_index
+
+    if countdown is None:
+        countdown = settings.SEARCH_INDEX_DEBOUNCE_SECONDS
+    if get_redis().set(make_key("search", "flush_scheduled"), 1, nx=True, ex=max(countdown, 1)):
+        flush_search_index.apply_async(countdown=countdown)
+
+
+def bulk(doc: Document, objects: Iterable[models.Model], action: str = "index",
+         target: str = None, **kwargs) -> tuple[int, list]:
+    """
+    Sends objects to elasticsearch with the bulk api without refreshing
+    :param doc: Document instance
+    :param objects: Model instances
+    :param action: Bulk action, index or delete
+    :param target: Index to write to, defaults to the document index
+    :return: Number of successful actions and errors
+    """
+    actions = doc._get_actions(objects, action)
+    if target:
+        actions = ({**item, "_index": target} for item in actions)
+    kwargs.setdefault("chunk_size", settings.SEARCH_INDEX_BATCH_SIZE)
+    return doc.bulk(actions, refresh=False, **kwargs)
+
+
+def index_ids(document: Type[Document], ids: list[int], target: str = None):
+    """
+    Pushes current state of the ids to the index with the bulk api.
+    Ids that no longer exist in the database are deleted from the index,
+    cached search results containing the ids are dropped afterwards
+    :param document: Document class
+    :param ids: Document ids
+    :param target: Index to write to, defaults to the document index
+    """
+    doc = document()
+    model = document.django.model
+    instances = list(doc.get_queryset().filter(pk__in=ids))
+    if instances:
+        bulk(doc, instances, target=target)
+    missing = set(ids) - {instance.pk for instance in instances}
+    if missing:
+        bulk(doc, [model(pk=pk) for pk in missing], action="delete", target=target, raise_on_error=False)
+    SearchCache.invalidate(document._index._name, ids)
+
+
+def flush_dirty_documents() -> int | None:
+    """
+    Drains dirty ids of every index in batches of SEARCH_INDEX_BATCH_SIZE.
+    A run indexes at most SEARCH_INDEX_MAX_BATCHES batches per index, so a large backlog
+    is spread over several runs instead of holding a worker. Only one run drains at a time.
+    On failure the popped ids are put back before the error is raised
+    :return: int | Number of ids still waiting, None if another run holds the lock
+    """
+    redis = get_redis()
+    lock = redis.lock(make_key("search", "flush_lock"), timeout=settings.SEARCH_INDEX_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return None
+    try:
+        remaining = 0
+        for document in registry.get_documents():
+            key = dirty_key(document._index._name)
+            for _ in range(settings.SEARCH_INDEX_MAX_BATCHES):
+                ids = [int(pk) for pk in redis.spop(key, settings.SEARCH_INDEX_BATCH_SIZE) or []]
+                if not ids:
+                    break
+                try:
+                    index_ids(document, ids)
+                except Exception:
+                    redis.sadd(key, *ids)
+                    raise
+            backlog = redis.scard(key)
+            if backlog > settings.SEARCH_INDEX_BACKLOG_WARNING:
+                logger.warning("Search index backlog of %s for '%s'", backlog, document._index._name)
+            remaining += backlog
+        return remaining
+    finally:
+        lock.release()
+
+
+def init_index_worker():
+    """
+    Initializer of forked rebuild workers, elasticsearch connections inherited from the parent
+    are replaced so every worker opens its own. The parent closes database connections before forking
+    """
+    for alias, kwargs in getattr(settings, "ELASTICSEARCH_DSL", {}).items():
+        es_connections.create_connection(alias, **kwargs)
+
+
+def index_id_range(index_name: str, start: int, end: int, chunk_size: int, target: str = None) -> int:
+    """
+    Indexes documents with start <= id < end using the bulk api, without refreshing the index
+    :param index_name: str | Name of the index
+    :param start: int | First id of the slice
+    :param end: int | Id after the last id of the slice
+    :param chunk_size: int | Rows fetched and documents sent per request
+    :param target: str | Index to write to, defaults to the document index
+    :return: int | Number of indexed documents
+    """
+    document = get_document(index_name)
+    doc = document()
+    queryset = doc.get_queryset().filter(pk__gte=start, pk__lt=end).order_by("pk")
+    success, _ = bulk(doc, queryset.iterator(chunk_size=chunk_size), target=target, chunk_size=chunk_size)
+    return success
+
+
+def start_change_log(index_name: str, target: str):
+    """
+    Starts recording ids changed while target is being filled
+    """
+    redis = get_redis()
+    redis.delete(change_log_key(index_name))
+    redis.set(rebuild_key(index_name), target, ex=settings.SEARCH_REBUILD_TIMEOUT)
+
+
+def stop_change_log(index_name: str):
+    get_redis().delete(rebuild_key(index_name))
+
+
+def replay_change_log(document: Type[Document], target: str = None) -> int:
+    """
+    Indexes the ids recorded in the change log into target
+    :param document: Document class
+    :param target: Index to write to, defaults to the document index
+    :return: int | Number of replayed ids
+    """
+    redis = get_redis()
+    key = change_log_key(document._index._name)
+    replayed = 0
+    while ids := [int(pk) for pk in redis.spop(key, settings.SEARCH_INDEX_BATCH_SIZE) or []]:
+        try:
+            index_ids(document, ids, target=target)
+        except Exception:
+            redis.sadd(key, *ids)
+            raise
+        replayed += len(ids)
+    return replayed
+
+
+def get_refresh_interval(document: Type[Document]) -> str | None:
+    """
+    Refresh interval of the index behind the alias, the one configured on the document
+    when there is no index yet
+    :param document: Document class
+    :return: str | None Interval, None when it is the elasticsearch default
+    """
+    alias = document._index._name
+    client = document._get_connection()
+    if client.indices.exists(index=alias):
+        for details in client.indices.get_settings(index=alias, name="index.refresh_interval").values():
+            return details["settings"].get("index", {}).get("refresh_interval")
+        return None
+    return document._index._settings.get("refresh_interval")
+
+
+def swap_alias(document: Type[Document], target: str) -> list[str]:
+    """
+    Points the index alias to target in one atomic request.
+    A concrete index still using the alias name is removed in the same request
+    :param document: Document class
+    :param target: Name of the new index
+    :return: list[str] Indexes the alias pointed to before
+    """
+    alias = document._index._name
+    client = document._get_connection()
+    previous = []
+    actions = [{"add": {"index": target, "alias": alias}}]
+    if client.indices.exists_alias(name=alias):
+        previous = list(client.indices.get_alias(name=alias))
+        actions = [{"remove": {"index": index, "alias": alias}} for index in previous] + actions
+    elif client.indices.exists(index=alias):
+        actions.append({"remove_index": {"index": alias}})
+    client.indices.update_aliases(body={"actions": actions})
+    return previous
+
+
+def delete_old_versions(document: Type[Document], keep: int) -> list[str]:
+    """
+    Deletes versions of the index that are not behind the alias, except the newest `keep`
+    :param document: Document class
+    :param keep: Number of unused versions to keep for rollback
+    :return: list[str] Deleted indexes
+    """
+    alias = document._index._name
+    client = document._get_connection()
+    versions = client.indices.get(index=f"{alias}-*")
+    unused = sorted(
+        (name for name, details in versions.items() if alias not in details.get("aliases", {})),
+        reverse=True
+    )
+    deleted = unused[keep:]
+    if deleted:
+        client.indices.delete(index=",".join(deleted))
+    return deleted
+
+
+class DirtyQueueSignalProcessor(BaseSignalProcessor):
+    """
+    Signal processor that only records changed document ids in redis.
+    Indexing is done by `blog.tasks.flush_search_index`, outside the request/response cycle
+    """
+
+    def setup(self):
+        models.signals.post_save.connect(self.handle_save)
+        models.signals.post_delete.connect(self.handle_delete)
+        models.signals.m2m_changed.connect(self.handle_m2m_changed)
+
+    def teardown(self):
+        models.signals.post_save.disconnect(self.handle_save)
+        models.signals.post_delete.disconnect(self.handle_delete)
+        models.signals.m2m_changed.disconnect(self.handle_m2m_changed)
+
+    @staticmethod
+    def enqueue(dirty: dict[str, set[int]]):
+        if dirty:
+            transaction.on_commit(lambda: mark_dirty(dirty))
+
+    def handle_save(self, sender, instance, **kwargs):
+        self.enqueue(get_dirty_ids(instance))
+
+    def handle_delete(self, sender, instance, **kwargs):
+        # Deleted ids are flushed like any other, missing rows are removed from the index
+        self.enqueue(get_dirty_ids(instance))
+
+    @staticmethod
+    def get_related_pks(through: Type[models.Model], instance: models.Model,
+                        related_model: Type[models.Model]) -> set[int]:
+        """
+        Ids of related_model linked to instance through the m2m through model
+        """
+        instance_field = related_field = None
+        for field in through._meta.concrete_fields:
+            if field.is_relation and isinstance(instance, field.related_model):
+                instance_field = field
+            elif field.is_relation and field.related_model is related_model:
+                related_field = field
+        if not instance_field or not related_field:
+            return set()
+        return set(
+            through._default_manager.filter(
+                **{instance_field.attname: instance.pk}
+            ).values_list(related_field.attname, flat=True)
+        )
+
+    def handle_m2m_changed(self, sender, instance, action, **kwargs):
+        if action not in ("post_add", "post_remove", "pre_clear"):
+            return
+        dirty = get_dirty_ids(instance)
+        related_model = kwargs["model"]
+        pk_set = kwargs.get("pk_set")
+        if action == "pre_clear":
+            # pk_set is not sent on clear, collect the ids before the rows are gone
+            pk_set = self.get_related_pks(sender, instance, related_model)
+        for pk in pk_set or ():
+            for index_name, ids in get_dirty_ids(related_model(pk=pk)).items():
+                dirty[index_name] |= ids
+        self.enqueue(dirty)
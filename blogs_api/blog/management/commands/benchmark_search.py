@@ -0,0 +1,94 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+import blog.documents  # noqa: F401 registers the documents
+from blog.indexing import index_id_range
+from blog.models import Blog
+from blog.search import ElasticsearchBackend, PostgresBackend
+from blog.views import BlogsViewSet
+
+WORDS = [
+    "django", "python", "docker", "nginx", "postgres", "redis", "celery", "elasticsearch", "kubernetes",
+    "deploy", "server", "cache", "queue", "index", "search", "query", "database", "migration", "model",
+    "view", "serializer", "api", "rest", "token", "auth", "security", "certificate", "ssl", "proxy",
+    "container", "image", "volume", "network", "worker", "task", "schedule", "backup", "monitoring",
+    "logging", "metrics", "latency", "throughput", "scaling", "replica", "shard", "cluster", "storage",
+    "bucket", "upload", "email", "template", "testing", "performance", "profiling", "async", "thread",
+    "process", "memory", "socket", "tutorial", "guide", "production", "development", "pipeline",
+]
+
+
+class Command(BaseCommand):
+    help = "Compares latency and relevance of the elasticsearch and postgres blog search backends on the same data"
+
+    backends = (ElasticsearchBackend, PostgresBackend)
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", type=int, default=0, help="Number of blogs to create and index first")
+        parser.add_argument("--queries", type=int, default=50)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--size", type=int, default=20)
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        if options["seed"]:
+            self.seed(rng, options["seed"])
+
+        queries = [" ".join(rng.sample(WORDS, rng.randint(1, 3))) for _ in range(options["queries"])]
+        timings = {backend.name: [] for backend in self.backends}
+        overlaps = []
+        for query in queries:
+            ids = {}
+            for backend_class in self.backends:
+                backend = backend_class(self.get_view(query))
+                search = backend.build()
+                for _ in range(options["repeat"]):
+                    start = time.perf_counter()
+                    result = backend.execute(search, options["size"])
+                    timings[backend.name].append((time.perf_counter() - start) * 1000)
+                ids[backend.name] = {backend.get_hit_id(hit) for hit in result.hits}
+            expected = ids[ElasticsearchBackend.name]
+            if expected:
+                overlaps.append(len(expected & ids[PostgresBackend.name]) / len(expected))
+
+        for name, values in timings.items():
+            values.sort()
+            self.stdout.write(
+                f"{name:<14} mean {statistics.mean(values):8.2f}ms  "
+                f"p50 {values[len(values) // 2]:8.2f}ms  "
+                f"p95 {values[int(len(values) * 0.95) - 1]:8.2f}ms"
+            )
+        if overlaps:
+            self.stdout.write(
+                f"Top {options['size']} overlap of postgres with elasticsearch: {statistics.mean(overlaps):.1%}"
+            )
+
+    @staticmethod
+    def get_view(query: str) -> BlogsViewSet:
+        view = BlogsViewSet()
+        view.kwargs = {}
+        view.request = RequestFactory().get("/", {"title": query, "text": query})
+        return view
+
+    def seed(self, rng: random.Random, count: int):
+        author, _ = get_user_model().objects.get_or_create(username="search-benchmark")
+        blogs = Blog.objects.bulk_create(
+            [
+                Blog(
+                    author=author,
+                    title=" ".join(rng.choices(WORDS, k=rng.randint(3, 8))).capitalize(),
+                    text=" ".join(rng.choices(WORDS, k=rng.randint(50, 300))),
+                    is_draft=False,
+                )
+                for _ in range(count)
+            ],
+            batch_size=1000
+        )
+        index_id_range("blogs", blogs[0].id, blogs[-1].id + 1, chunk_size=500)
+        BlogsViewSet.document_class._index.refresh()
+        self.stdout.write(f"Seeded and indexed {count} blogs")
@@ -0,0 +1,111 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from multiprocessing import get_context
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Max, Min
+
+import blog.documents  # noqa: F401 registers the documents
+from blog.indexing import (
+    delete_old_versions,
+    get_document,
+    get_refresh_interval,
+    index_id_range,
+    init_index_worker,
+    replay_change_log,
+    start_change_log,
+    stop_change_log,
+    swap_alias,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds search indexes from the database into a new versioned index, slices of ids are "
+        "indexed in parallel worker processes. Changes made during the rebuild are replayed and the "
+        "index alias is swapped to the new index atomically, searches keep using the old index until then"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("indexes", nargs="*", default=["blogs", "tags"])
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--slice-size", type=int, default=5000)
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument("--keep", type=int, default=1, help="Number of old index versions kept for rollback")
+
+    def handle(self, *args, **options):
+        for index_name in options["indexes"]:
+            self.rebuild(
+                index_name, options["workers"], options["slice_size"], options["chunk_size"], options["keep"]
+            )
+
+    def get_slices(self, document, slice_size: int) -> list[tuple[int, int]]:
+        """
+        Splits the id range of the document queryset into [start, end) slices
+        """
+        bounds = document.django.model._default_manager.aggregate(start=Min("pk"), end=Max("pk"))
+        if bounds["start"] is None:
+            return []
+        return [
+            (start, min(start + slice_size, bounds["end"] + 1))
+            for start in range(bounds["start"], bounds["end"] + 1, slice_size)
+        ]
+
+    def rebuild(self, index_name: str, workers: int, slice_size: int, chunk_size: int, keep: int):
+        document = get_document(index_name)
+        target = f"{index_name}-{datetime.utcnow():%Y%m%d%H%M%S}"
+        # Refreshing while bulk loading makes every request create new segments
+        refresh_interval = get_refresh_interval(document)
+        index = document._index.clone(name=target)
+        index.settings(refresh_interval="-1")
+        index.create()
+        slices = self.get_slices(document, slice_size)
+        self.stdout.write(f"Indexing '{index_name}' into '{target}' in {len(slices)} slices with {workers} workers")
+
+        start_change_log(index_name, target)
+        try:
+            total = self.fill(index_name, target, slices, workers, chunk_size)
+            replayed = replay_change_log(document, target)
+            # None resets the interval to the elasticsearch default
+            index.put_settings(body={"index": {"refresh_interval": refresh_interval}})
+            index.refresh()
+            previous = swap_alias(document, target)
+        except BaseException:
+            stop_change_log(index_name)
+            index.delete(ignore_unavailable=True)
+            raise
+        # Changes recorded between the last replay and the swap went to the old index only
+        stop_change_log(index_name)
+        replayed += replay_change_log(document)
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {total} documents into '{target}', replayed {replayed} changes, "
+            f"'{index_name}' now points to '{target}' instead of {previous or 'a concrete index'}"
+        ))
+        deleted = delete_old_versions(document, keep)
+        if deleted:
+            self.stdout.write(f"Deleted old indexes {', '.join(deleted)}")
+
+    @staticmethod
+    def fill(index_name: str, target: str, slices: list[tuple[int, int]], workers: int, chunk_size: int) -> int:
+        """
+        Indexes every slice into target
+        :return: int | Number of indexed documents
+        """
+        if workers <= 1:
+            return sum(index_id_range(index_name, start, end, chunk_size, target) for start, end in slices)
+        total = 0
+        # Forked workers must not share the parent's database connection
+        connections.close_all()
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=get_context("fork"),
+                initializer=init_index_worker
+        ) as executor:
+            futures = [
+                executor.submit(index_id_range, index_name, start, end, chunk_size, target)
+                for start, end in slices
+            ]
+            for future in as_completed(futures):
+                total += future.result()
+        return total
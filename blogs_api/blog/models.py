@@ -1,16 +1,20 @@
 from __future__ import absolute_import, annotations
-import mimetypes
-import os
-from uuid import uuid4
+from datetime import timedelta
+from typing import Any
 
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField, TrigramSimilarity
 from django.core.files import File
-from django.db import models
-from django.db.models import QuerySet, Count, Q
+from django.db import models, transaction
+from django.db.models import QuerySet, Count, Q, OuterRef, Subquery, F, FloatField
+from django.db.models.functions import Coalesce, Cast, Upper
 from django.forms import formset_factory
 from django.utils import timezone
 from django.utils.text import slugify
 
-from lib.backends import StorageService
+from core.storage import store_file, store_files
 from lib.models import TimeStampedModel, LowerCaseCharField
 
 
@@ -25,6 +29,20 @@ class TagManager(models.Manager):
             count=Count("tagcontent")
         )
 
+    def search_tags(self, tag: str) -> QuerySet[Tag]:
+        """
+        Active tags starting with or similar to tag, ranked by trigram similarity
+        Both lookups are served by the trigram index on upper(tag)
+        :param tag: str | Search term
+        :return: QuerySet
+        """
+        return self.get_active_tags().annotate(
+            tag_upper=Upper("tag"),
+            rank=Cast(TrigramSimilarity(Upper("tag"), tag.upper()), FloatField()),
+        ).filter(
+            Q(tag__istartswith=tag) | Q(tag_upper__trigram_similar=tag.upper())
+        )
+
 
 class Tag(TimeStampedModel):
     """
@@ -35,6 +53,11 @@ class Tag(TimeStampedModel):
 
     objects = TagManager()
 
+    class Meta(TimeStampedModel.Meta):
+        indexes = [
+            GinIndex(OpClass(Upper("tag"), name="gin_trgm_ops"), name="blog_tag_tag_trgm"),
+        ]
+
     def __str__(self):
         return self.tag
 
@@ -52,6 +75,13 @@ class TagContent(TimeStampedModel):
 
 class BlogManager(models.Manager):
 
+    def get_queryset(self) -> QuerySet[Blog]:
+        """
+        search_vector is only used inside queries by `full_text_search`, often larger than the text itself
+        :return: QuerySet[Blog]
+        """
+        return super().get_queryset().defer("search_vector")
+
     def all_posts_with_details(self) -> QuerySet[Blog]:
         """
         Returns queryset with additional details
@@ -69,6 +99,80 @@ class BlogManager(models.Manager):
             "-view_count"
         )
 
+    def get_indexing_queryset(self) -> QuerySet[Blog]:
+        """
+        Blogs with everything the search document needs in a single query
+        Counts are correlated subqueries, so votes and comments are not joined together
+        :return: QuerySet
+        """
+        return self.get_queryset().annotate(
+            up_vote_count=self._count_subquery(Vote, state=VoteChoice.UP_VOTE),
+            down_vote_count=self._count_subquery(Vote, state=VoteChoice.DOWN_VOTE),
+            comment_count=self._count_subquery(Comment),
+        ).select_related(
+            "author",
+        ).prefetch_related(
+            "tags",
+        )
+
+    @staticmethod
+    def _count_subquery(model, **filters) -> Coalesce:
+        """
+        Count of model rows pointing to the blog
+        :param model: Model with `blog` foreign key
+        :param filters: Additional filters
+        :return: Coalesce expression
+        """
+        return Coalesce(
+            Subquery(
+                model.objects.filter(blog=OuterRef("pk"), **filters).order_by().values(
+                    "blog"
+                ).annotate(count=Count("*")).values("count")
+            ),
+            0
+        )
+
+    def full_text_search(self, title: str = "", text: str = "") -> QuerySet[Blog]:
+        """
+        Full text search over the stored search_vector, title words weigh more than text words
+        Results are annotated with `rank`, the vector is matched and ranked in the database and never loaded
+        :param title: str | Search terms for title
+        :param text: str | Search terms for text
+        :return: QuerySet
+        """
+        queries = [SearchQuery(value, config="english") for value in (title, text) if value]
+        query = queries[0]
+        for other in queries[1:]:
+            query = query | other
+        return self.get_indexing_queryset().filter(
+            search_vector=query
+        ).annotate(
+            # Real rank is cast to double so the value survives the cursor round trip
+            rank=Cast(SearchRank(F("search_vector"), query), FloatField())
+        )
+
+    def search_recent_posts(self, title: str = "", text: str = "") -> QuerySet[Blog]:
+        """
+        Degraded search used while the search backend is unavailable
+        icontains match over public posts of the last SEARCH_FALLBACK_RECENT_DAYS days, newest first
+        :param title: Text searched in title
+        :param text: Text searched in text
+        :return: QuerySet[Blog]
+        """
+        query = Q()
+        if title:
+            query |= Q(title__icontains=title)
+        if text:
+            query |= Q(text__icontains=text)
+        return self.get_indexing_queryset().filter(
+            query,
+            is_archived=False,
+            is_draft=False,
+            is_banned=False,
+            is_deleted=False,
+            created_at__gte=timezone.now() - timedelta(days=settings.SEARCH_FALLBACK_RECENT_DAYS),
+        ).order_by("-created_at", "-id")
+
     def get_public_posts(self) -> QuerySet[Blog]:
         """
         Returns queryset of post that is public to every viewer
@@ -160,12 +264,56 @@ class Blog(TimeStampedModel):
     # A worker will delete the deleted post from database that has been deleted and 15 days ago
     is_deleted = models.BooleanField(default=False)
     deleted_at = models.DateTimeField(blank=True, null=True)
+    # Weighted title (A) and text (B) vector, maintained by a database trigger
+    search_vector = SearchVectorField(null=True, editable=False)
 
     objects = BlogManager()
 
+    # Fields of `is_public`, author blog_count follows changes of visibility
+    VISIBILITY_FIELDS = ("is_archived", "is_draft", "is_banned", "is_deleted")
+
+    class Meta(TimeStampedModel.Meta):
+        indexes = [
+            GinIndex(fields=["search_vector"], name="blog_blog_search_vector"),
+        ]
+
     def __str__(self):
         return slugify(self.title)
 
+    def get_stored_public(self) -> bool:
+        """
+        Whether the stored row is public, the row is locked until the transaction ends
+        so concurrent saves of the blog count a change of visibility once
+        """
+        row = type(self)._base_manager.select_for_update().filter(pk=self.pk).values_list(
+            *self.VISIBILITY_FIELDS
+        ).first()
+        return row is not None and not any(row)
+
+    def save(self, *args, **kwargs):
+        """
+        Saves the blog and updates blog_count of the author in the same transaction
+        when the blog becomes public or stops being public
+        """
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and not set(update_fields) & set(self.VISIBILITY_FIELDS):
+            return super().save(*args, **kwargs)
+        is_public = self.is_public
+        with transaction.atomic():
+            # Visibility read when the blog was loaded may be stale, the stored row decides
+            was_public = self.pk is not None and self.get_stored_public()
+            super().save(*args, **kwargs)
+            if is_public != was_public:
+                get_user_model().objects.update_blog_count(self.author_id, 1 if is_public else -1)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            was_public = self.get_stored_public()
+            result = super().delete(*args, **kwargs)
+            if was_public:
+                get_user_model().objects.update_blog_count(self.author_id, -1)
+        return result
+
     @property
     def slug(self):
         """
@@ -256,7 +404,46 @@ class Blog(TimeStampedModel):
         Prepare tags list for elasticsearch document
         :return: list[str] List of tags
         """
-        return list(self.tags.values_list("tag", flat=True))
+        return [tag.tag for tag in self.tags.all()]
+
+    @property
+    def is_public(self) -> bool:
+        """
+        Same criteria as `BlogManager.get_public_posts`
+        """
+        return not (self.is_archived or self.is_draft or self.is_banned or self.is_deleted)
+
+    def prepare_title_suggest(self) -> dict[str, Any]:
+        """
+        Prepare completion suggester input for elasticsearch document
+        Every word suffix of the title is an input, so typing any word of the title matches it.
+        Popular posts are suggested first
+        :return: dict[str, Any] Completion input, weight and contexts
+        """
+        words = self.title.split()
+        return {
+            "input": [" ".join(words[i:]) for i in range(min(len(words), 10))],
+            "weight": min(self.view_count, 2 ** 31 - 1),
+            "contexts": {"visibility": ["public" if self.is_public else "hidden"]},
+        }
+
+
+class BlogImageManager(models.Manager):
+
+    def upload_images(self, blog_id: int, files: list[File], image_alts: list[str] = None) -> list[BlogImage]:
+        """
+        Stores the images concurrently and creates them in one query
+        :param blog_id: Id of the blog
+        :param files: Validated image files
+        :param image_alts: Alt text of each image
+        :return: list[BlogImage] In the order of files
+        """
+        image_alts = image_alts or []
+        urls = store_files([(file, file.content_type or "", file.name) for file in files])
+        return self.bulk_create([
+            BlogImage(blog_id=blog_id, image_url=url, image_alt=image_alts[index] if index < len(image_alts) else "")
+            for index, url in enumerate(urls)
+        ])
 
 
 class BlogImage(TimeStampedModel):
@@ -267,33 +454,21 @@ class BlogImage(TimeStampedModel):
     image_url = models.URLField()
     image_alt = models.CharField(max_length=128, blank=True, default="")
 
+    objects = BlogImageManager()
+
     def __str__(self):
         return str(self.blog_id)
 
-    def build_image_url(self, file_name: str) -> str:
-        """
-        Builds Image URL from file name for blog image
-        :param file_name: str | Name of the file uploaded
-        :return: str | Full unique filename
-        """
-        return f"{self.blog_id}-{uuid4()}{os.path.splitext(file_name)[1]}"
-
     def upload_image(self, validated_data: dict[str, File]):
         """
         Uploads image to cloud storage and retains url and stores in db
-        :param validated_data:
-        :return:
+        :param validated_data: Contains validated image data
+        :return: str | URL of the image
         """
-        file = validated_data["profile_picture"]
-        file_name = file.name
-        url = StorageService.upload_file(
-            file,
-            file_name=self.build_image_url(file_name),
-            content_type=mimetypes.guess_type(file_name)[0]
-        )
-        self.profile_picture_url = url
+        file = validated_data["image"]
+        self.image_url = store_file(file, file.content_type or "", file.name)
         self.save()
-        return url
+        return self.image_url
 
 
 class VoteChoice(models.TextChoices):
@@ -1,5 +1,7 @@
 from rest_framework import permissions
 
+from blog.models import Blog
+
 
 class PostPublicPermission(permissions.IsAuthenticatedOrReadOnly):
     message = 'Adding customers not allowed.'
@@ -12,3 +14,16 @@ class PostStrictPermission(permissions.IsAuthenticated):
 
     def has_object_permission(self, request, view, obj):
         return obj.author == request.user
+
+
+class BlogAuthorPermission(permissions.IsAuthenticatedOrReadOnly):
+    """
+    Only the author of the parent blog can change nested resources, the view provides `get_blog_id`
+    """
+
+    def has_permission(self, request, view):
+        if not super().has_permission(request, view):
+            return False
+        return request.method in permissions.SAFE_METHODS or Blog.objects.filter(
+            pk=view.get_blog_id(), author=request.user
+        ).exists()
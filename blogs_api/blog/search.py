@@ -1,10 +1,45 @@
-from dataclasses import dataclass
-from typing import Any, Type
+import hashlib
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Type
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q, QuerySet
+from django.utils.module_loading import import_string
 from django_elasticsearch_dsl import Document
 from django_elasticsearch_dsl.search import Search
-from rest_framework.exceptions import ValidationError
+from elasticsearch import ConnectionError, TransportError
+from elasticsearch_dsl.response import Response as SearchResponse
+from elasticsearch_dsl.utils import AttrDict
+from redis import RedisError
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound, ValidationError
 from rest_framework.request import Request
+from rest_framework.response import Response
+
+from lib import metrics
+from lib.cache import get_redis, make_key
+from lib.circuit_breaker import CircuitBreaker, CircuitOpen
+from lib.pagination import PositionCursorPagination
+
+logger = logging.getLogger(__name__)
+
+
+class SearchBackendError(Exception):
+    """
+    Raised by a search backend that is failing or whose circuit is open
+    """
+
+
+class SearchUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Search is temporarily unavailable, try again later."
+    default_code = "search_unavailable"
 
 
 @dataclass
@@ -18,14 +53,384 @@ class FilterField:
     is_required: bool = False
 
 
+@dataclass
+class SearchResult:
+    """
+    Page of search hits
+    hits: list | Documents in sort order
+    sort_values: list[list] | Sort values of each hit, used as search_after cursor
+    total: int | Number of matching documents
+    cursors: bool | Whether sort values can be used as cursors, the page has no next or previous link otherwise
+    """
+    hits: list = field(default_factory=list)
+    sort_values: list[list] = field(default_factory=list)
+    total: int = 0
+    cursors: bool = True
+
+
+class SearchAfterPagination(PositionCursorPagination):
+    """
+    Pages through search hits with search_after, only page_size + 1 hits are requested per page
+    """
+    total = 0
+    cursors = True
+
+    def fetch_page(self, queryset, size, position, reverse):
+        if position is not None and not self.view.search_backend.is_valid_position(position):
+            raise NotFound(self.invalid_cursor_message)
+        result = self.view.execute_search(queryset, size=size, search_after=position, reverse=reverse)
+        self.total = result.total
+        self.cursors = result.cursors
+        return result.hits, result.sort_values
+
+    def paginate_queryset(self, queryset, request, view=None):
+        items = super().paginate_queryset(queryset, request, view)
+        if not self.cursors:
+            self.next_position = self.previous_position = None
+        return items
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema["properties"]["count"] = {"type": "integer"}
+        return response_schema
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.total),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+
+class SearchCache:
+    """
+    Short lived redis cache of search result ids, totals and sort values.
+    Entries are keyed by the normalized query, concurrent misses of the same query
+    are coalesced so only one of them reaches the search backend.
+    Every entry is referenced from the ids it contains, so re-indexing a document only
+    drops the entries that contain it
+    """
+
+    def __init__(self, index_name: str):
+        self.index_name = index_name
+        self.redis = get_redis()
+
+    def get_key(self, query: dict[str, Any]) -> str:
+        digest = hashlib.sha1(json.dumps(query, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return make_key("search", "cache", self.index_name, digest)
+
+    @staticmethod
+    def get_ref_key(index_name: str, pk: int) -> str:
+        return make_key("search", "cache_refs", index_name, pk)
+
+    def get(self, key: str) -> dict | None:
+        value = self.redis.get(key)
+        return json.loads(value) if value is not None else None
+
+    def get_stale(self, query: dict[str, Any]) -> dict | None:
+        """
+        Last value of the query, kept for SEARCH_CACHE_STALE_TTL and never invalidated
+        Served only while the search backend is unavailable
+        """
+        try:
+            return self.get(f"{self.get_key(query)}:stale")
+        except RedisError:
+            logger.warning("Search cache unavailable", exc_info=True)
+            return None
+
+    def set(self, key: str, value: dict[str, Any]):
+        ttl = settings.SEARCH_CACHE_TTL
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.set(key, json.dumps(value), ex=ttl)
+        pipeline.set(f"{key}:stale", json.dumps(value), ex=settings.SEARCH_CACHE_STALE_TTL)
+        for pk in value["ids"]:
+            ref_key = self.get_ref_key(self.index_name, pk)
+            pipeline.sadd(ref_key, key)
+            pipeline.expire(ref_key, ttl)
+        pipeline.execute()
+
+    def get_or_execute(self, query: dict[str, Any], execute: Callable[[], dict[str, Any]]) -> dict[str, Any]:
+        """
+        Returns cached value of the query, on a miss only the caller holding the lock executes
+        the query, the others wait for its value.
+        Waiters stop waiting as soon as the lock is released without a value, EG: the holder failed
+        because the search backend is down, and execute the query themselves.
+        Redis errors are logged and the query is executed without the cache
+        :param query: Normalized query
+        :param execute: Runs the query and returns the value to cache
+        :return: dict
+        """
+        key = self.get_key(query)
+        lock_key = f"{key}:lock"
+        lock_timeout = settings.SEARCH_CACHE_LOCK_TIMEOUT
+        try:
+            value = self.get(key)
+            if value is not None:
+                return value
+            is_holder = self.redis.set(lock_key, 1, nx=True, ex=lock_timeout)
+        except RedisError:
+            logger.warning("Search cache unavailable", exc_info=True)
+            return execute()
+
+        if is_holder:
+            try:
+                value = execute()
+                try:
+                    self.set(key, value)
+                except RedisError:
+                    logger.warning("Could not cache search result", exc_info=True)
+                return value
+            finally:
+                try:
+                    self.redis.delete(lock_key)
+                except RedisError:
+                    logger.warning("Could not release search cache lock", exc_info=True)
+
+        deadline = time.monotonic() + lock_timeout
+        try:
+            while time.monotonic() < deadline:
+                time.sleep(0.02)
+                # The holder caches the value before releasing the lock, both are read atomically
+                pipeline = self.redis.pipeline(transaction=True)
+                pipeline.get(key)
+                pipeline.exists(lock_key)
+                value, is_locked = pipeline.execute()
+                if value is not None:
+                    return json.loads(value)
+                if not is_locked:
+                    break
+        except RedisError:
+            logger.warning("Search cache unavailable", exc_info=True)
+        # Lock holder failed or is too slow, do not wait any longer
+        return execute()
+
+    @classmethod
+    def invalidate(cls, index_name: str, ids: Iterable[int]):
+        """
+        Drops cached results containing any of the ids
+        :param index_name: Name of the index
+        :param ids: Document ids
+        """
+        redis = get_redis()
+        ref_keys = [cls.get_ref_key(index_name, pk) for pk in ids]
+        if not ref_keys:
+            return
+        pipeline = redis.pipeline(transaction=False)
+        for ref_key in ref_keys:
+            pipeline.smembers(ref_key)
+        keys = set().union(*pipeline.execute())
+        redis.delete(*keys, *ref_keys)
+
+
+class SearchBackend(ABC):
+    """
+    Base search backend, runs the search of a `SearchViewSetMixin` view
+    position_types: Types of the sort values of a hit, checked before a cursor is used as search_after
+    """
+    name: str = ""
+    # Relevance score and id
+    position_types: tuple[tuple[type, ...], ...] = ((int, float), (int,))
+
+    def __init__(self, view: "SearchViewSetMixin"):
+        self.view = view
+
+    @abstractmethod
+    def build(self) -> Any:
+        """
+        Query of the request filters, executed page by page by `execute`
+        """
+
+    @abstractmethod
+    def execute(self, query: Any, size: int, search_after: list = None, reverse: bool = False) -> SearchResult:
+        """
+        Fetch one page of hits
+        :param query: Query returned by `build`
+        :param size: Number of hits
+        :param search_after: Sort values of the hit before the page
+        :param reverse: Walk the sort order backwards
+        :return: SearchResult
+        """
+
+    def get_hit_id(self, hit: Any) -> int:
+        return int(hit["id"])
+
+    def is_valid_position(self, position: list) -> bool:
+        """
+        Whether the sort values of a cursor match the sort of the backend
+        """
+        return len(position) == len(self.position_types) and all(
+            isinstance(value, types) and not isinstance(value, bool)
+            for value, types in zip(position, self.position_types)
+        )
+
+    @abstractmethod
+    def suggest(self, prefix: str, size: int) -> list[dict[str, Any]]:
+        """
+        Typeahead suggestions of a prefix
+        :param prefix: Text typed so far
+        :param size: Number of suggestions
+        :return: list[dict] Fields of `view.suggest_source` of each suggestion
+        """
+
+    def hydrate(self, ids: list[int]) -> dict[int, AttrDict]:
+        """
+        Builds hits from the database, shaped like the indexed documents
+        :param ids: Document ids
+        :return: dict[int, AttrDict] Hits by id
+        """
+        return {
+            pk: self.view.prepare_hit(instance)
+            for pk, instance in self.view.get_hit_queryset().in_bulk(ids).items()
+        }
+
+
+class ElasticsearchBackend(SearchBackend):
+    """
+    Searches the view's document index
+    """
+    name = "elasticsearch"
+    # Relevance first, id keeps the order stable between hits with equal score
+    sort: tuple[tuple[str, str], ...] = (("_score", "desc"), ("id", "asc"))
+
+    def __init__(self, view: "SearchViewSetMixin"):
+        super().__init__(view)
+        self.breaker = CircuitBreaker(self.name, is_failure=self.is_failure)
+
+    @staticmethod
+    def is_failure(exc: Exception) -> bool:
+        """
+        Unreachable cluster, timeouts, server errors and rejections count against the circuit,
+        bad requests do not say anything about the health of the cluster
+        """
+        if isinstance(exc, ConnectionError):
+            return True
+        return isinstance(exc, TransportError) and isinstance(exc.status_code, int) and (
+                exc.status_code >= 500 or exc.status_code == 429
+        )
+
+    def run(self, search: Search) -> SearchResponse:
+        """
+        Executes the search through the circuit breaker, with a client side timeout for the
+        whole request and a server side timeout after which shards return what they have
+        :raises SearchBackendError: When the circuit is open or the cluster fails
+        """
+        search = search.params(request_timeout=settings.SEARCH_REQUEST_TIMEOUT).extra(
+            timeout=settings.SEARCH_SERVER_TIMEOUT
+        )
+        start = time.perf_counter()
+        try:
+            response = self.breaker.call(search.execute)
+        except CircuitOpen as exc:
+            raise SearchBackendError(f"Circuit of '{self.name}' is open") from exc
+        except TransportError as exc:
+            metrics.observe("search.latency", time.perf_counter() - start, backend=self.name)
+            if not self.is_failure(exc):
+                raise
+            metrics.incr("search.errors", backend=self.name)
+            raise SearchBackendError(str(exc)) from exc
+        metrics.observe("search.latency", time.perf_counter() - start, backend=self.name)
+        if response.timed_out:
+            metrics.incr("search.timed_out", backend=self.name)
+        return response
+
+    def build(self) -> Search:
+        return self.view.document_class.search().query(
+            self.view.generate_q_clause()
+        )
+
+    def get_sort(self, reverse: bool = False) -> list[dict[str, dict[str, str]]]:
+        flip = {"asc": "desc", "desc": "asc"}
+        return [
+            {name: {"order": flip[order] if reverse else order}}
+            for name, order in self.sort
+        ]
+
+    def execute(self, query: Search, size: int, search_after: list = None, reverse: bool = False) -> SearchResult:
+        search = query.sort(*self.get_sort(reverse)).extra(size=size)
+        if search_after:
+            search = search.extra(search_after=search_after)
+        response = self.run(search)
+        return SearchResult(
+            hits=list(response),
+            sort_values=[list(hit.meta.sort) for hit in response],
+            total=response.hits.total.value
+        )
+
+    def get_hit_id(self, hit: Any) -> int:
+        return int(hit.meta.id)
+
+    def suggest(self, prefix: str, size: int) -> list[dict[str, Any]]:
+        """
+        Completion suggester answers from its in-memory FST, it only matches from the start of
+        an indexed input. When it finds nothing the edge n-gram fallback query matches words anywhere
+        """
+        view = self.view
+        clause = view.generate_suggest_clause()
+        if clause is None:
+            return []
+        search = view.document_class.search().source(view.suggest_source).extra(size=0)
+        search = search.suggest("suggestions", prefix, completion={**clause, "size": size})
+        options = self.run(search).suggest.suggestions[0].options
+        if options:
+            return [option["_source"].to_dict() for option in options]
+        fallback = view.generate_suggest_fallback_q_clause(prefix)
+        if fallback is None:
+            return []
+        response = self.run(view.document_class.search().source(view.suggest_source).query(fallback).extra(size=size))
+        return [hit.to_dict() for hit in response]
+
+
+class PostgresBackend(SearchBackend):
+    """
+    Searches the database with the view's `generate_search_queryset`,
+    which must annotate a float `rank`. Pages are fetched with a (rank, id) keyset
+    """
+    name = "postgres"
+
+    def build(self) -> QuerySet:
+        queryset = self.view.generate_search_queryset()
+        if queryset is None:
+            raise ImproperlyConfigured(f"{type(self.view).__name__} has no database search")
+        return queryset
+
+    def execute(self, query: QuerySet, size: int, search_after: list = None, reverse: bool = False) -> SearchResult:
+        queryset = query
+        if search_after:
+            rank, pk = search_after
+            if reverse:
+                queryset = queryset.filter(Q(rank__gt=rank) | Q(rank=rank, id__lt=pk))
+            else:
+                queryset = queryset.filter(Q(rank__lt=rank) | Q(rank=rank, id__gt=pk))
+        ordering = ("rank", "-id") if reverse else ("-rank", "id")
+        instances = list(queryset.order_by(*ordering)[:size])
+        return SearchResult(
+            hits=[self.view.prepare_hit(instance) for instance in instances],
+            sort_values=[[instance.rank, instance.id] for instance in instances],
+            total=query.count()
+        )
+
+    def suggest(self, prefix: str, size: int) -> list[dict[str, Any]]:
+        queryset = self.view.generate_suggest_queryset(prefix)
+        if queryset is None:
+            return []
+        return list(queryset.values(*self.view.suggest_source)[:size])
+
+
 class SearchViewSetMixin:
     """
-    Elasticsearch mixin
+    Search mixin, the backend is selected per viewset with settings.SEARCH_BACKENDS
+    Elasticsearch backend uses `document_class` and `generate_q_clause`,
+    postgres backend uses `generate_search_queryset`.
+    Suggestions use `generate_suggest_clause` and `generate_suggest_fallback_q_clause` on elasticsearch,
+    `generate_suggest_queryset` on postgres
     """
     filter_params: list[FilterField] = list()
+    suggest_source: list[str] = ["id"]
     kwargs: dict
     document_class: Type[Document]
     request: Request
+    search_pagination_class = SearchAfterPagination
 
     def validate_filter(self, filter_data: dict[str, Any]):
         pass
@@ -38,12 +443,20 @@ class SearchViewSetMixin:
         ret = {}
         for field in self.filter_params:
             if field.field_name in self.request.GET:
-                ret[field.field_name] = self.request.GET[field.field_name]
+                ret[field.field_name] = self.normalize_filter_value(self.request.GET[field.field_name])
             elif field.is_required:
                 raise ValidationError(f"'{field.field_name}' missing in query")
         self.validate_filter(ret)
         return ret
 
+    @staticmethod
+    def normalize_filter_value(value: str) -> str:
+        """
+        Lower case and collapse whitespace, analyzers do the same,
+        so equal queries share one cache entry
+        """
+        return " ".join(value.split()).lower()
+
     @property
     def filter_kwargs(self):
         return self.get_filter_kwargs()
@@ -51,9 +464,155 @@ class SearchViewSetMixin:
     def generate_q_clause(self):
         return
 
-    def es_search(self):
-        max_count = self.filter_kwargs.pop("max_count", 1000)
-        search: Search = self.document_class.search().extra(size=max_count).query(
-            self.generate_q_clause()
+    def generate_search_queryset(self) -> QuerySet | None:
+        """
+        Search of the postgres backend, annotated with a float `rank`, None when the view has none
+        """
+        return
+
+    def generate_suggest_clause(self) -> dict[str, Any] | None:
+        """
+        Completion suggester options, EG: field and contexts, None when the view has no suggestions
+        """
+        return
+
+    def generate_suggest_fallback_q_clause(self, prefix: str):
+        return
+
+    def generate_suggest_queryset(self, prefix: str) -> QuerySet | None:
+        """
+        Suggestions of the postgres backend, None when the view has no suggestions
+        """
+        return
+
+    def generate_fallback_queryset(self) -> QuerySet | None:
+        """
+        Cheap database query served while the search backend is unavailable, None disables it
+        """
+        return
+
+    def get_hit_queryset(self) -> QuerySet:
+        """
+        Queryset hits are built from
+        """
+        return self.document_class().get_queryset()
+
+    def prepare_hit(self, instance) -> AttrDict:
+        """
+        Hit of a database row, shaped like the indexed document
+        """
+        return AttrDict(self.document_class().prepare(instance))
+
+    @property
+    def search_backend(self) -> SearchBackend:
+        if not hasattr(self, "_search_backend"):
+            backends = settings.SEARCH_BACKENDS
+            path = backends.get(self.__class__.__name__, backends["default"])
+            self._search_backend = import_string(path)(self)
+        return self._search_backend
+
+    @property
+    def search_paginator(self) -> SearchAfterPagination:
+        if not hasattr(self, "_search_paginator"):
+            self._search_paginator = self.search_pagination_class()
+        return self._search_paginator
+
+    def get_search(self) -> Any:
+        """
+        Search of the request filters, executed page by page by `search_paginator`
+        """
+        return self.search_backend.build()
+
+    def get_suggestions(self, prefix: str, size: int) -> list[dict[str, Any]]:
+        prefix = self.normalize_filter_value(prefix)
+        try:
+            return self.search_backend.suggest(prefix, size)
+        except SearchBackendError:
+            if "database" not in settings.SEARCH_FALLBACKS:
+                metrics.incr("search.fallback", kind="unavailable")
+                raise SearchUnavailable()
+            metrics.incr("search.fallback", kind="database")
+            return PostgresBackend(self).suggest(prefix, size)
+
+    def execute_search(self, query: Any, size: int, search_after: list = None,
+                       reverse: bool = False) -> SearchResult:
+        """
+        Fetch one page of hits through the search cache
+        Hits of a cached page are loaded from the database by id,
+        a failing backend is replaced by the fallbacks of `search_fallback`
+        :param query: Query returned by `get_search`
+        :param size: Number of hits
+        :param search_after: Sort values of the hit before the page
+        :param reverse: Walk the sort order backwards
+        :return: SearchResult
+        """
+        backend = self.search_backend
+        executed = []
+
+        def execute() -> dict[str, Any]:
+            result = backend.execute(query, size, search_after, reverse)
+            executed.append(result)
+            return {
+                "ids": [backend.get_hit_id(hit) for hit in result.hits],
+                "sort_values": result.sort_values,
+                "total": result.total,
+            }
+
+        cache = SearchCache(self.document_class._index._name)
+        cache_query = {
+            "backend": backend.name,
+            "filters": self.filter_kwargs,
+            "size": size,
+            "search_after": search_after,
+            "reverse": reverse,
+        }
+        try:
+            value = cache.get_or_execute(cache_query, execute)
+        except SearchBackendError:
+            return self.search_fallback(cache, cache_query, size, search_after)
+        if executed:
+            return executed[0]
+        return self.hydrate_cached(value)
+
+    def hydrate_cached(self, value: dict[str, Any]) -> SearchResult:
+        """
+        Loads hits of a cached page from the database by id
+        """
+        hits = self.search_backend.hydrate(value["ids"])
+        return SearchResult(
+            hits=[hits[pk] for pk in value["ids"] if pk in hits],
+            sort_values=[sort for pk, sort in zip(value["ids"], value["sort_values"]) if pk in hits],
+            total=value["total"]
         )
-        return search.execute()
+
+    def search_fallback(self, cache: SearchCache, cache_query: dict[str, Any], size: int,
+                        search_after: list = None) -> SearchResult:
+        """
+        Degraded result while the search backend is unavailable,
+        fallbacks of settings.SEARCH_FALLBACKS are tried in order
+        cache: Stale cached page of the same query
+        database: First page of `generate_fallback_queryset`, without cursors
+        :raises SearchUnavailable: When no fallback has a result
+        """
+        for fallback in settings.SEARCH_FALLBACKS:
+            if fallback == "cache":
+                value = cache.get_stale(cache_query)
+                if value is not None:
+                    metrics.incr("search.fallback", kind="cache")
+                    return self.hydrate_cached(value)
+            elif fallback == "database" and not search_after:
+                queryset = self.generate_fallback_queryset()
+                if queryset is None:
+                    continue
+                metrics.incr("search.fallback", kind="database")
+                instances = list(queryset[:size])
+                # Positions of database rows mean nothing to the search backend
+                return SearchResult(
+                    hits=[self.prepare_hit(instance) for instance in instances],
+                    sort_values=[[] for _ in instances],
+                    # The paginator asks for one hit more than a page to tell if there is another one
+                    total=min(len(instances), size - 1),
+                    cursors=False
+                )
+        metrics.incr("search.fallback", kind="unavailable")
+        raise SearchUnavailable()
@@ -1,9 +1,10 @@
+from django.conf import settings
 from rest_framework import serializers
 from rest_framework.generics import get_object_or_404
 
-from blog.models import Tag, Blog, Comment, Vote, UniqueVisitor
+from blog.models import Tag, Blog, BlogImage, Comment, Vote, UniqueVisitor
 from account.serializers import UserPublicBaseSerializer
-from lib.serializers import RequestUserCreateMixin
+from lib.serializers import RequestUserCreateMixin, DirectUploadConfirmSerializer
 
 
 class TagSerializer(serializers.ModelSerializer):
@@ -33,7 +34,7 @@ class BlogSerializer(RequestUserCreateMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Blog
-        fields = "__all__"
+        exclude = ["search_vector"]
         user_key = "author"
         read_only_fields = [
             "id",
@@ -47,6 +48,14 @@ class BlogSearchSerializer(BlogSerializer):
     tags = serializers.ListField(read_only=True)
 
 
+class BlogSuggestionSerializer(serializers.Serializer):
+    """
+    Typeahead suggestion of a blog
+    """
+    id = serializers.IntegerField(read_only=True)
+    title = serializers.CharField(read_only=True)
+
+
 class CommentSerializer(RequestUserCreateMixin, serializers.ModelSerializer, ):
     """
     Responsible for creating comments and presenting them
@@ -81,3 +90,58 @@ class UniqueVisitorSerializer(RequestUserCreateMixin, serializers.ModelSerialize
         model = UniqueVisitor
         user_key = "author"
         fields = "__all__"
+
+
+class BlogImageSerializer(serializers.ModelSerializer):
+    """
+    Presents blog images, images are added through direct uploads
+    """
+
+    class Meta:
+        model = BlogImage
+        fields = ["id", "blog", "image_url", "image_alt", "created_at"]
+        read_only_fields = ["id", "blog", "image_url", "created_at"]
+
+
+class BlogImageConfirmSerializer(DirectUploadConfirmSerializer):
+    """
+    Confirms a blog image uploaded through a presigned upload and creates it
+    """
+    image_alt = serializers.CharField(max_length=128, required=False, default="")
+
+    def create(self, validated_data):
+        return BlogImage.objects.create(
+            blog_id=self.context["blog_id"],
+            image_url=validated_data["url"],
+            image_alt=validated_data["image_alt"]
+        )
+
+
+class BlogImageUploadSerializer(serializers.Serializer):
+    """
+    Uploads many images in one multipart request, images are stored concurrently
+    """
+    images = serializers.ListField(
+        child=serializers.ImageField(), allow_empty=False, max_length=settings.BLOG_IMAGE_UPLOAD_MAX_FILES,
+        write_only=True
+    )
+    image_alt = serializers.ListField(
+        child=serializers.CharField(max_length=128, allow_blank=True), required=False, write_only=True
+    )
+
+    def validate_images(self, value):
+        for image in value:
+            if image.size > settings.IMAGE_UPLOAD_MAX_SIZE:
+                raise serializers.ValidationError(
+                    f"'{image.name}' must be smaller than {settings.IMAGE_UPLOAD_MAX_SIZE // 2 ** 20}MB"
+                )
+        if sum(image.size for image in value) > settings.BLOG_IMAGE_UPLOAD_MAX_TOTAL_SIZE:
+            raise serializers.ValidationError(
+                f"Images must be smaller than {settings.BLOG_IMAGE_UPLOAD_MAX_TOTAL_SIZE // 2 ** 20}MB in total"
+            )
+        return value
+
+    def create(self, validated_data):
+        return BlogImage.objects.upload_images(
+            self.context["blog_id"], validated_data["images"], validated_data.get("image_alt")
+        )
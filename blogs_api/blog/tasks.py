@@ -0,0 +1,24 @@
+from django.conf import settings
+from elasticsearch import TransportError
+from elasticsearch.helpers import BulkIndexError
+
+from blogs_api.celery import app
+from blog.indexing import flush_dirty_documents
+
+
+@app.task(bind=True, ignore_result=True, max_retries=settings.SEARCH_INDEX_MAX_RETRIES)
+def flush_search_index(self):
+    """
+    Indexes documents marked dirty by `blog.indexing.DirtyQueueSignalProcessor`.
+    Re-schedules itself while a backlog remains, and backs off exponentially
+    when elasticsearch rejects or fails the bulk request
+    """
+    try:
+        remaining = flush_dirty_documents()
+    except (TransportError, BulkIndexError) as exc:
+        raise self.retry(exc=exc, countdown=settings.SEARCH_INDEX_DEBOUNCE_SECONDS * 2 ** self.request.retries)
+    if remaining is None:
+        # Another flush is draining the queue, check again once it should be done
+        self.apply_async(countdown=settings.SEARCH_INDEX_DEBOUNCE_SECONDS)
+    elif remaining:
+        self.apply_async(countdown=1)
@@ -1,3 +1,212 @@
-from django.test import TestCase
+import io
+import json
+import threading
+import time
+from base64 import urlsafe_b64encode
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from PIL import Image
+from redis import RedisError
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from blog.indexing import get_refresh_interval
+from blog.search import (
+    PostgresBackend,
+    SearchBackend,
+    SearchAfterPagination,
+    SearchCache,
+    SearchResult,
+    SearchViewSetMixin,
+)
+from blog.serializers import BlogImageUploadSerializer
+
+
+@override_settings(SEARCH_CACHE_LOCK_TIMEOUT=2)
+class SearchCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch("blog.search.get_redis", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = SearchCache("blogs")
+        self.value = {"ids": [1], "sort_values": [[1]], "total": 1}
+
+    def run_holder(self, execute) -> threading.Thread:
+        """
+        Runs the query in another thread and returns once it holds the lock
+        """
+        holder = threading.Thread(target=self.cache.get_or_execute, args=({"q": "django"}, execute))
+        holder.start()
+        while not self.redis.exists(f"{self.cache.get_key({'q': 'django'})}:lock"):
+            time.sleep(0.001)
+        return holder
+
+    def test_waiter_gets_value_of_lock_holder(self):
+        def slow():
+            time.sleep(0.1)
+            return self.value
+
+        holder = self.run_holder(slow)
+        execute = mock.Mock()
+        self.assertEqual(self.cache.get_or_execute({"q": "django"}, execute), self.value)
+        execute.assert_not_called()
+        holder.join()
+
+    def test_waiter_stops_waiting_when_holder_fails(self):
+        def failing():
+            time.sleep(0.1)
+            raise RuntimeError("Search backend down")
+
+        with mock.patch("threading.excepthook"):
+            holder = self.run_holder(failing)
+            started = time.monotonic()
+            self.assertEqual(self.cache.get_or_execute({"q": "django"}, lambda: self.value), self.value)
+            self.assertLess(time.monotonic() - started, 1)
+            holder.join()
+
+    def test_redis_errors_fall_through_to_execute(self):
+        self.cache.redis = mock.Mock(**{"get.side_effect": RedisError("Connection refused")})
+        with self.assertLogs("blog.search", "WARNING"):
+            self.assertEqual(self.cache.get_or_execute({"q": "django"}, lambda: self.value), self.value)
+
+
+def encode_cursor(position: list) -> str:
+    return urlsafe_b64encode(json.dumps({"p": position}).encode("utf-8")).decode("ascii")
+
+
+class SearchAfterPaginationTestCase(SimpleTestCase):
+
+    def paginate(self, result: SearchResult, page_size: int, cursor: str = None) -> SearchAfterPagination:
+        view = mock.Mock(**{"execute_search.return_value": result})
+        view.search_backend = PostgresBackend(view)
+        params = {"page_size": page_size, **({"cursor": cursor} if cursor else {})}
+        request = Request(APIRequestFactory().get("/search/", params))
+        paginator = SearchAfterPagination()
+        paginator.paginate_queryset(None, request, view)
+        if not cursor:
+            view.execute_search.assert_called_once_with(None, size=page_size + 1, search_after=None, reverse=False)
+        return paginator
+
+    def test_full_page_has_next_link(self):
+        result = SearchResult(hits=[1, 2, 3], sort_values=[[1], [2], [3]], total=10)
+        paginator = self.paginate(result, 2)
+        self.assertEqual(paginator.page, [1, 2])
+        self.assertIsNotNone(paginator.get_next_link())
+
+    def test_cursor_of_the_backend_sort_is_accepted(self):
+        result = SearchResult(hits=[1, 2, 3], sort_values=[[1], [2], [3]], total=10)
+        for position in ([0.5, 3], [2, 3]):
+            with self.subTest(position=position):
+                cursor = encode_cursor(position)
+                self.assertEqual(self.paginate(result, 2, cursor).page, [1, 2])
+
+    def test_crafted_cursor_is_not_found(self):
+        result = SearchResult(hits=[1], sort_values=[[1]], total=1)
+        for position in ([], [0.5], [0.5, 3, 1], ["x", 3], [0.5, "3"], [0.5, 3.5], [0.5, True], [None, 3]):
+            with self.subTest(position=position):
+                cursor = encode_cursor(position)
+                with self.assertRaises(NotFound):
+                    self.paginate(result, 2, cursor)
+
+    def test_result_without_cursors_has_no_links(self):
+        for page_size in (1, 2):
+            with self.subTest(page_size=page_size):
+                result = SearchResult(hits=[1, 2, 3][:page_size + 1], sort_values=[[]] * (page_size + 1),
+                                      total=page_size + 1, cursors=False)
+                paginator = self.paginate(result, page_size)
+                self.assertEqual(paginator.page, [1, 2][:page_size])
+                self.assertIsNone(paginator.get_next_link())
+                self.assertIsNone(paginator.get_previous_link())
+
+
+class RefreshIntervalTestCase(SimpleTestCase):
+
+    def get_document(self, exists: bool, live_settings: dict) -> mock.Mock:
+        client = mock.Mock()
+        client.indices.exists.return_value = exists
+        client.indices.get_settings.return_value = {"blogs-20240101000000": {"settings": live_settings}}
+        document = mock.Mock(**{"_get_connection.return_value": client})
+        document._index._name = "blogs"
+        document._index._settings = {"number_of_shards": 1, "refresh_interval": "5s"}
+        return document
+
+    def test_interval_of_the_live_index(self):
+        document = self.get_document(True, {"index": {"refresh_interval": "30s"}})
+        self.assertEqual(get_refresh_interval(document), "30s")
+
+    def test_default_interval_of_the_live_index(self):
+        self.assertIsNone(get_refresh_interval(self.get_document(True, {})))
+
+    def test_interval_of_the_document_without_an_index(self):
+        self.assertEqual(get_refresh_interval(self.get_document(False, {})), "5s")
+
+
+@override_settings(SEARCH_FALLBACKS=["database"])
+class DatabaseFallbackTestCase(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch("lib.metrics.get_redis", return_value=fakeredis.FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.view = SearchViewSetMixin()
+        self.view.prepare_hit = lambda instance: instance
+
+    def fallback(self, rows: int, size: int) -> SearchResult:
+        self.view.generate_fallback_queryset = lambda: list(range(rows))
+        return self.view.search_fallback(mock.Mock(), {}, size)
+
+    def test_count_leaves_out_the_probe_row(self):
+        for rows, total in ((10, 2), (3, 2), (2, 2), (1, 1), (0, 0)):
+            with self.subTest(rows=rows):
+                result = self.fallback(rows, size=3)
+                self.assertEqual(result.hits, list(range(min(rows, 3))))
+                self.assertEqual(result.total, total)
+                self.assertFalse(result.cursors)
+
+
+class SearchHooksTestCase(SimpleTestCase):
+
+    def test_backend_without_required_methods_cannot_be_created(self):
+        class IncompleteBackend(SearchBackend):
+            def build(self):
+                return None
+
+        with self.assertRaises(TypeError):
+            IncompleteBackend(SearchViewSetMixin())
+
+    def test_view_without_suggestions_suggests_nothing(self):
+        self.assertEqual(PostgresBackend(SearchViewSetMixin()).suggest("dja", 5), [])
+
+
+def make_image(name: str) -> SimpleUploadedFile:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64)).save(buffer, "PNG")
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type="image/png")
+
+
+class BlogImageUploadSerializerTestCase(SimpleTestCase):
+
+    def validate(self, count: int) -> BlogImageUploadSerializer:
+        serializer = BlogImageUploadSerializer(data={"images": [make_image(f"{i}.png") for i in range(count)]})
+        serializer.is_valid()
+        return serializer
+
+    def test_images_within_the_limits_are_valid(self):
+        self.assertEqual(self.validate(2).errors, {})
+
+    def test_image_over_the_image_limit_is_rejected(self):
+        size = make_image("0.png").size
+        with override_settings(IMAGE_UPLOAD_MAX_SIZE=size - 1):
+            self.assertIn("images", self.validate(1).errors)
+
+    def test_images_over_the_total_limit_are_rejected(self):
+        size = make_image("0.png").size
+        with override_settings(BLOG_IMAGE_UPLOAD_MAX_TOTAL_SIZE=size * 2):
+            self.assertEqual(self.validate(2).errors, {})
+            self.assertIn("in total", str(self.validate(3).errors["images"]))
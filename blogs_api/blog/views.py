@@ -6,19 +6,24 @@ from drf_yasg.openapi import Parameter, IN_QUERY
 from drf_yasg.utils import swagger_auto_schema
 from elasticsearch_dsl import Q as EsQ
 from rest_framework.decorators import action
-from rest_framework import viewsets
-from rest_framework.exceptions import ValidationError
+from rest_framework import status, viewsets
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
 from rest_framework_extensions.mixins import NestedViewSetMixin
 from rest_framework.permissions import AllowAny, IsAuthenticated
 
 from blog.documents import TagDocument, BlogDocument
-from blog.models import Blog, Comment, Vote, Tag, UniqueVisitor
-from blog.permissions import PostPublicPermission
+from blog.models import Blog, BlogImage, Comment, Vote, Tag, UniqueVisitor
+from blog.permissions import PostPublicPermission, BlogAuthorPermission
 from blog.search import SearchViewSetMixin, FilterField
 from blog.serializers import BlogSerializer, CommentSerializer, VoteSerializer, TagSerializer, UniqueVisitorSerializer, \
-    BlogSearchSerializer
+    BlogSearchSerializer, BlogSuggestionSerializer, BlogImageSerializer, BlogImageConfirmSerializer, BlogImageUploadSerializer
+from lib.backends import StorageService
+from lib.pagination import KeysetPagination
+from lib.routers import compose_parent_pk_kwarg_name
+from lib.serializers import DirectUploadSerializer
+from lib.throttling import WriteRateThrottle
 from lib.views import list_api, retrieve_api
 
 
@@ -43,6 +48,12 @@ class TagViewSet(viewsets.GenericViewSet,
     def generate_q_clause(self):
         return EsQ("match_phrase_prefix", tag=self.filter_kwargs["tag"])
 
+    def generate_search_queryset(self) -> QuerySet[Tag]:
+        return Tag.objects.search_tags(self.filter_kwargs["tag"])
+
+    def generate_fallback_queryset(self) -> QuerySet[Tag]:
+        return Tag.objects.get_active_tags().filter(tag__istartswith=self.filter_kwargs["tag"])
+
     @swagger_auto_schema(methods=['get'],
                          manual_parameters=[
                              Parameter('tag', IN_QUERY, type='str'),
@@ -56,9 +67,9 @@ class TagViewSet(viewsets.GenericViewSet,
         return list_api(
             request,
             self,
-            queryset=self.es_search(),
+            queryset=self.get_search(),
             serializer=self.get_serializer,
-            paginator=self.paginator
+            paginator=self.search_paginator
         )
 
 
@@ -79,6 +90,8 @@ class BlogsViewSet(viewsets.ModelViewSet, SearchViewSetMixin):
         FilterField("title"),
         FilterField("text"),
     )
+    suggest_source = ["id", "title"]
+    max_suggestions = 20
 
     def validate_filter(self, filter_data: dict[str, Any]):
         """
@@ -99,6 +112,42 @@ class BlogsViewSet(viewsets.ModelViewSet, SearchViewSetMixin):
             should_clause.append(EsQ("match", text=text))
         return EsQ("bool", should=should_clause)
 
+    def generate_search_queryset(self) -> QuerySet[Blog]:
+        filter_kwargs = self.filter_kwargs
+        return Blog.objects.full_text_search(
+            title=filter_kwargs.get("title", ""),
+            text=filter_kwargs.get("text", "")
+        )
+
+    def generate_fallback_queryset(self) -> QuerySet[Blog]:
+        filter_kwargs = self.filter_kwargs
+        return Blog.objects.search_recent_posts(
+            title=filter_kwargs.get("title", ""),
+            text=filter_kwargs.get("text", "")
+        )
+
+    def generate_suggest_clause(self) -> dict[str, Any]:
+        return {
+            "field": "title_suggest",
+            "skip_duplicates": True,
+            "contexts": {"visibility": ["public"]},
+        }
+
+    def generate_suggest_fallback_q_clause(self, prefix: str):
+        return EsQ(
+            "bool",
+            must=[EsQ("match", **{"title.edge": {"query": prefix, "operator": "and"}})],
+            filter=[
+                EsQ("term", is_archived=False),
+                EsQ("term", is_draft=False),
+                EsQ("term", is_banned=False),
+                EsQ("term", is_deleted=False),
+            ]
+        )
+
+    def generate_suggest_queryset(self, prefix: str) -> QuerySet[Blog]:
+        return Blog.objects.get_public_posts().filter(title__istartswith=prefix).order_by("-view_count", "id")
+
     def get_object(self):
         queryset = self.queryset
         # Perform the lookup filtering.
@@ -166,11 +215,33 @@ class BlogsViewSet(viewsets.ModelViewSet, SearchViewSetMixin):
         return list_api(
             request,
             self,
-            queryset=self.es_search(),
+            queryset=self.get_search(),
             serializer=BlogSearchSerializer,
-            paginator=self.paginator
+            paginator=self.search_paginator
         )
 
+    @swagger_auto_schema(methods=['get'],
+                         manual_parameters=[
+                             Parameter('q', IN_QUERY, type='str', required=True),
+                             Parameter('size', IN_QUERY, type='int'),
+                         ],
+                         responses={200: BlogSuggestionSerializer(many=True)}
+                         )
+    @action(methods=["get"], detail=False, permission_classes=[AllowAny])
+    def suggest(self, request, *args, **kwargs):
+        """
+        Typeahead suggestions of blog titles
+        """
+        prefix = request.GET.get("q", "")
+        if not prefix.strip():
+            raise ValidationError("'q' missing in query")
+        try:
+            size = min(max(int(request.GET.get("size", 5)), 1), self.max_suggestions)
+        except ValueError:
+            raise ValidationError("'size' must be an integer")
+        serializer = BlogSuggestionSerializer(self.get_suggestions(prefix, size), many=True)
+        return Response(serializer.data)
+
 
 class CommentViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
     """
@@ -182,6 +253,8 @@ class CommentViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
     """
     queryset = Comment.objects.all()
     permission_classes = [PostPublicPermission]
+    throttle_classes = [WriteRateThrottle]
+    throttle_scope = "comments"
     serializer_class = CommentSerializer
     pagination_class = CursorPagination
 
@@ -199,6 +272,8 @@ class VoteViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
     """
     queryset = Vote.objects.all()
     permission_classes = [PostPublicPermission]
+    throttle_classes = [WriteRateThrottle]
+    throttle_scope = "votes"
     serializer_class = VoteSerializer
     pagination_class = CursorPagination
 
@@ -224,3 +299,59 @@ class UniqueVisitorViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
         :return: QuerySet[Vote]
         """
         return self.queryset.order_by("-created_at")
+
+
+class BlogImageViewSet(NestedViewSetMixin,
+                       viewsets.GenericViewSet,
+                       viewsets.mixins.ListModelMixin,
+                       viewsets.mixins.RetrieveModelMixin,
+                       viewsets.mixins.UpdateModelMixin,
+                       viewsets.mixins.DestroyModelMixin):
+    """
+    Blog Image ViewSet
+    post: Uploads many images in one multipart request
+    Images can also be uploaded straight to Cloud Storage: upload_url issues a presigned upload,
+    confirm checks the uploaded file and adds it to the blog
+    """
+    queryset = BlogImage.objects.all()
+    permission_classes = [BlogAuthorPermission]
+    serializer_class = BlogImageSerializer
+    pagination_class = KeysetPagination
+
+    def get_blog_id(self) -> int:
+        blog_id = self.kwargs[compose_parent_pk_kwarg_name("blog")]
+        if not blog_id.isdigit():
+            raise NotFound()
+        return int(blog_id)
+
+    def get_queryset(self) -> QuerySet[BlogImage]:
+        return self.queryset.filter(blog_id=self.get_blog_id())
+
+    @swagger_auto_schema(request_body=BlogImageUploadSerializer, responses={201: BlogImageSerializer(many=True)})
+    def create(self, request, *args, **kwargs):
+        serializer = BlogImageUploadSerializer(data=request.data, context={"blog_id": self.get_blog_id()})
+        serializer.is_valid(raise_exception=True)
+        images = serializer.save()
+        return Response(BlogImageSerializer(images, many=True).data, status=status.HTTP_201_CREATED)
+
+    def get_key_prefix(self) -> str:
+        return StorageService.get_upload_prefix("blogs", self.get_blog_id())
+
+    @swagger_auto_schema(methods=['post'], request_body=DirectUploadSerializer)
+    @action(methods=["post"], detail=False)
+    def upload_url(self, request, *args, **kwargs):
+        serializer = DirectUploadSerializer(data=request.data, context={"key_prefix": self.get_key_prefix()})
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.save(), status=status.HTTP_201_CREATED)
+
+    @swagger_auto_schema(methods=['post'], request_body=BlogImageConfirmSerializer,
+                         responses={201: BlogImageSerializer})
+    @action(methods=["post"], detail=False)
+    def confirm(self, request, *args, **kwargs):
+        serializer = BlogImageConfirmSerializer(
+            data=request.data,
+            context={"key_prefix": self.get_key_prefix(), "blog_id": self.get_blog_id()}
+        )
+        serializer.is_valid(raise_exception=True)
+        image = serializer.save()
+        return Response(BlogImageSerializer(image).data, status=status.HTTP_201_CREATED)
@@ -38,6 +38,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     "rest_framework",
     "storages",
     # "django_elasticsearch_dsl",
@@ -65,6 +66,69 @@ DATABASES = {
 #     "default": {"hosts": os.environ.get("ELASTICSEARCH_HOST", "localhost:9200")},
 # }
 
+# Index updates are queued in redis and flushed by celery, see blog.indexing
+# Read by django_elasticsearch_dsl only, no updates are queued while it is left out of INSTALLED_APPS
+ELASTICSEARCH_DSL_SIGNAL_PROCESSOR = "blog.indexing.DirtyQueueSignalProcessor"
+SEARCH_INDEX_BATCH_SIZE = 500
+SEARCH_INDEX_MAX_BATCHES = 20
+SEARCH_INDEX_DEBOUNCE_SECONDS = 5
+SEARCH_INDEX_LOCK_TIMEOUT = 300
+SEARCH_INDEX_MAX_RETRIES = 8
+SEARCH_INDEX_BACKLOG_WARNING = 50000
+SEARCH_REBUILD_TIMEOUT = 24 * 60 * 60
+SEARCH_CACHE_TTL = 30
+SEARCH_CACHE_LOCK_TIMEOUT = 2
+SEARCH_CACHE_STALE_TTL = 60 * 60
+# Seconds the client waits for elasticsearch, and time after which shards return partial results
+SEARCH_REQUEST_TIMEOUT = 2
+SEARCH_SERVER_TIMEOUT = "1500ms"
+# Tried in order while the search backend is unavailable
+# "cache": stale cached page of the same query, "database": icontains query over recent posts
+# A 503 is returned when none of them has a result
+SEARCH_FALLBACKS = ["cache", "database"]
+SEARCH_FALLBACK_RECENT_DAYS = 30
+# Search backend of each SearchViewSetMixin viewset, by viewset class name
+SEARCH_BACKENDS = {
+    "default": "blog.search.ElasticsearchBackend",
+    # "BlogsViewSet": "blog.search.PostgresBackend",
+    # "TagViewSet": "blog.search.PostgresBackend",
+}
+
+# Most ids accepted by the follow_many and unfollow_many endpoints
+FOLLOW_MANY_MAX_IDS = 500
+# Follower and following sets of account.graph with more members are split into shards
+SOCIAL_GRAPH_SHARD_THRESHOLD = 10000
+SOCIAL_GRAPH_SHARDS = 16
+# Users listed in "followed by" of the relationship endpoint
+SOCIAL_GRAPH_FOLLOWED_BY_PREVIEW = 3
+# Uploaded images wait in redis for the image pipeline at most this long
+IMAGE_UPLOAD_STAGING_TTL = 60 * 60
+IMAGE_UPLOAD_MAX_SIZE = 10 * 2 ** 20
+# Longest side in pixels of each profile picture variant
+PROFILE_PICTURE_SIZES = {
+    "small": 64,
+    "medium": 256,
+    "large": 1024,
+}
+# Variant stored in profile_picture_url
+PROFILE_PICTURE_DEFAULT_SIZE = "medium"
+
+# Follow suggestions, see account.suggestions
+SUGGESTION_CHUNK_SIZE = 500
+SUGGESTION_TOP_K = 50
+SUGGESTION_MAX_FANOUT = 5000
+SUGGESTION_AUTHORS_PER_TAG = 200
+SUGGESTION_MUTUAL_WEIGHT = 1.0
+SUGGESTION_INTEREST_WEIGHT = 2.0
+# Rows compared per core.tasks.reconcile_counter run
+RECONCILE_CHUNK_SIZE = 1000
+
+# Circuit breakers of lib.circuit_breaker by name, state is shared by every replica through redis
+CIRCUIT_BREAKERS = {
+    "default": {"failure_threshold": 5, "window": 30, "reset_timeout": 30, "probe_timeout": 5},
+    "elasticsearch": {"failure_threshold": 5, "window": 30, "reset_timeout": 15, "probe_timeout": 5},
+}
+
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
@@ -146,6 +210,27 @@ USE_TZ = True
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MAX_UPLOAD_FILE_SIZE_BYTES = 100 * 1000000  # 100MB
+# Presigned direct to bucket uploads, see lib.serializers.DirectUploadSerializer
+UPLOAD_CONTENT_TYPES = ["image/jpeg", "image/png", "image/webp", "image/gif"]
+UPLOAD_URL_EXPIRES_IN = 15 * 60
+MULTIPART_UPLOAD_PART_SIZE = 8 * 2 ** 20
+# Server side uploads over the threshold are streamed in parts, see lib.backends.S3Storage.upload_stream
+# Memory held per upload is at most part size * (concurrency + 1)
+STORAGE_MULTIPART_THRESHOLD = 16 * 2 ** 20
+STORAGE_MULTIPART_PART_SIZE = 8 * 2 ** 20
+STORAGE_MULTIPART_CONCURRENCY = 4
+# Files uploaded at once by StorageService.upload_files
+STORAGE_UPLOAD_CONCURRENCY = 8
+# Images accepted by one blog image upload request, each up to IMAGE_UPLOAD_MAX_SIZE
+BLOG_IMAGE_UPLOAD_MAX_FILES = 20
+BLOG_IMAGE_UPLOAD_MAX_TOTAL_SIZE = 50 * 2 ** 20
+# Cache-Control of content addressed files, see core.storage
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Storage clients, a bucket can override the pool size with "max_pool_connections"
+STORAGE_MAX_POOL_CONNECTIONS = 32
+STORAGE_CONNECT_TIMEOUT = 5
+STORAGE_READ_TIMEOUT = 60
+STORAGE_MAX_ATTEMPTS = 3
 
 # DRF
 REST_FRAMEWORK = {
@@ -153,8 +238,20 @@ REST_FRAMEWORK = {
         "rest_framework.permissions.IsAuthenticatedOrReadOnly",
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+        'authentication.authentication.CachedJWTAuthentication',
+    ),
+    # Rates of lib.throttling by throttle_scope of the view
+    "DEFAULT_THROTTLE_RATES": {
+        "votes": "60/min",
+        "comments": "20/min",
+        "follow": "60/min",
+        # Up to FOLLOW_MANY_MAX_IDS relationships per request
+        "follow_many": "10/hour",
+        "send_verification": "3/hour",
+        "token_obtain": "10/min",
+    },
+    # Client IP is the last address nginx appends to X-Forwarded-For
+    "NUM_PROXIES": 1,
 }
 
 AUTH_USER_MODEL = "account.User"
@@ -180,8 +277,17 @@ AWS_LOCATION = os.environ["AWS_LOCATION"]
 AWS_QUERYSTRING_AUTH = True
 AWS_STATIC_LOCATION = 'static'
 
+# Storage backend of the default bucket: s3, local or memory, see lib.backends.StorageRegistry
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "s3")
+# Local backend files, served by nginx
+MEDIA_ROOT = os.environ.get("MEDIA_ROOT", "/vol/media")
+MEDIA_URL = os.environ.get("MEDIA_URL", "/media/")
+
 DIGITAL_OCEAN_BUCKETS = {
     "default": {
+        "backend": STORAGE_BACKEND,
+        "location": MEDIA_ROOT,
+        "base_url": MEDIA_URL,
         "bucket": AWS_STORAGE_BUCKET_NAME,
         "endpoint_url": AWS_S3_ENDPOINT_URL,
         "access_key_id": AWS_ACCESS_KEY_ID,
@@ -198,11 +304,30 @@ EMAIL_HOST_PASSWORD = os.environ["EMAIL_HOST_PASSWORD"]
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+# Seconds an SMTP operation may block, well under the 60 seconds the mail flush lock outlives a run
+EMAIL_TIMEOUT = 10
 DEFAULT_FROM_EMAIL = os.environ["DEFAULT_FROM_EMAIL"]
+# Mail queues, see core.mail. "options" are passed to get_connection and default to the EMAIL_* settings,
+# "rate_limit" is in messages per second
+EMAIL_PROVIDERS = {
+    "default": {
+        "backend": EMAIL_BACKEND,
+        "options": {},
+        "rate_limit": 10,
+        "batch_size": 50,
+    },
+}
+EMAIL_MAX_ATTEMPTS = 5
+# Seconds before the first retry of a refused message, doubled on every attempt
+EMAIL_RETRY_BACKOFF = 30
+EMAIL_FLUSH_MAX_SECONDS = 50
 
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=int(os.environ["ACCESS_TOKEN_LIFETIME"])),
     "REFRESH_TOKEN_LIFETIME": timedelta(minutes=int(os.environ["REFRESH_TOKEN_LIFETIME"]))
 }
 
+# Seconds authentication.authentication.CachedJWTAuthentication keeps a user, saves drop it sooner
+AUTH_USER_CACHE_TTL = 60
+
 DEFAULT_PARENT_LOOKUP_KWARG_NAME_PREFIX = "parent_"
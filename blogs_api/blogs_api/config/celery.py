@@ -1,5 +1,7 @@
 import os
 
+from kombu import Queue
+
 broker_url = os.environ.get("CELERY_BROKER_URL")
 broker_api = os.environ.get("BROKER_API", broker_url)
 
@@ -9,3 +11,77 @@ CELERY_BROKER_URL = BROKER_URL
 CELERY_RESULT_BACKEND = BROKER_URL
 
 worker_proc_alive_timeout = 12
+
+# Nothing reads task results, tasks that return something still skip the result backend
+CELERY_TASK_IGNORE_RESULT = True
+
+# One queue per workload, each consumed by its own worker profile in the compose files
+CELERY_TASK_DEFAULT_QUEUE = "celery"
+CELERY_TASK_QUEUES = (
+    Queue("celery"),
+    Queue("email"),
+    Queue("search-indexing"),
+    Queue("media"),
+    Queue("maintenance"),
+    # Follower and notification fan out, shares the default worker until it needs its own
+    Queue("fanout"),
+)
+
+# Priority 0 is consumed first, redis emulates priorities with one list per step
+CELERY_TASK_DEFAULT_PRIORITY = 5
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    "priority_steps": list(range(10)),
+    "sep": ":",
+    "queue_order_strategy": "priority",
+    # Unacknowledged tasks are redelivered after this long, longer than any task runs or is delayed
+    "visibility_timeout": 60 * 60,
+}
+
+CELERY_TASK_ROUTES = {
+    "core.tasks.send_email": {"queue": "email", "priority": 0},
+    "core.tasks.flush_mail_queue": {"queue": "email", "priority": 0},
+    "core.tasks.flush_mail_queues": {"queue": "email", "priority": 3},
+    "blog.tasks.flush_search_index": {"queue": "search-indexing", "priority": 3},
+    "account.tasks.process_profile_picture": {"queue": "media", "priority": 3},
+    "core.tasks.reconcile_counters": {"queue": "maintenance", "priority": 7},
+    "core.tasks.reconcile_counter": {"queue": "maintenance", "priority": 7},
+    "account.tasks.compute_follow_suggestions": {"queue": "maintenance", "priority": 9},
+}
+
+# Tasks that are safe to run twice are acknowledged once done, so a worker that shuts down mid task hands them
+# to another one. Only the small flush tasks are also requeued when the worker process dies, a task that kills it,
+# EG: an image bomb or a large fan-out, would otherwise be redelivered forever
+CELERY_TASK_ANNOTATIONS = {
+    **{
+        task: {"acks_late": True}
+        for task in (
+            "account.tasks.process_profile_picture",
+            "core.tasks.reconcile_counters",
+            "core.tasks.reconcile_counter",
+            "account.tasks.compute_follow_suggestions",
+        )
+    },
+    **{
+        task: {"acks_late": True, "reject_on_worker_lost": True}
+        for task in (
+            "core.tasks.flush_mail_queue",
+            "core.tasks.flush_mail_queues",
+            "blog.tasks.flush_search_index",
+        )
+    },
+}
+
+CELERY_BEAT_SCHEDULE = {
+    "reconcile-counters": {
+        "task": "core.tasks.reconcile_counters",
+        "schedule": 6 * 60 * 60,
+    },
+    "flush-mail-queues": {
+        "task": "core.tasks.flush_mail_queues",
+        "schedule": 60,
+    },
+    "compute-follow-suggestions": {
+        "task": "account.tasks.compute_follow_suggestions",
+        "schedule": 24 * 60 * 60,
+    },
+}
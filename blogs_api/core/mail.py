@@ -0,0 +1,237 @@
+"""
+Outgoing mail queue in redis, one list per provider of settings.EMAIL_PROVIDERS.
+`core.tasks.flush_mail_queue` drains a provider over a single SMTP connection with `send_messages`,
+at most `rate_limit` messages per second. Messages the server refuses are retried with exponential backoff
+from a sorted set, after EMAIL_MAX_ATTEMPTS attempts they are moved to a dead letter list.
+Delivery is at least once: messages being sent are moved to a processing list and only dropped from it once
+sent, messages left there by a crashed worker are queued again by the next flush
+"""
+import json
+import logging
+import smtplib
+import time
+from typing import Any
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from redis.exceptions import LockError, LockNotOwnedError
+
+from lib import metrics
+from lib.cache import get_redis, make_key
+
+logger = logging.getLogger(__name__)
+
+# Moves messages whose retry is due back to the queue
+PROMOTE_SCRIPT = """
+local unpack = unpack or table.unpack
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #due > 0 then
+    redis.call('zrem', KEYS[1], unpack(due))
+    redis.call('rpush', KEYS[2], unpack(due))
+end
+return #due
+"""
+
+
+# Moves a batch from the head of the queue to the processing list
+CLAIM_SCRIPT = """
+local unpack = unpack or table.unpack
+local batch = redis.call('lrange', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #batch > 0 then
+    redis.call('ltrim', KEYS[1], #batch, -1)
+    redis.call('rpush', KEYS[2], unpack(batch))
+end
+return batch
+"""
+
+# Moves unsent messages of the processing list back to the head of the queue, in order
+RELEASE_SCRIPT = """
+local claimed = redis.call('lrange', KEYS[2], 0, -1)
+for index = #claimed, 1, -1 do
+    redis.call('lpush', KEYS[1], claimed[index])
+end
+redis.call('del', KEYS[2])
+return #claimed
+"""
+
+
+def queue_key(provider: str) -> str:
+    return make_key("mail", "queue", provider)
+
+
+def processing_key(provider: str) -> str:
+    """
+    Messages claimed by the running flush and not sent yet, in queue order
+    """
+    return make_key("mail", "processing", provider)
+
+
+def retry_key(provider: str) -> str:
+    """
+    Sorted set of messages waiting for a retry, scored by the time they are due
+    """
+    return make_key("mail", "retry", provider)
+
+
+def dead_key(provider: str) -> str:
+    return make_key("mail", "dead", provider)
+
+
+def enqueue(subject: str, message: str, from_email: str, recipient_list: list[str], html_message: str = None,
+            provider: str = "default"):
+    """
+    Queues a message and schedules a flush of the provider's queue
+    :param subject: str
+    :param message: Plain text body
+    :param from_email: Sender, DEFAULT_FROM_EMAIL when empty
+    :param recipient_list: Recipients, all of them see each other in the 'To' field
+    :param html_message: HTML alternative of the body
+    :param provider: Key of settings.EMAIL_PROVIDERS
+    """
+    get_redis().rpush(queue_key(provider), build_payload(subject, message, from_email, recipient_list, html_message))
+    schedule_flush(provider)
+
+
+def build_payload(subject: str, message: str, from_email: str, recipient_list: list[str],
+                  html_message: str = None) -> str:
+    return json.dumps({
+        "subject": subject,
+        "message": message,
+        "from_email": from_email or settings.DEFAULT_FROM_EMAIL,
+        "recipient_list": list(recipient_list),
+        "html_message": html_message,
+        "attempts": 0,
+    })
+
+
+def schedule_flush(provider: str, countdown: int = 0):
+    """
+    Schedules one flush per provider at a time, messages queued meanwhile are sent by that flush
+    """
+    from core.tasks import flush_mail_queue
+
+    if get_redis().set(make_key("mail", "flush_scheduled", provider), 1, nx=True, ex=max(countdown, 1) + 5):
+        flush_mail_queue.apply_async(args=[provider], countdown=countdown)
+
+
+def build_message(payload: dict[str, Any]) -> EmailMultiAlternatives:
+    message = EmailMultiAlternatives(
+        payload["subject"], payload["message"], payload["from_email"], payload["recipient_list"]
+    )
+    if payload.get("html_message"):
+        message.attach_alternative(payload["html_message"], "text/html")
+    return message
+
+
+def open_connection(provider: str):
+    """
+    Opened connection of the provider's email backend, options default to the EMAIL_* settings
+    """
+    options = settings.EMAIL_PROVIDERS[provider]
+    connection = get_connection(options.get("backend"), fail_silently=False, **options.get("options", {}))
+    connection.open()
+    return connection
+
+
+def retry_later(redis, provider: str, payload: dict[str, Any]):
+    payload["attempts"] += 1
+    if payload["attempts"] >= settings.EMAIL_MAX_ATTEMPTS:
+        logger.error("Giving up on mail '%s' to %s", payload["subject"], payload["recipient_list"])
+        redis.rpush(dead_key(provider), json.dumps(payload))
+        metrics.incr("mail.dead", provider=provider)
+        return
+    due = time.time() + settings.EMAIL_RETRY_BACKOFF * 2 ** (payload["attempts"] - 1)
+    redis.zadd(retry_key(provider), {json.dumps(payload): due})
+    metrics.incr("mail.retried", provider=provider)
+
+
+def flush_mail_queue(provider: str = "default") -> int | None:
+    """
+    Sends queued messages of the provider over one connection, batch_size messages are claimed at a time.
+    Messages are handed to `send_messages` one by one on the open connection, so a refused message
+    is told apart from the rest of the batch without reconnecting.
+    A run lasts at most EMAIL_FLUSH_MAX_SECONDS so a large backlog is spread over several runs.
+    Only one run per provider sends at a time, so pacing the run keeps the provider's rate limit,
+    and messages a crashed run left in the processing list are queued again before sending.
+    The lock is renewed while sending, a run that lost it stops at once and leaves the processing
+    list to the run holding it.
+    Refused messages are retried later, when the connection fails the unsent messages are put back
+    before the error is raised
+    :param provider: Key of settings.EMAIL_PROVIDERS
+    :return: int | Number of messages still waiting, None if another run holds the lock
+    """
+    options = settings.EMAIL_PROVIDERS[provider]
+    interval = 1 / options["rate_limit"] if options.get("rate_limit") else 0
+    redis = get_redis()
+    lock_timeout = settings.EMAIL_FLUSH_MAX_SECONDS + 60
+    lock = redis.lock(make_key("mail", "flush_lock", provider), timeout=lock_timeout)
+    if not lock.acquire(blocking=False):
+        return None
+    keys = [queue_key(provider), processing_key(provider)]
+    release = redis.register_script(RELEASE_SCRIPT)
+    connection = None
+    try:
+        requeued = release(keys=keys)
+        if requeued:
+            logger.warning("Queued %s messages of an interrupted flush of '%s' again", requeued, provider)
+        redis.register_script(PROMOTE_SCRIPT)(
+            keys=[retry_key(provider), queue_key(provider)], args=[time.time(), options["batch_size"] * 10]
+        )
+        claim = redis.register_script(CLAIM_SCRIPT)
+        deadline = time.monotonic() + settings.EMAIL_FLUSH_MAX_SECONDS
+        next_send = 0.0
+        renew_at = time.monotonic() + lock_timeout / 2
+        while time.monotonic() < deadline:
+            batch = claim(keys=keys, args=[options["batch_size"]])
+            if not batch:
+                break
+            if connection is None:
+                try:
+                    connection = open_connection(provider)
+                except Exception:
+                    if lock.owned():
+                        release(keys=keys)
+                    raise
+            sent = 0
+            for raw in batch:
+                if time.monotonic() > renew_at:
+                    try:
+                        lock.reacquire()
+                    except LockNotOwnedError:
+                        logger.error("Lost the flush lock of '%s', stopping", provider)
+                        metrics.incr("mail.sent", sent, provider=provider)
+                        return None
+                    renew_at = time.monotonic() + lock_timeout / 2
+                payload = json.loads(raw)
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_send = max(next_send, time.monotonic()) + interval
+                try:
+                    connection.send_messages([build_message(payload)])
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+                    logger.warning("Mail '%s' refused, retrying later", payload["subject"], exc_info=True)
+                    retry_later(redis, provider, payload)
+                except Exception:
+                    # A run that lost the lock leaves the processing list to the run holding it
+                    if lock.owned():
+                        release(keys=keys)
+                    metrics.incr("mail.sent", sent, provider=provider)
+                    metrics.incr("mail.errors", provider=provider)
+                    raise
+                else:
+                    sent += 1
+                redis.lpop(processing_key(provider))
+            metrics.incr("mail.sent", sent, provider=provider)
+        return redis.llen(queue_key(provider))
+    finally:
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        try:
+            lock.release()
+        except LockError:
+            # Expired during a stalled send, must not hide the error being raised
+            logger.warning("Flush lock of '%s' expired before it was released", provider)
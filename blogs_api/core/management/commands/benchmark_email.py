@@ -0,0 +1,115 @@
+import socketserver
+import threading
+import time
+
+from django.core.mail import get_connection, send_mail
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from core import mail
+from lib.cache import get_redis
+
+BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+
+
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Accepts every message and drops it, enough SMTP for Django's smtp backend
+    """
+
+    def reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        # Stands in for the TCP and TLS handshake of a remote server
+        time.sleep(self.server.connect_delay)
+        self.reply("220 sink ESMTP")
+        while line := self.rfile.readline():
+            command = line.decode(errors="replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250-sink")
+                self.reply("250 8BITMIME")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                with self.server.lock:
+                    self.server.messages += 1
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, connect_delay: float):
+        super().__init__(("127.0.0.1", 0), SmtpSinkHandler)
+        self.connect_delay = connect_delay
+        self.connections = 0
+        self.messages = 0
+        self.lock = threading.Lock()
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends mail to a local SMTP sink, once with a new connection per message like send_mail, "
+        "once through the redis mail queue over one connection, and reports messages per second"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=500)
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument("--connect-delay-ms", type=int, default=0,
+                            help="Delay of the sink before greeting every connection, EG: 30 for a TLS handshake")
+
+    def handle(self, *args, **options):
+        sink = SmtpSink(options["connect_delay_ms"] / 1000)
+        threading.Thread(target=sink.serve_forever, daemon=True).start()
+        connection_options = {
+            "host": "127.0.0.1", "port": sink.server_address[1], "username": "", "password": "", "use_tls": False
+        }
+        count = options["messages"]
+        try:
+            start = time.perf_counter()
+            for index in range(count):
+                send_mail(
+                    f"Benchmark {index}", "Benchmark", "benchmark@localhost", ["sink@localhost"],
+                    connection=get_connection(BACKEND, **connection_options)
+                )
+            self.report("send_mail", count, time.perf_counter() - start, sink)
+
+            provider = "benchmark"
+            providers = {
+                provider: {
+                    "backend": BACKEND, "options": connection_options, "rate_limit": 0,
+                    "batch_size": options["batch_size"]
+                }
+            }
+            with override_settings(EMAIL_PROVIDERS=providers, EMAIL_FLUSH_MAX_SECONDS=3600):
+                redis = get_redis()
+                redis.delete(mail.queue_key(provider))
+                redis.rpush(mail.queue_key(provider), *(
+                    mail.build_payload(f"Benchmark {index}", "Benchmark", "benchmark@localhost", ["sink@localhost"])
+                    for index in range(count)
+                ))
+                start = time.perf_counter()
+                while mail.flush_mail_queue(provider):
+                    pass
+                self.report("queue", count, time.perf_counter() - start, sink)
+        finally:
+            sink.shutdown()
+            sink.server_close()
+
+    def report(self, name: str, count: int, elapsed: float, sink: SmtpSink):
+        self.stdout.write(
+            f"{name:<10} {count} messages in {elapsed:6.2f}s  {count / elapsed:8.1f} msg/s  "
+            f"{sink.connections} connections, {sink.messages} delivered"
+        )
+        sink.connections = sink.messages = 0
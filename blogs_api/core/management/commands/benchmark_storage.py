@@ -0,0 +1,90 @@
+import os
+import resource
+import tempfile
+import threading
+import time
+from uuid import uuid4
+
+from django.core.files import File
+from django.core.management.base import BaseCommand
+
+from lib.backends import StorageService
+
+
+def get_rss() -> int:
+    """
+    Current resident memory in bytes, peak resident memory where /proc is missing
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler(threading.Thread):
+    """
+    Samples resident memory in the background, peak is relative to the memory used when it started
+    """
+
+    def __init__(self, interval: float = 0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.baseline = get_rss()
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, get_rss() - self.baseline)
+
+    def stop(self) -> int:
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+class Command(BaseCommand):
+    help = (
+        "Uploads a generated file to a storage bucket and reports throughput and peak memory. "
+        "Point an s3 bucket at MinIO or moto_server, or use a local or memory bucket, to run it without network access"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size-mb", type=int, default=100)
+        parser.add_argument("--method", choices=["stream", "put"], default="stream",
+                            help="stream: multipart upload_stream, put: single put_object of the whole file")
+        parser.add_argument("--part-size-mb", type=int, default=None)
+        parser.add_argument("--concurrency", type=int, default=None)
+        parser.add_argument("--bucket", default="default")
+        parser.add_argument("--repeat", type=int, default=1)
+
+    def handle(self, *args, **options):
+        size = options["size_mb"] * 2 ** 20
+        with tempfile.TemporaryFile() as file:
+            for _ in range(options["size_mb"]):
+                file.write(os.urandom(2 ** 20))
+            for _ in range(options["repeat"]):
+                file.seek(0)
+                file_name = f"benchmark-{uuid4()}.bin"
+                sampler = RssSampler()
+                sampler.start()
+                start = time.perf_counter()
+                if options["method"] == "stream":
+                    part_size = options["part_size_mb"] and options["part_size_mb"] * 2 ** 20
+                    url = StorageService.upload_stream(
+                        file, file_name, bucket=options["bucket"], content_type="application/octet-stream",
+                        part_size=part_size, concurrency=options["concurrency"]
+                    )
+                else:
+                    url = StorageService.upload_file(
+                        file.read(), file_name, bucket=options["bucket"], content_type="application/octet-stream"
+                    )
+                elapsed = time.perf_counter() - start
+                peak = sampler.stop()
+                self.stdout.write(
+                    f"{options['method']:<6} {options['size_mb']}MB in {elapsed:6.2f}s  "
+                    f"{size / 2 ** 20 / elapsed:8.2f}MB/s  peak rss +{peak / 2 ** 20:.1f}MB"
+                )
+                backend = StorageService.get_backend(options["bucket"])
+                backend.delete_file(backend.get_key(file_name))
@@ -0,0 +1,32 @@
+# Generated by Django 4.1.7 on 2026-10-19 05:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('bucket', models.CharField(max_length=64)),
+                ('digest', models.CharField(max_length=64)),
+                ('key', models.CharField(max_length=1024)),
+                ('url', models.URLField(max_length=1024)),
+                ('size', models.PositiveBigIntegerField()),
+                ('content_type', models.CharField(blank=True, default='', max_length=128)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='storedfile',
+            constraint=models.UniqueConstraint(fields=('bucket', 'digest'), name='core_storedfile_bucket_digest_uniq'),
+        ),
+    ]
@@ -1 +1,24 @@
 from django.db import models
+
+from lib.models import TimeStampedModel
+
+
+class StoredFile(TimeStampedModel):
+    """
+    File stored under the digest of its content by `core.storage.store_file`
+    Uploads of content that is already stored are skipped and reuse the url
+    """
+    bucket = models.CharField(max_length=64)
+    digest = models.CharField(max_length=64)
+    key = models.CharField(max_length=1024)
+    url = models.URLField(max_length=1024)
+    size = models.PositiveBigIntegerField()
+    content_type = models.CharField(max_length=128, blank=True, default="")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["bucket", "digest"], name="core_storedfile_bucket_digest_uniq"),
+        ]
+
+    def __str__(self):
+        return self.key
@@ -0,0 +1,113 @@
+"""
+Reconciliation of denormalized counters with the rows they count.
+A counter is a column of a target model and an aggregate of the source rows pointing to each target row.
+`core.tasks.reconcile_counter` sweeps the target table in id order, chunk by chunk, and rewrites the drifted
+values of a chunk with a single UPDATE ... FROM (VALUES ...).
+A value is only rewritten if it still holds what was read, so increments made meanwhile are never lost,
+a value that changed in between is checked again by the next sweep
+"""
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Type
+
+from django.db import connection, models
+from django.db.models import Count
+
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+COUNTERS: dict[str, "Counter"] = {}
+
+
+@dataclass
+class Counter:
+    """
+    Denormalized counter
+    name: str | Unique name used in metrics and task arguments, EG: "user.follower_count"
+    model: Model holding the counter
+    column: str | Name of the counter field, must not be nullable
+    source: Model of the counted rows
+    source_field: str | Foreign key of source to model
+    filters: dict | Filters of the counted rows
+    aggregate: Aggregate of the source rows of a target row, counts them by default
+    """
+    name: str
+    model: Type[models.Model]
+    column: str
+    source: Type[models.Model]
+    source_field: str
+    filters: dict[str, Any] = field(default_factory=dict)
+    aggregate: models.Aggregate = field(default_factory=lambda: Count("*"))
+
+
+def register(counter: Counter) -> Counter:
+    """
+    Adds a counter to the periodic sweep of `core.tasks.reconcile_counters`
+    """
+    if counter.name in COUNTERS:
+        raise ValueError(f"Counter '{counter.name}' is already registered")
+    COUNTERS[counter.name] = counter
+    return counter
+
+
+def get_actual_values(counter: Counter, ids: list[int]) -> dict[int, Any]:
+    """
+    Aggregates of the source rows of each target row, rows without source rows are left out
+    """
+    return dict(
+        counter.source.objects.filter(**{f"{counter.source_field}__in": ids}, **counter.filters).order_by().values(
+            counter.source_field
+        ).annotate(value=counter.aggregate).values_list(counter.source_field, "value")
+    )
+
+
+def write_values(counter: Counter, rows: list[tuple[int, Any, Any]]) -> int:
+    """
+    Rewrites counter values in one statement, rows whose value changed since it was read are left alone
+    :param counter: Counter
+    :param rows: Primary key, value read and value to write
+    :return: int | Number of rewritten rows
+    """
+    meta = counter.model._meta
+    quote = connection.ops.quote_name
+    table, pk, column = quote(meta.db_table), quote(meta.pk.column), quote(meta.get_field(counter.column).column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {table} SET {column} = v.actual "
+            f"FROM (VALUES {', '.join(['(%s, %s, %s)'] * len(rows))}) AS v (id, stored, actual) "
+            f"WHERE {table}.{pk} = v.id AND {table}.{column} = v.stored",
+            [value for row in rows for value in row]
+        )
+        return cursor.rowcount
+
+
+def reconcile(counter: Counter, after_id: int, chunk_size: int) -> int | None:
+    """
+    Compares a chunk of stored values with their source rows and rewrites the drifted ones
+    Reports checked, drifted and fixed rows and the total drift as metrics labelled with the counter name
+    :param counter: Counter
+    :param after_id: Id of the last row of the previous chunk
+    :param chunk_size: Rows per chunk
+    :return: int | None | Id of the last row of the chunk, None once the table is swept
+    """
+    stored = list(
+        counter.model._default_manager.filter(pk__gt=after_id).order_by("pk").values_list(
+            "pk", counter.column
+        )[:chunk_size]
+    )
+    actual = get_actual_values(counter, [pk for pk, _ in stored]) if stored else {}
+    drifted = [(pk, value, actual.get(pk, 0)) for pk, value in stored if value != actual.get(pk, 0)]
+    metrics.incr("reconcile.checked", len(stored), counter=counter.name)
+    if drifted:
+        fixed = write_values(counter, drifted)
+        logger.warning("Counter %s drifted on %s rows, fixed %s", counter.name, len(drifted), fixed)
+        metrics.incr("reconcile.drifted", len(drifted), counter=counter.name)
+        metrics.incr("reconcile.fixed", fixed, counter=counter.name)
+        metrics.incr("reconcile.drift", int(sum(abs(actual - value) for _, value, actual in drifted)),
+                     counter=counter.name)
+    if len(stored) == chunk_size:
+        return stored[-1][0]
+    metrics.set_gauge("reconcile.swept_at", time.time(), counter=counter.name)
+    return None
@@ -0,0 +1,79 @@
+"""
+Content addressed storage, files are stored under the BLAKE2b digest of their content:
+"<default location>/objects/<first 2 digest characters>/<digest><extension>".
+The same content is stored once, and since a key never changes content it is cached as immutable.
+Stored files are recorded in StoredFile so repeated uploads skip the transfer
+"""
+import mimetypes
+import os.path
+from typing import BinaryIO
+
+from django.conf import settings
+from django.core.files import File
+
+from core.models import StoredFile
+from lib.backends import StorageService, hash_file
+
+
+def get_extension(content_type: str, file_name: str = "") -> str:
+    extension = mimetypes.guess_extension(content_type) if content_type else None
+    return extension or os.path.splitext(file_name)[1].lower()
+
+
+def store_files(files: list[tuple[bytes | File | BinaryIO, str, str]], bucket: str = "default") -> list[str]:
+    """
+    Stores every file under the digest of its content, content that is stored already or repeated
+    in the batch is uploaded once. Objects stored but not recorded are found with a HEAD request,
+    missing files are uploaded concurrently
+    Files are read twice, the key is derived from the digest so it is known before the upload starts
+    :param files: Content, content type and original file name of every file,
+    the extension of the name is used when the content type has none
+    :param bucket: str
+    :return: list[str] URLs in the order of files
+    """
+    digests = [hash_file(file) for file, _, _ in files]
+    urls = dict(
+        StoredFile.objects.filter(bucket=bucket, digest__in={digest for digest, _ in digests}).values_list(
+            "digest", "url"
+        )
+    )
+    backend = StorageService.get_backend(bucket)
+    uploads, records, found = {}, [], []
+    for (file, content_type, file_name), (digest, size) in zip(files, digests):
+        if digest in urls or digest in uploads:
+            continue
+        upload_path = f"{backend.details['default_location']}/objects/{digest[:2]}"
+        file_name = f"{digest}{get_extension(content_type, file_name)}"
+        key = backend.get_key(file_name, upload_path)
+        record = StoredFile(bucket=bucket, digest=digest, key=key, size=size, content_type=content_type)
+        # Stored before but not recorded, EG: the row insert failed
+        if backend.head_file(key) is not None:
+            record.url = urls[digest] = backend.get_file_url(key)
+            found.append(record)
+            continue
+        uploads[digest] = {
+            "file": file,
+            "file_name": file_name,
+            "upload_path": upload_path,
+            "content_type": content_type,
+            "cache_control": settings.IMMUTABLE_CACHE_CONTROL,
+        }
+        records.append(record)
+    for record, url in zip(records, StorageService.upload_files(list(uploads.values()), bucket=bucket)):
+        record.url = urls[record.digest] = url
+    # Keys are derived from the content, a row inserted meanwhile by another upload holds the same url
+    StoredFile.objects.bulk_create(found + records, ignore_conflicts=True)
+    return [urls[digest] for digest, _ in digests]
+
+
+def store_file(file: bytes | File | BinaryIO, content_type: str = "", file_name: str = "",
+               bucket: str = "default") -> str:
+    """
+    Stores the file under the digest of its content unless it is stored already
+    :param file: Content to store
+    :param content_type: Content type, also picks the extension of the key
+    :param file_name: Original file name, its extension is used when the content type has none
+    :param bucket: str
+    :return: str | URL of the file
+    """
+    return store_files([(file, content_type, file_name)], bucket)[0]
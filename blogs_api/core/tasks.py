@@ -1,8 +1,13 @@
+import smtplib
+
+from django.conf import settings
+
 from blogs_api.celery import app
-from django.core.mail import send_mail as django_send_email
+from core import mail, reconcile
+from lib.cache import get_redis, make_key
 
 
-@app.task()
+@app.task(ignore_result=True)
 def send_email(
         subject,
         message,
@@ -15,24 +20,60 @@ def send_email(
         html_message=None,
 ):
     """
-        Easy wrapper for sending a single message to a recipient list. All members
+        Queues a single message to a recipient list, see `core.mail.enqueue`. All members
         of the recipient list will see the other recipients in the 'To' field.
 
         If from_email is None, use the DEFAULT_FROM_EMAIL setting.
-        If auth_user is None, use the EMAIL_HOST_USER setting.
-        If auth_password is None, use the EMAIL_HOST_PASSWORD setting.
-
-        Note: The API for this method is frozen. New code wanting to extend the
-        functionality should use the EmailMessage class directly.
+        Kept for messages queued before the mail queue, the connection options are ignored,
+        messages are sent over the default provider's connection
         """
-    django_send_email(
-        subject,
-        message,
-        from_email,
-        recipient_list,
-        fail_silently=fail_silently,
-        auth_user=auth_user,
-        auth_password=auth_password,
-        connection=connection,
-        html_message=html_message,
-    )
+    mail.enqueue(subject, message, from_email, recipient_list, html_message=html_message)
+
+
+@app.task(bind=True, ignore_result=True, max_retries=settings.EMAIL_MAX_ATTEMPTS)
+def flush_mail_queue(self, provider: str = "default"):
+    """
+    Sends queued mail of the provider, see `core.mail.flush_mail_queue`.
+    Re-schedules itself while a backlog remains, and backs off exponentially
+    when the mail server can not be reached
+    """
+    get_redis().delete(make_key("mail", "flush_scheduled", provider))
+    try:
+        remaining = mail.flush_mail_queue(provider)
+    except (smtplib.SMTPException, OSError) as exc:
+        raise self.retry(exc=exc, countdown=settings.EMAIL_RETRY_BACKOFF * 2 ** self.request.retries)
+    if remaining is None:
+        # Another flush is sending, check again once it should be done
+        mail.schedule_flush(provider, countdown=5)
+    elif remaining:
+        mail.schedule_flush(provider)
+
+
+@app.task(ignore_result=True)
+def flush_mail_queues():
+    """
+    Periodic flush of every provider, sends retries that came due and mail whose flush was lost
+    """
+    for provider in settings.EMAIL_PROVIDERS:
+        mail.schedule_flush(provider)
+
+
+@app.task(ignore_result=True)
+def reconcile_counters():
+    """
+    Periodic sweep, starts reconciling every counter registered in `core.reconcile`
+    """
+    for name in reconcile.COUNTERS:
+        reconcile_counter.delay(name)
+
+
+@app.task(ignore_result=True)
+def reconcile_counter(name: str, after_id: int = 0):
+    """
+    Reconciles a chunk of the counter, then schedules the next chunk so a sweep never holds a worker for long
+    :param name: Name of a registered counter
+    :param after_id: Id of the last row of the previous chunk
+    """
+    last_id = reconcile.reconcile(reconcile.COUNTERS[name], after_id, settings.RECONCILE_CHUNK_SIZE)
+    if last_id is not None:
+        reconcile_counter.delay(name, last_id)
@@ -1,3 +1,265 @@
-from django.test import TestCase
+import json
+import smtplib
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+from django.core.mail.backends.base import BaseEmailBackend
+from django.test import SimpleTestCase, override_settings
+
+from core import mail, storage
+from core.management.commands.benchmark_email import SmtpSink
+from core.models import StoredFile
+
+
+class CountingBackend(BaseEmailBackend):
+    """
+    Email backend recording connections and messages, recipients in `refused` are refused
+    and the connection drops once `disconnect_after` messages were sent
+    """
+    opened = 0
+    sent = []
+    refused = set()
+    disconnect_after = None
+
+    @classmethod
+    def reset(cls):
+        cls.opened, cls.sent, cls.refused, cls.disconnect_after = 0, [], set(), None
+
+    def open(self):
+        CountingBackend.opened += 1
+        return True
+
+    def send_messages(self, email_messages):
+        for message in email_messages:
+            if self.disconnect_after is not None and len(self.sent) >= self.disconnect_after:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            refused = set(message.to) & self.refused
+            if refused:
+                raise smtplib.SMTPRecipientsRefused({recipient: (550, b"No such user") for recipient in refused})
+            self.sent.append((message.subject, time.monotonic()))
+        return len(email_messages)
+
+
+PROVIDER = {"backend": "core.tests.CountingBackend", "options": {}, "rate_limit": 0, "batch_size": 5}
+
+
+@override_settings(EMAIL_PROVIDERS={"default": PROVIDER}, EMAIL_MAX_ATTEMPTS=3, EMAIL_RETRY_BACKOFF=30,
+                   EMAIL_FLUSH_MAX_SECONDS=60)
+class MailQueueTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        for target in ("core.mail.get_redis", "lib.metrics.get_redis"):
+            patcher = mock.patch(target, return_value=self.redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        CountingBackend.reset()
+
+    def enqueue(self, count: int, recipient: str = "user@example.com", provider: str = "default"):
+        self.redis.rpush(mail.queue_key(provider), *(
+            mail.build_payload(f"Message {index}", "Body", "blogs@example.com", [recipient])
+            for index in range(count)
+        ))
+
+    def test_enqueue_schedules_one_flush(self):
+        with mock.patch("core.tasks.flush_mail_queue.apply_async") as apply_async:
+            mail.enqueue("Subject", "Body", "", ["user@example.com"])
+            mail.enqueue("Subject", "Body", "", ["user@example.com"])
+        apply_async.assert_called_once_with(args=["default"], countdown=0)
+        self.assertEqual(self.redis.llen(mail.queue_key("default")), 2)
+
+    def test_batches_are_sent_over_one_connection(self):
+        self.enqueue(12)
+        self.assertEqual(mail.flush_mail_queue(), 0)
+        self.assertEqual(CountingBackend.opened, 1)
+        self.assertEqual([subject for subject, _ in CountingBackend.sent], [f"Message {i}" for i in range(12)])
+        self.assertEqual(self.redis.llen(mail.processing_key("default")), 0)
+
+    def test_empty_queue_opens_no_connection(self):
+        self.assertEqual(mail.flush_mail_queue(), 0)
+        self.assertEqual(CountingBackend.opened, 0)
+
+    def test_refused_message_is_retried_with_backoff_then_dead_lettered(self):
+        CountingBackend.refused = {"gone@example.com"}
+        self.enqueue(1, "gone@example.com")
+        self.enqueue(1)
+
+        started = time.time()
+        with self.assertLogs("core.mail", "WARNING"):
+            mail.flush_mail_queue()
+        self.assertEqual(len(CountingBackend.sent), 1)
+        (raw, due), = self.redis.zrange(mail.retry_key("default"), 0, -1, withscores=True)
+        self.assertEqual(json.loads(raw)["attempts"], 1)
+        self.assertAlmostEqual(due - started, 30, delta=2)
+
+        for attempt, backoff in ((2, 60), (3, None)):
+            with mock.patch("core.mail.time.time", return_value=due + 1), self.assertLogs("core.mail", "WARNING"):
+                started = due + 1
+                mail.flush_mail_queue()
+            retries = self.redis.zrange(mail.retry_key("default"), 0, -1, withscores=True)
+            if backoff:
+                (raw, due), = retries
+                self.assertEqual(json.loads(raw)["attempts"], attempt)
+                self.assertAlmostEqual(due - started, backoff, delta=2)
+            else:
+                self.assertEqual(retries, [])
+
+        dead, = self.redis.lrange(mail.dead_key("default"), 0, -1)
+        self.assertEqual(json.loads(dead)["attempts"], 3)
+        self.assertEqual(self.redis.llen(mail.queue_key("default")), 0)
+
+    @override_settings(EMAIL_PROVIDERS={"default": {**PROVIDER, "rate_limit": 20}})
+    def test_rate_limit_paces_sends(self):
+        self.enqueue(10)
+        mail.flush_mail_queue()
+        times = [sent_at for _, sent_at in CountingBackend.sent]
+        self.assertEqual(len(times), 10)
+        # 20 messages per second, one every 50ms
+        self.assertGreaterEqual(times[-1] - times[0], 9 * 0.05 * 0.95)
+        self.assertTrue(all(later - earlier >= 0.045 for earlier, later in zip(times, times[1:])))
+
+    def test_disconnect_mid_batch_puts_unsent_messages_back(self):
+        CountingBackend.disconnect_after = 3
+        self.enqueue(8)
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            mail.flush_mail_queue()
+        queued = [json.loads(raw)["subject"] for raw in self.redis.lrange(mail.queue_key("default"), 0, -1)]
+        self.assertEqual(queued, [f"Message {i}" for i in range(3, 8)])
+        self.assertEqual(self.redis.llen(mail.processing_key("default")), 0)
+
+        CountingBackend.disconnect_after = None
+        self.assertEqual(mail.flush_mail_queue(), 0)
+        self.assertEqual([subject for subject, _ in CountingBackend.sent], [f"Message {i}" for i in range(8)])
+
+    def test_messages_of_a_crashed_flush_are_sent_again(self):
+        self.enqueue(4)
+        # A worker claimed a batch and died before sending it
+        self.redis.register_script(mail.CLAIM_SCRIPT)(
+            keys=[mail.queue_key("default"), mail.processing_key("default")], args=[2]
+        )
+        self.assertEqual(self.redis.llen(mail.processing_key("default")), 2)
+        with self.assertLogs("core.mail", "WARNING") as logs:
+            mail.flush_mail_queue()
+        self.assertIn("Queued 2 messages of an interrupted flush", logs.output[0])
+        self.assertEqual([subject for subject, _ in CountingBackend.sent], [f"Message {i}" for i in range(4)])
+
+    def steal_lock_on_send(self):
+        """
+        The first send stalls past the lock timeout and another run takes the lock meanwhile
+        """
+        clock = [time.monotonic()]
+        send = CountingBackend.send_messages
+
+        def stalled_send(backend, email_messages):
+            if len(CountingBackend.sent) == 0:
+                clock[0] += 200
+                self.redis.set(mail.make_key("mail", "flush_lock", "default"), "other run")
+            return send(backend, email_messages)
+
+        for patcher in (mock.patch("core.mail.time.monotonic", side_effect=lambda: clock[0]),
+                        mock.patch.object(CountingBackend, "send_messages", stalled_send)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_run_stops_when_it_lost_the_lock(self):
+        self.enqueue(3)
+        self.steal_lock_on_send()
+        with self.assertLogs("core.mail", "WARNING") as logs:
+            self.assertIsNone(mail.flush_mail_queue())
+        self.assertIn("Lost the flush lock of 'default'", logs.output[0])
+        self.assertEqual(len(CountingBackend.sent), 1)
+        # Left to the run holding the lock, which queues them again
+        self.assertEqual(self.redis.llen(mail.processing_key("default")), 2)
+        self.assertEqual(self.redis.get(mail.make_key("mail", "flush_lock", "default")), b"other run")
+
+    def test_error_of_a_run_that_lost_the_lock_is_raised(self):
+        CountingBackend.disconnect_after = 1
+        self.enqueue(3)
+        self.steal_lock_on_send()
+        # The lock is not due for renewal yet, the lost lock shows when the connection fails
+        with override_settings(EMAIL_FLUSH_MAX_SECONDS=1000), self.assertLogs("core.mail", "WARNING"):
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                mail.flush_mail_queue()
+        self.assertEqual(self.redis.llen(mail.processing_key("default")), 2)
+        self.assertEqual(self.redis.llen(mail.queue_key("default")), 0)
+
+    def test_locked_provider_is_not_flushed(self):
+        self.enqueue(1)
+        lock = self.redis.lock(mail.make_key("mail", "flush_lock", "default"), timeout=10)
+        lock.acquire()
+        self.assertIsNone(mail.flush_mail_queue())
+        self.assertEqual(CountingBackend.sent, [])
+
+
+class MailQueueSmtpSinkTestCase(SimpleTestCase):
+    """
+    Mail queue against a local SMTP server with Django's smtp backend
+    """
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        for target in ("core.mail.get_redis", "lib.metrics.get_redis"):
+            patcher = mock.patch(target, return_value=self.redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.sink = SmtpSink(connect_delay=0)
+        threading.Thread(target=self.sink.serve_forever, daemon=True).start()
+        self.addCleanup(self.sink.server_close)
+        self.addCleanup(self.sink.shutdown)
+
+    def test_queue_is_sent_over_one_smtp_connection(self):
+        provider = {
+            "backend": "django.core.mail.backends.smtp.EmailBackend",
+            "options": {"host": "127.0.0.1", "port": self.sink.server_address[1], "username": "", "password": "",
+                        "use_tls": False},
+            "rate_limit": 0,
+            "batch_size": 50,
+        }
+        count = 300
+        self.redis.rpush(mail.queue_key("default"), *(
+            mail.build_payload(f"Message {index}", "Body", "blogs@example.com", ["user@example.com"])
+            for index in range(count)
+        ))
+        with override_settings(EMAIL_PROVIDERS={"default": provider}, EMAIL_FLUSH_MAX_SECONDS=60):
+            started = time.perf_counter()
+            self.assertEqual(mail.flush_mail_queue(), 0)
+            elapsed = time.perf_counter() - started
+        self.assertEqual(self.sink.messages, count)
+        self.assertEqual(self.sink.connections, 1)
+        # Hundreds of messages per second over one connection, send_mail manages about 20 reconnecting each time
+        self.assertGreater(count / elapsed, 100)
+
+
+class StoreFilesTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.objects = mock.Mock()
+        self.objects.filter.return_value.values_list.return_value = []
+        self.backend = mock.Mock(details={"default_location": "content"})
+        self.backend.get_key.side_effect = lambda file_name, upload_path: f"{upload_path}/{file_name}"
+        self.backend.get_file_url.side_effect = lambda key: f"https://cdn/{key}"
+        self.service = mock.Mock(**{"get_backend.return_value": self.backend})
+        self.service.upload_files.side_effect = lambda uploads, bucket: [
+            f"https://cdn/{upload['upload_path']}/{upload['file_name']}" for upload in uploads
+        ]
+        for patcher in (mock.patch.object(StoredFile, "objects", self.objects),
+                        mock.patch("core.storage.StorageService", self.service)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_object_stored_but_not_recorded_is_not_uploaded(self):
+        stored, missing = b"stored", b"missing"
+        digest, _ = storage.hash_file(stored)
+        stored_key = f"content/objects/{digest[:2]}/{digest}.png"
+        self.backend.head_file.side_effect = lambda key: {"size": 6} if key == stored_key else None
+
+        urls = storage.store_files([(stored, "image/png", ""), (missing, "image/png", ""), (stored, "image/png", "")])
+
+        self.assertEqual(urls[0], f"https://cdn/{stored_key}")
+        self.assertEqual(urls[2], urls[0])
+        (uploads,), _ = self.service.upload_files.call_args
+        self.assertEqual([upload["file"] for upload in uploads], [missing])
+        (records,), _ = self.objects.bulk_create.call_args
+        self.assertEqual({record.url for record in records}, {urls[0], urls[1]})
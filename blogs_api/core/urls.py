@@ -5,7 +5,9 @@ from account.views import UserViewSet, UserDetailsViewSet
 # Auth views
 from authentication.views import TokenObtainPairView, TokenRefreshView
 # Blog views
-from blog.views import BlogsViewSet, CommentViewSet, VoteViewSet, TagViewSet, UniqueVisitorViewSet
+from blog.views import BlogsViewSet, CommentViewSet, VoteViewSet, TagViewSet, UniqueVisitorViewSet, BlogImageViewSet
+# Core views
+from core.views import MetricsView
 # Library views
 from lib.routers import Router
 from rest_framework_extensions.routers import ExtendedSimpleRouter
@@ -37,8 +39,13 @@ blog_router.register(
     r'unique_visitors', UniqueVisitorViewSet, basename="unique_visitor", parents_query_lookups=["blog"]
 )
 
+blog_router.register(
+    r'images', BlogImageViewSet, basename="images", parents_query_lookups=["blog"]
+)
+
 
 urlpatterns = router.urls + [
     path("auth/access_token", TokenObtainPairView.as_view()),
     path("auth/refresh_token", TokenRefreshView.as_view()),
+    path("metrics", MetricsView.as_view()),
 ]
@@ -1,3 +1,24 @@
-from django.shortcuts import render
+from django.conf import settings
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
-# Create your views here.
+from lib.circuit_breaker import CircuitBreaker
+from lib.metrics import get_metrics
+
+
+class MetricsView(APIView):
+    """
+    Counters, gauges and timings recorded in redis, and the live state of every circuit breaker
+    Staff only
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        data = get_metrics()
+        data["circuit_breakers"] = {
+            name: CircuitBreaker(name).get_state()
+            for name in settings.CIRCUIT_BREAKERS
+            if name != "default"
+        }
+        return Response(data)
@@ -1,122 +1,736 @@
+import base64
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
 from copy import deepcopy
+from functools import partial
+from typing import Any, BinaryIO
 
 from boto3 import session
 from botocore.client import BaseClient
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 from django.conf import settings
 from django.core.files import File
 
+from lib import metrics
 
-class S3BucketError(Exception):
+
+class StorageError(Exception):
     pass
 
 
-class S3Storage:
-    __bucket_keys = [
-        "bucket",
-        "endpoint_url",
-        "access_key_id",
-        "access_key",
-        "region",
-        "acl",
-        "default_location",
-    ]
+class StorageFileNotFound(StorageError):
+    """
+    Raised by every backend when a key does not exist
+    """
 
-    def set_bucket(self):
+    def __init__(self, key: str):
+        super().__init__(f"'{key}' does not exist")
+        self.key = key
+
+
+class S3BucketError(StorageError):
+    pass
+
+
+class S3UploadError(S3BucketError):
+    """
+    A streaming upload failed, the multipart upload is kept so it can be resumed with `upload_id`
+    """
+
+    def __init__(self, message: str, key: str, upload_id: str):
+        super().__init__(message)
+        self.key = key
+        self.upload_id = upload_id
+
+
+def hash_file(file: bytes | BinaryIO, chunk_size: int = 2 ** 20) -> tuple[str, int]:
+    """
+    BLAKE2b digest of the content, files are read in chunks and rewound
+    :return: tuple[str, int] Hex digest and size in bytes
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    if isinstance(file, bytes):
+        digest.update(file)
+        return digest.hexdigest(), len(file)
+    start, size = file.tell(), 0
+    while chunk := file.read(chunk_size):
+        digest.update(chunk)
+        size += len(chunk)
+    file.seek(start)
+    return digest.hexdigest(), size
+
+
+class BaseStorage(ABC):
+    """
+    Storage backend of a single bucket, configured by its entry in settings.DIGITAL_OCEAN_BUCKETS
+    Files are addressed by key, "<upload path>/<file name>", the upload path defaults to the bucket's default_location
+    """
+    required_keys = ["default_location"]
+
+    def __init__(self, name: str, details: dict[str, Any]):
+        for key in self.required_keys:
+            if key not in details:
+                raise StorageError(f"'{key}' missing in bucket details")
+        self.name = name
+        self.details = details
+
+    def get_key(self, file_name: str, upload_path: str = "") -> str:
+        return f"{upload_path or self.details['default_location']}/{file_name}"
+
+    def get_upload_prefix(self, *parts) -> str:
         """
-        Set bucket registry
+        Key prefix of direct uploads, EG: get_upload_prefix("users", 1) -> "content/uploads/users/1/"
+        Presigned uploads are only issued and confirmed within their prefix
         """
-        buckets = deepcopy(settings.DIGITAL_OCEAN_BUCKETS)
-        if "default" not in buckets:
-            raise S3BucketError("'default' bucket missing error")
+        return "/".join([self.details["default_location"], "uploads", *map(str, parts)]) + "/"
 
-        for bucket, values in buckets.items():
-            for key in self.__bucket_keys:
-                if key not in values:
-                    raise S3BucketError(f"'{key}' missing in bucket details")
-        return buckets
+    @abstractmethod
+    def upload_file(self, file: bytes | File, file_name: str, upload_path: str = "", content_type: str = "",
+                    cache_control: str = "") -> str:
+        """
+        Stores the file
+        :return: str | URL of the file
+        """
 
-    def create_session(self):
+    def upload_stream(self, file: BinaryIO, file_name: str, upload_path: str = "", content_type: str = "",
+                      cache_control: str = "", **kwargs) -> str:
         """
-        Create session
+        Stores a large file without reading it into memory at once
         """
-        if not self.session:
-            return session.Session()
+        return self.upload_file(file, file_name, upload_path, content_type, cache_control)
 
-    def create_client(self):
+    @abstractmethod
+    def get_file_url(self, key: str) -> str:
         """
-        Create sessions for each bucket
+        Public URL of the file
         """
-        _clients = {}
-        for bucket, bucket_details in self.buckets.items():
-            _clients[bucket] = self.session.client(
-                service_name="s3",
-                region_name="nyc3",
-                aws_access_key_id=bucket_details["access_key_id"],
-                aws_secret_access_key=bucket_details["access_key"],
-                endpoint_url=bucket_details["endpoint_url"]
-            )
-        return _clients
 
-    def __init__(self):
+    @abstractmethod
+    def head_file(self, key: str) -> dict[str, Any] | None:
         """
-        Settings folder must have digital ocean bucket list
+        File metadata, None if it does not exist
+        :return: dict[str, Any] | None Size and content type of the file
         """
-        self.session = session.Session()
-        self.buckets = self.set_bucket()
-        self.clients: dict[str, BaseClient] = self.create_client()
 
-    def get_client_with_bucket(self, bucket) -> tuple[BaseClient, dict[str, str]]:
+    @abstractmethod
+    def download_file(self, key: str) -> bytes:
         """
-        Get bucket client along with bucket details
+        Content of the file
+        :raises StorageFileNotFound: When the file does not exist
         """
-        if bucket not in self.buckets:
-            raise S3BucketError(f"Invalid bucket '{bucket}'")
 
-        client = self.clients[bucket]
-        bucket_details = self.buckets[bucket]
-        return client, bucket_details
+    @abstractmethod
+    def delete_file(self, key: str):
+        """
+        Deletes the file, a missing file is not an error
+        """
+
+    def unsupported(self, *args, **kwargs):
+        raise StorageError(f"Bucket '{self.name}' does not support direct uploads")
+
+    generate_presigned_post = unsupported
+    generate_presigned_put = unsupported
+    create_multipart_upload = unsupported
+    complete_multipart_upload = unsupported
+    abort_multipart_upload = unsupported
+
+
+class S3Storage(BaseStorage):
+    """
+    S3 compatible bucket, EG: Digital Ocean spaces
+    """
+    required_keys = [
+        "bucket",
+        "endpoint_url",
+        "access_key_id",
+        "access_key",
+        "region",
+        "acl",
+        "default_location",
+    ]
+
+    def __init__(self, name: str, details: dict[str, Any]):
+        super().__init__(name, details)
+        self._client: BaseClient | None = None
+        self._lock = threading.Lock()
+
+    def create_client(self) -> BaseClient:
+        """
+        Creates the client of the bucket, clients are thread safe and shared by every thread of the process.
+        The connection pool is sized by the bucket's "max_pool_connections" or STORAGE_MAX_POOL_CONNECTIONS,
+        enough for every worker thread and streaming upload part at once
+        """
+        config = Config(
+            max_pool_connections=self.details.get("max_pool_connections", settings.STORAGE_MAX_POOL_CONNECTIONS),
+            tcp_keepalive=self.details.get("tcp_keepalive", True),
+            connect_timeout=settings.STORAGE_CONNECT_TIMEOUT,
+            read_timeout=settings.STORAGE_READ_TIMEOUT,
+            retries={"max_attempts": settings.STORAGE_MAX_ATTEMPTS, "mode": "standard"},
+        )
+        # Sessions are not thread safe, each client gets its own while the lock is held
+        client = session.Session().client(
+            service_name="s3",
+            region_name=self.details["region"],
+            aws_access_key_id=self.details["access_key_id"],
+            aws_secret_access_key=self.details["access_key"],
+            endpoint_url=self.details["endpoint_url"],
+            config=config
+        )
+        events = client.meta.events
+        events.register("before-call.s3", self.start_timer)
+        events.register("after-call.s3", partial(self.record_call, self.name))
+        events.register("after-call-error.s3", partial(self.record_call_error, self.name))
+        return client
+
+    @staticmethod
+    def start_timer(context: dict, **kwargs):
+        context["storage_started_at"] = time.perf_counter()
+
+    @staticmethod
+    def record_call(bucket: str, http_response, model, context: dict, **kwargs):
+        operation = model.name
+        metrics.observe(
+            "storage.latency", time.perf_counter() - context["storage_started_at"], bucket=bucket, operation=operation
+        )
+        if http_response.status_code >= 300:
+            metrics.incr("storage.errors", bucket=bucket, operation=operation, status=http_response.status_code)
+
+    @staticmethod
+    def record_call_error(bucket: str, exception: Exception, context: dict, event_name: str, **kwargs):
+        operation = event_name.rsplit(".", 1)[-1]
+        metrics.observe(
+            "storage.latency", time.perf_counter() - context["storage_started_at"], bucket=bucket, operation=operation
+        )
+        metrics.incr("storage.errors", bucket=bucket, operation=operation, error=type(exception).__name__)
+
+    @staticmethod
+    def get_object_parameters(content_type: str, cache_control: str) -> dict[str, str]:
+        parameters = {}
+        if content_type:
+            parameters["ContentType"] = content_type
+        if cache_control:
+            parameters["CacheControl"] = cache_control
+        return parameters
+
+    @property
+    def client(self) -> BaseClient:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self.create_client()
+        return self._client
 
     def upload_file(self,
                     file: bytes | File,
                     file_name: str,
                     upload_path: str = "",
-                    bucket: str = "default",
-                    content_type=""
+                    content_type="",
+                    cache_control=""
                     ):
         """
         Upload file to space ( Not space, digital ocean space ) bucket
         Args:
-            bucket: str
             file: bytes | File
             upload_path: str
             file_name: str
             content_type: str
+            cache_control: str
 
         Returns: URL of the file
         """
-        if bucket not in self.buckets:
-            raise S3BucketError(f"Invalid bucket '{bucket}'")
-
-        client = self.clients[bucket]
-        bucket_details = self.buckets[bucket]
-        if not upload_path:
-            upload_path = bucket_details["default_location"]
-        kwargs = {}
-        if content_type:
-            kwargs["ContentType"] = content_type
-        full_path = f"{upload_path}/{file_name}"
-        response = client.put_object(
+        if isinstance(file, File) and file.size and file.size > settings.STORAGE_MULTIPART_THRESHOLD:
+            file.seek(0)
+            return self.upload_stream(file, file_name, upload_path, content_type, cache_control)
+        kwargs = self.get_object_parameters(content_type, cache_control)
+        full_path = self.get_key(file_name, upload_path)
+        response = self.client.put_object(
             Body=file,
-            Bucket=bucket_details["bucket"],
+            Bucket=self.details["bucket"],
             Key=full_path,
-            ACL=bucket_details["acl"],
+            ACL=self.details["acl"],
             **kwargs
         )
         if not response["ResponseMetadata"]["HTTPStatusCode"] == 200:
             raise S3BucketError(
                 "File upload failed"
             )
-        return f"{bucket_details['endpoint_url']}/{bucket_details['bucket']}/{full_path}"
+        return self.get_file_url(full_path)
+
+    def upload_stream(self,
+                      file: BinaryIO,
+                      file_name: str,
+                      upload_path: str = "",
+                      content_type: str = "",
+                      cache_control: str = "",
+                      part_size: int = None,
+                      concurrency: int = None,
+                      upload_id: str = None
+                      ) -> str:
+        """
+        Multipart upload reading the file part by part, parts are uploaded by `concurrency` threads.
+        At most concurrency + 1 parts are held in memory, whatever the size of the file.
+        Every part is sent with its Content-MD5 so the bucket rejects corrupted parts, and the ETag of
+        the assembled object is checked against the MD5 of the parts.
+        A failed upload raises S3UploadError with the upload id, calling again with it only sends
+        the parts that are missing.
+        :param file: Readable binary file
+        :param file_name: str
+        :param upload_path: str
+        :param content_type: str
+        :param cache_control: str
+        :param part_size: Bytes per part, STORAGE_MULTIPART_PART_SIZE by default, 5MB at least
+        :param concurrency: Parts uploaded at once, STORAGE_MULTIPART_CONCURRENCY by default
+        :param upload_id: Multipart upload to resume
+        :return: URL of the file
+        """
+        client = self.client
+        part_size = max(part_size or settings.STORAGE_MULTIPART_PART_SIZE, 5 * 2 ** 20)
+        concurrency = concurrency or settings.STORAGE_MULTIPART_CONCURRENCY
+        key = self.get_key(file_name, upload_path)
+        params = {"Bucket": self.details["bucket"], "Key": key}
+
+        uploaded = {}
+        if upload_id:
+            paginator = client.get_paginator("list_parts")
+            for page in paginator.paginate(**params, UploadId=upload_id):
+                for part in page.get("Parts", []):
+                    uploaded[part["PartNumber"]] = part["ETag"].strip('"')
+        else:
+            upload_id = client.create_multipart_upload(
+                **params, ACL=self.details["acl"], **self.get_object_parameters(content_type, cache_control)
+            )["UploadId"]
+
+        def upload_part(part_number: int, data: bytes, digest: bytes) -> str:
+            response = client.upload_part(
+                **params,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=data,
+                ContentMD5=base64.b64encode(digest).decode()
+            )
+            etag = response["ETag"].strip('"')
+            if etag != digest.hex():
+                raise S3UploadError(f"Part {part_number} checksum mismatch", key, upload_id)
+            return etag
+
+        digests = []
+        pending: set[Future] = set()
+        slots = threading.BoundedSemaphore(concurrency + 1)
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="s3-upload") as executor:
+                part_number = 0
+                while True:
+                    slots.acquire()
+                    data = file.read(part_size)
+                    if not data:
+                        slots.release()
+                        break
+                    part_number += 1
+                    digest = hashlib.md5(data).digest()
+                    digests.append(digest)
+                    if uploaded.get(part_number) == digest.hex():
+                        slots.release()
+                        continue
+                    future = executor.submit(upload_part, part_number, data, digest)
+                    future.add_done_callback(lambda _: slots.release())
+                    pending.add(future)
+                    # Stop reading at the first failed part
+                    done = {future for future in pending if future.done()}
+                    for future in done:
+                        future.result()
+                    pending -= done
+            for future in pending:
+                future.result()
+
+            if not digests:
+                client.abort_multipart_upload(**params, UploadId=upload_id)
+                client.put_object(**params, Body=b"", ACL=self.details["acl"],
+                                  **self.get_object_parameters(content_type, cache_control))
+                return self.get_file_url(key)
+            response = client.complete_multipart_upload(
+                **params,
+                UploadId=upload_id,
+                MultipartUpload={
+                    "Parts": [
+                        {"PartNumber": number, "ETag": f'"{digest.hex()}"'}
+                        for number, digest in enumerate(digests, 1)
+                    ]
+                }
+            )
+        except S3UploadError:
+            raise
+        except (BotoCoreError, ClientError, OSError) as exc:
+            raise S3UploadError(str(exc), key, upload_id) from exc
+
+        expected = f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+        if response["ETag"].strip('"') != expected:
+            raise S3UploadError("Object checksum mismatch", key, upload_id)
+        return self.get_file_url(key)
+
+    def get_file_url(self, key: str) -> str:
+        """
+        Public URL of an object
+        :param key: Object key
+        :return: str
+        """
+        return f"{self.details['endpoint_url']}/{self.details['bucket']}/{key}"
+
+    def generate_presigned_post(self,
+                                key: str,
+                                key_prefix: str,
+                                content_type: str,
+                                max_size: int,
+                                expires_in: int = 900
+                                ) -> dict[str, Any]:
+        """
+        Presigned form upload, the browser posts the file straight to the bucket
+        The policy pins the key prefix, content type, acl and the largest accepted size
+        :param key: Object key, must start with key_prefix
+        :param key_prefix: Prefix the upload is scoped to
+        :param content_type: Content type the file must be uploaded with
+        :param max_size: Largest file in bytes
+        :param expires_in: Seconds the policy is valid
+        :return: dict[str, Any] Form url and fields
+        """
+        return self.client.generate_presigned_post(
+            Bucket=self.details["bucket"],
+            Key=key,
+            Fields={"acl": self.details["acl"], "Content-Type": content_type},
+            Conditions=[
+                {"acl": self.details["acl"]},
+                {"Content-Type": content_type},
+                ["starts-with", "$key", key_prefix],
+                ["content-length-range", 1, max_size],
+            ],
+            ExpiresIn=expires_in
+        )
+
+    def generate_presigned_put(self, key: str, content_type: str, expires_in: int = 900) -> dict[str, Any]:
+        """
+        Presigned PUT upload of a single object
+        :return: dict[str, Any] URL and the headers the upload must be sent with
+        """
+        url = self.client.generate_presigned_url(
+            "put_object",
+            Params={
+                "Bucket": self.details["bucket"],
+                "Key": key,
+                "ContentType": content_type,
+                "ACL": self.details["acl"],
+            },
+            ExpiresIn=expires_in
+        )
+        return {"url": url, "headers": {"Content-Type": content_type, "x-amz-acl": self.details["acl"]}}
+
+    def create_multipart_upload(self, key: str, content_type: str, part_count: int,
+                                expires_in: int = 900) -> dict[str, Any]:
+        """
+        Starts a multipart upload session and presigns a PUT url for every part
+        :param key: Object key
+        :param content_type: str
+        :param part_count: Number of parts the file is split into
+        :param expires_in: Seconds the part urls are valid
+        :return: dict[str, Any] Upload id and part urls
+        """
+        upload_id = self.client.create_multipart_upload(
+            Bucket=self.details["bucket"],
+            Key=key,
+            ContentType=content_type,
+            ACL=self.details["acl"]
+        )["UploadId"]
+        parts = [
+            {
+                "part_number": part_number,
+                "url": self.client.generate_presigned_url(
+                    "upload_part",
+                    Params={
+                        "Bucket": self.details["bucket"],
+                        "Key": key,
+                        "UploadId": upload_id,
+                        "PartNumber": part_number,
+                    },
+                    ExpiresIn=expires_in
+                )
+            }
+            for part_number in range(1, part_count + 1)
+        ]
+        return {"upload_id": upload_id, "parts": parts}
+
+    def complete_multipart_upload(self, key: str, upload_id: str, parts: list[dict[str, Any]]):
+        """
+        Assembles the uploaded parts into the object
+        :param parts: Part number and ETag of every part, EG: [{"PartNumber": 1, "ETag": "..."}]
+        """
+        self.client.complete_multipart_upload(
+            Bucket=self.details["bucket"],
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": sorted(parts, key=lambda part: part["PartNumber"])}
+        )
+
+    def abort_multipart_upload(self, key: str, upload_id: str):
+        self.client.abort_multipart_upload(Bucket=self.details["bucket"], Key=key, UploadId=upload_id)
+
+    def head_file(self, key: str) -> dict[str, Any] | None:
+        try:
+            response = self.client.head_object(Bucket=self.details["bucket"], Key=key)
+        except ClientError as exc:
+            if exc.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
+                return None
+            raise
+        return {"size": response["ContentLength"], "content_type": response.get("ContentType", "")}
+
+    def download_file(self, key: str) -> bytes:
+        try:
+            response = self.client.get_object(Bucket=self.details["bucket"], Key=key)
+        except ClientError as exc:
+            if exc.response["Error"].get("Code") in ("NoSuchKey", "404"):
+                raise StorageFileNotFound(key) from exc
+            raise
+        return response["Body"].read()
+
+    def delete_file(self, key: str):
+        self.client.delete_object(Bucket=self.details["bucket"], Key=key)
+
+
+class LocalStorage(BaseStorage):
+    """
+    Files on local disk under "location", served by nginx at "base_url"
+    Files are written to a temporary file next to the target and renamed, readers never see partial files.
+    Files already on disk, EG: large uploads Django spooled to a temporary file, are copied by the kernel
+    with copy_file_range or sendfile instead of through python buffers
+    """
+    required_keys = ["location", "base_url", "default_location"]
+
+    def get_path(self, key: str) -> str:
+        root = os.path.abspath(self.details["location"])
+        path = os.path.abspath(os.path.join(root, key))
+        if not path.startswith(root + os.sep):
+            raise StorageError(f"Invalid key '{key}'")
+        return path
+
+    @staticmethod
+    def copy(file: bytes | BinaryIO, target: BinaryIO):
+        if isinstance(file, bytes):
+            target.write(file)
+            return
+        try:
+            source_fd = file.fileno()
+            offset = file.tell()
+            remaining = os.fstat(source_fd).st_size - offset
+        except (AttributeError, OSError, ValueError):
+            shutil.copyfileobj(file, target, 2 ** 20)
+            return
+        target_fd = target.fileno()
+        while remaining > 0:
+            if hasattr(os, "copy_file_range"):
+                try:
+                    copied = os.copy_file_range(source_fd, target_fd, remaining, offset)
+                except OSError:
+                    copied = os.sendfile(target_fd, source_fd, offset, remaining)
+            else:
+                copied = os.sendfile(target_fd, source_fd, offset, remaining)
+            if not copied:
+                break
+            offset += copied
+            remaining -= copied
+        file.seek(offset)
+
+    def upload_file(self, file: bytes | File, file_name: str, upload_path: str = "", content_type: str = "",
+                    cache_control: str = "") -> str:
+        # Content type and caching of served files are up to nginx
+        key = self.get_key(file_name, upload_path)
+        path = self.get_path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=directory, prefix=".upload-")
+        try:
+            with os.fdopen(descriptor, "wb") as target:
+                self.copy(file, target)
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        return self.get_file_url(key)
+
+    def get_file_url(self, key: str) -> str:
+        return f"{self.details['base_url'].rstrip('/')}/{key}"
+
+    def head_file(self, key: str) -> dict[str, Any] | None:
+        try:
+            size = os.stat(self.get_path(key)).st_size
+        except FileNotFoundError:
+            return None
+        return {"size": size, "content_type": mimetypes.guess_type(key)[0] or ""}
+
+    def download_file(self, key: str) -> bytes:
+        try:
+            with open(self.get_path(key), "rb") as file:
+                return file.read()
+        except FileNotFoundError as exc:
+            raise StorageFileNotFound(key) from exc
+
+    def delete_file(self, key: str):
+        try:
+            os.unlink(self.get_path(key))
+        except FileNotFoundError:
+            pass
+
+
+class MemoryStorage(BaseStorage):
+    """
+    Files kept in process memory, for benchmarks and local development without a bucket
+    """
+
+    def __init__(self, name: str, details: dict[str, Any]):
+        super().__init__(name, details)
+        self.files: dict[str, tuple[bytes, str]] = {}
+        self._lock = threading.Lock()
+
+    def upload_file(self, file: bytes | File, file_name: str, upload_path: str = "", content_type: str = "",
+                    cache_control: str = "") -> str:
+        key = self.get_key(file_name, upload_path)
+        data = file if isinstance(file, bytes) else file.read()
+        with self._lock:
+            self.files[key] = (data, content_type)
+        return self.get_file_url(key)
+
+    def get_file_url(self, key: str) -> str:
+        return f"{self.details.get('base_url', f'memory://{self.name}').rstrip('/')}/{key}"
+
+    def head_file(self, key: str) -> dict[str, Any] | None:
+        if key not in self.files:
+            return None
+        data, content_type = self.files[key]
+        return {"size": len(data), "content_type": content_type}
+
+    def download_file(self, key: str) -> bytes:
+        try:
+            return self.files[key][0]
+        except KeyError:
+            raise StorageFileNotFound(key)
+
+    def delete_file(self, key: str):
+        with self._lock:
+            self.files.pop(key, None)
+
+
+class StorageRegistry:
+    """
+    Storage backend of every bucket in settings.DIGITAL_OCEAN_BUCKETS, picked by the bucket's "backend": s3 by default,
+    local or memory. Methods take the bucket name and call its backend.
+    Buckets are read and backends created on first use, so importing the service costs nothing
+    """
+    backend_classes = {
+        "s3": S3Storage,
+        "local": LocalStorage,
+        "memory": MemoryStorage,
+    }
+
+    def __init__(self):
+        self._buckets = None
+        self._backends: dict[str, BaseStorage] = {}
+        self._lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            # Connection pools must not be shared with forked worker processes
+            os.register_at_fork(after_in_child=self._backends.clear)
+
+    def set_bucket(self):
+        """
+        Set bucket registry
+        """
+        buckets = deepcopy(settings.DIGITAL_OCEAN_BUCKETS)
+        if "default" not in buckets:
+            raise StorageError("'default' bucket missing error")
+        for bucket, values in buckets.items():
+            if values.get("backend", "s3") not in self.backend_classes:
+                raise StorageError(f"Invalid backend '{values['backend']}' of bucket '{bucket}'")
+        return buckets
+
+    @property
+    def buckets(self) -> dict[str, dict[str, Any]]:
+        if self._buckets is None:
+            with self._lock:
+                if self._buckets is None:
+                    self._buckets = self.set_bucket()
+        return self._buckets
+
+    def get_backend(self, bucket: str = "default") -> BaseStorage:
+        backend = self._backends.get(bucket)
+        if backend is None:
+            if bucket not in self.buckets:
+                raise StorageError(f"Invalid bucket '{bucket}'")
+            with self._lock:
+                backend = self._backends.get(bucket)
+                if backend is None:
+                    details = self.buckets[bucket]
+                    backend_class = self.backend_classes[details.get("backend", "s3")]
+                    backend = self._backends[bucket] = backend_class(bucket, details)
+        return backend
+
+    def upload_file(self, file: bytes | File, file_name: str, upload_path: str = "", bucket: str = "default",
+                    content_type: str = "", cache_control: str = "") -> str:
+        return self.get_backend(bucket).upload_file(file, file_name, upload_path, content_type, cache_control)
+
+    def upload_stream(self, file: BinaryIO, file_name: str, upload_path: str = "", bucket: str = "default",
+                      content_type: str = "", cache_control: str = "", **kwargs) -> str:
+        return self.get_backend(bucket).upload_stream(
+            file, file_name, upload_path, content_type, cache_control, **kwargs
+        )
+
+    def upload_files(self, uploads: list[dict[str, Any]], bucket: str = "default", max_workers: int = None) -> list[str]:
+        """
+        Uploads files concurrently, at most STORAGE_UPLOAD_CONCURRENCY transfers run at once
+        :param uploads: upload_file arguments of every file, EG: [{"file": b"...", "file_name": "a.png"}]
+        :param bucket: str
+        :param max_workers: Transfers at once
+        :return: list[str] URLs in the order of uploads
+        """
+        backend = self.get_backend(bucket)
+        if len(uploads) < 2:
+            return [backend.upload_file(**upload) for upload in uploads]
+        max_workers = min(max_workers or settings.STORAGE_UPLOAD_CONCURRENCY, len(uploads))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="storage-upload") as executor:
+            return list(executor.map(lambda upload: backend.upload_file(**upload), uploads))
+
+    def get_file_url(self, key: str, bucket: str = "default") -> str:
+        return self.get_backend(bucket).get_file_url(key)
+
+    def get_upload_prefix(self, *parts, bucket: str = "default") -> str:
+        return self.get_backend(bucket).get_upload_prefix(*parts)
+
+    def generate_presigned_post(self, *args, bucket: str = "default", **kwargs) -> dict[str, Any]:
+        return self.get_backend(bucket).generate_presigned_post(*args, **kwargs)
+
+    def generate_presigned_put(self, *args, bucket: str = "default", **kwargs) -> dict[str, Any]:
+        return self.get_backend(bucket).generate_presigned_put(*args, **kwargs)
+
+    def create_multipart_upload(self, *args, bucket: str = "default", **kwargs) -> dict[str, Any]:
+        return self.get_backend(bucket).create_multipart_upload(*args, **kwargs)
+
+    def complete_multipart_upload(self, *args, bucket: str = "default", **kwargs):
+        return self.get_backend(bucket).complete_multipart_upload(*args, **kwargs)
+
+    def abort_multipart_upload(self, *args, bucket: str = "default", **kwargs):
+        return self.get_backend(bucket).abort_multipart_upload(*args, **kwargs)
+
+    def head_file(self, key: str, bucket: str = "default") -> dict[str, Any] | None:
+        return self.get_backend(bucket).head_file(key)
+
+    def download_file(self, key: str, bucket: str = "default") -> bytes:
+        return self.get_backend(bucket).download_file(key)
+
+    def delete_file(self, key: str, bucket: str = "default"):
+        return self.get_backend(bucket).delete_file(key)
 
 
-StorageService = S3Storage()
+StorageService = StorageRegistry()
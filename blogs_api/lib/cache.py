@@ -0,0 +1,22 @@
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis import Redis
+
+
+def get_redis(alias: str = "default") -> Redis:
+    """
+    Raw redis client of the cache backend, shared by every redis backed feature
+    :param alias: Cache alias from settings.CACHES
+    :return: Redis
+    """
+    return get_redis_connection(alias)
+
+
+def make_key(*parts) -> str:
+    """
+    Builds a redis key namespaced with the cache key prefix
+    Example: make_key("search", "dirty", "blogs") -> "blogs_api:search:dirty:blogs"
+    :param parts: Key parts
+    :return: str
+    """
+    return ":".join([settings.CACHES["default"].get("KEY_PREFIX", ""), *map(str, parts)])
@@ -0,0 +1,117 @@
+import logging
+from typing import Any, Callable
+
+from django.conf import settings
+from redis import RedisError
+
+from lib import metrics
+from lib.cache import get_redis, make_key
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling a service whose circuit is open
+    """
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker with its state in redis, so every replica stops calling a failing service together
+    closed: Calls go through, failures within `window` seconds are counted
+    open: After `failure_threshold` failures calls are rejected for `reset_timeout` seconds
+    half_open: Then one probe call at a time is let through, success closes the circuit, failure opens it again
+    Redis errors never block calls, the breaker then stays closed
+    Options are read from settings.CIRCUIT_BREAKERS by name
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, is_failure: Callable[[Exception], bool] = None):
+        options = settings.CIRCUIT_BREAKERS.get(name, settings.CIRCUIT_BREAKERS["default"])
+        self.name = name
+        self.failure_threshold = options["failure_threshold"]
+        self.window = options["window"]
+        self.reset_timeout = options["reset_timeout"]
+        self.probe_timeout = options["probe_timeout"]
+        self.is_failure = is_failure or (lambda exc: True)
+        self.redis = get_redis()
+
+    def get_key(self, part: str) -> str:
+        return make_key("circuit", self.name, part)
+
+    def get_state(self) -> str:
+        try:
+            is_open, is_tripped = self.redis.exists(self.get_key("open")), self.redis.exists(self.get_key("tripped"))
+        except RedisError:
+            return self.CLOSED
+        if is_open:
+            return self.OPEN
+        return self.HALF_OPEN if is_tripped else self.CLOSED
+
+    def before_call(self):
+        """
+        Raises CircuitOpen when the call must not be made
+        """
+        try:
+            if self.redis.exists(self.get_key("open")):
+                raise CircuitOpen(self.name)
+            if self.redis.exists(self.get_key("tripped")):
+                if not self.redis.set(self.get_key("probe"), 1, nx=True, ex=self.probe_timeout):
+                    # Another caller is probing the half open circuit
+                    raise CircuitOpen(self.name)
+                self.transition(self.HALF_OPEN)
+        except RedisError:
+            logger.warning("Circuit breaker '%s' state unavailable", self.name, exc_info=True)
+
+    def record_success(self):
+        try:
+            if self.redis.delete(self.get_key("tripped")):
+                self.redis.delete(self.get_key("failures"), self.get_key("probe"))
+                self.transition(self.CLOSED)
+        except RedisError:
+            logger.warning("Circuit breaker '%s' state unavailable", self.name, exc_info=True)
+
+    def record_failure(self):
+        try:
+            if self.redis.exists(self.get_key("tripped")):
+                self.trip()
+                return
+            failures = self.redis.incr(self.get_key("failures"))
+            if failures == 1:
+                self.redis.expire(self.get_key("failures"), self.window)
+            if failures >= self.failure_threshold:
+                self.trip()
+        except RedisError:
+            logger.warning("Circuit breaker '%s' state unavailable", self.name, exc_info=True)
+
+    def trip(self):
+        pipeline = self.redis.pipeline()
+        pipeline.set(self.get_key("open"), 1, ex=self.reset_timeout)
+        pipeline.set(self.get_key("tripped"), 1)
+        pipeline.delete(self.get_key("failures"), self.get_key("probe"))
+        pipeline.execute()
+        logger.warning("Circuit breaker '%s' opened for %s seconds", self.name, self.reset_timeout)
+        self.transition(self.OPEN)
+
+    def transition(self, state: str):
+        metrics.incr("circuit_breaker.transitions", breaker=self.name, state=state)
+        metrics.set_gauge("circuit_breaker.state", self.STATE_VALUES[state], breaker=self.name)
+
+    def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Calls func through the breaker
+        :raises CircuitOpen: When the circuit is open
+        """
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            if self.is_failure(exc):
+                self.record_failure()
+            raise
+        self.record_success()
+        return result
@@ -0,0 +1,65 @@
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+CONTENT_TYPES = {
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+}
+
+
+class ImageProcessingError(Exception):
+    pass
+
+
+def open_image(data: bytes, max_size: int) -> Image.Image:
+    """
+    Decodes the image once, JPEGs are decoded straight at the smallest scale that still covers max_size.
+    Orientation from EXIF is applied to the pixels, metadata is not carried over to the variants
+    :param data: Uploaded file
+    :param max_size: Largest variant size
+    :return: Image
+    """
+    try:
+        image = Image.open(BytesIO(data))
+        image.draft("RGB", (max_size, max_size))
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        raise ImageProcessingError("Invalid image") from exc
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+    return image
+
+
+def encode(image: Image.Image, image_format: str, quality: int) -> bytes:
+    buffer = BytesIO()
+    if image_format == "jpeg":
+        if image.mode == "RGBA":
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def make_variants(data: bytes, sizes: dict[str, int], formats: tuple[str, ...] = ("webp", "jpeg"),
+                  quality: int = 82) -> dict[str, dict[str, bytes]]:
+    """
+    Resizes an image to fit each size, in every format
+    Variants are made from largest to smallest, each one is downscaled from the previous one
+    Images are never upscaled
+    :param data: Uploaded file
+    :param sizes: Variant name and the longest side in pixels, EG: {"small": 64}
+    :param formats: Output formats, webp and jpeg
+    :param quality: Encoder quality
+    :return: dict[str, dict[str, bytes]] Variant name, format and encoded image
+    """
+    image = open_image(data, max(sizes.values()))
+    variants = {}
+    for name, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        variants[name] = {image_format: encode(image, image_format, quality) for image_format in formats}
+    return variants
@@ -0,0 +1,79 @@
+import logging
+from typing import Any
+
+from redis import RedisError
+
+from lib.cache import get_redis, make_key
+
+logger = logging.getLogger(__name__)
+
+
+def metric_name(name: str, **labels) -> str:
+    """
+    Metric name with sorted labels
+    Example: metric_name("search.latency", backend="postgres") -> "search.latency{backend=postgres}"
+    :param name: Metric name
+    :param labels: Metric labels
+    :return: str
+    """
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{key}={value}" for key, value in sorted(labels.items())) + "}"
+
+
+def incr(name: str, amount: int = 1, **labels):
+    """
+    Increases a counter, shared by every replica through redis
+    Metrics never fail the caller, redis errors are logged and ignored
+    """
+    try:
+        get_redis().hincrby(make_key("metrics", "counters"), metric_name(name, **labels), amount)
+    except RedisError:
+        logger.warning("Could not record metric '%s'", name, exc_info=True)
+
+
+def set_gauge(name: str, value: float, **labels):
+    """
+    Sets the current value of a gauge
+    """
+    try:
+        get_redis().hset(make_key("metrics", "gauges"), metric_name(name, **labels), value)
+    except RedisError:
+        logger.warning("Could not record metric '%s'", name, exc_info=True)
+
+
+def observe(name: str, seconds: float, **labels):
+    """
+    Records a duration, count and sum are kept so the mean can be derived
+    """
+    key = metric_name(name, **labels)
+    try:
+        pipeline = get_redis().pipeline(transaction=False)
+        pipeline.hincrby(make_key("metrics", "timings", "count"), key, 1)
+        pipeline.hincrbyfloat(make_key("metrics", "timings", "sum"), key, seconds)
+        pipeline.execute()
+    except RedisError:
+        logger.warning("Could not record metric '%s'", name, exc_info=True)
+
+
+def get_metrics() -> dict[str, Any]:
+    """
+    Returns every recorded metric
+    :return: dict[str, Any] Counters, gauges and timings with count, sum and mean in seconds
+    """
+    redis = get_redis()
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.hgetall(make_key("metrics", "counters"))
+    pipeline.hgetall(make_key("metrics", "gauges"))
+    pipeline.hgetall(make_key("metrics", "timings", "count"))
+    pipeline.hgetall(make_key("metrics", "timings", "sum"))
+    counters, gauges, counts, sums = pipeline.execute()
+    timings = {}
+    for key, count in counts.items():
+        count, total = int(count), float(sums.get(key, 0))
+        timings[key.decode()] = {"count": count, "sum": total, "mean": total / count if count else 0}
+    return {
+        "counters": {key.decode(): int(value) for key, value in counters.items()},
+        "gauges": {key.decode(): float(value) for key, value in gauges.items()},
+        "timings": timings,
+    }
@@ -1,7 +1,19 @@
+import binascii
+import json
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from collections import OrderedDict
+from datetime import datetime
+from typing import Any
 
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Model, Q
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import CursorPagination as RestCursorPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class CursorPagination(RestCursorPagination):
@@ -27,4 +39,148 @@ class CursorPagination(RestCursorPagination):
             ('next', self.get_next_link()),
             ('previous', self.get_previous_link()),
             ('results', data)
-        ]))
\ No newline at end of file
+        ]))
+
+
+class PositionCursorPagination(CursorPagination, ABC):
+    """
+    Cursor pagination where the cursor holds the sort values of the boundary item
+    and the backend fetches the items after it ( keyset / search_after ), so the cost
+    of a page does not grow with its depth
+    Subclasses implement `fetch_page`
+    """
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+
+    next_position = None
+    previous_position = None
+
+    @abstractmethod
+    def fetch_page(self, queryset, size: int, position: list | None, reverse: bool) -> tuple[list, list[list]]:
+        """
+        Fetch items following the position in sort order, or preceding it when reverse
+        :param queryset: Source of items
+        :param size: Number of items to fetch
+        :param position: Sort values of the boundary item, None for first page
+        :param reverse: Walk the sort order backwards
+        :return: Items and the sort values of each item, nearest to the position first
+        """
+
+    def decode_position(self, request) -> tuple[list | None, bool]:
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            data = json.loads(urlsafe_b64decode(encoded.encode("ascii")))
+            position, reverse = data["p"], bool(data.get("r"))
+            if not isinstance(position, list):
+                raise ValueError
+        except (TypeError, ValueError, KeyError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def encode_position(self, position: list, reverse: bool = False) -> str:
+        data = {"p": position}
+        if reverse:
+            data["r"] = 1
+        encoded = urlsafe_b64encode(
+            json.dumps(data, separators=(",", ":"), cls=DjangoJSONEncoder).encode("utf-8")
+        ).decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.view = view
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        position, reverse = self.decode_position(request)
+
+        # One extra item tells whether there is another page
+        items, positions = self.fetch_page(queryset, self.page_size + 1, position, reverse)
+        has_more = len(items) > self.page_size
+        items, positions = list(items[:self.page_size]), list(positions[:self.page_size])
+        if reverse:
+            items.reverse()
+            positions.reverse()
+        has_following = position is not None if reverse else has_more
+        has_preceding = has_more if reverse else position is not None
+        self.next_position = positions[-1] if has_following and positions else None
+        self.previous_position = positions[0] if has_preceding and positions else None
+        self.page = items
+        return items
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_position(self.next_position)
+
+    def get_previous_link(self):
+        if self.previous_position is None:
+            return None
+        return self.encode_position(self.previous_position, reverse=True)
+
+
+class KeysetPagination(PositionCursorPagination):
+    """
+    Keyset pagination of a queryset, the cursor holds the `ordering` values of the boundary row
+    and the page is fetched with a range filter on them, served by an index on the same columns
+    The last ordering field must be unique
+    """
+    ordering = ("-created_at", "-id")
+
+    def get_position(self, item: Model) -> list[Any]:
+        # Full precision, DjangoJSONEncoder would cut datetimes to milliseconds
+        return [
+            value.isoformat() if isinstance(value, datetime) else value
+            for value in (getattr(item, name.lstrip("-")) for name in self.ordering)
+        ]
+
+    def get_position_filter(self, position: list, reverse: bool) -> Q:
+        """
+        Rows after the position in ordering, before it when reverse
+        (a, b) after (x, y) is a > x OR (a = x AND b > y)
+        """
+        query = Q()
+        equal = {}
+        for name, value in zip(self.ordering, position):
+            field = name.lstrip("-")
+            lookup = "gt" if name.startswith("-") == reverse else "lt"
+            query |= Q(**equal, **{f"{field}__{lookup}": value})
+            equal[field] = value
+        return query
+
+    def fetch_page(self, queryset, size, position, reverse):
+        if position is not None:
+            if len(position) != len(self.ordering):
+                raise NotFound(self.invalid_cursor_message)
+            try:
+                queryset = queryset.filter(self.get_position_filter(position, reverse))
+            except (TypeError, ValueError, ValidationError):
+                raise NotFound(self.invalid_cursor_message)
+        ordering = self.ordering
+        if reverse:
+            ordering = [name[1:] if name.startswith("-") else f"-{name}" for name in ordering]
+        items = list(queryset.order_by(*ordering)[:size])
+        return items, [self.get_position(item) for item in items]
+
+
+class SortedIdsPagination(PositionCursorPagination):
+    """
+    Pages through an ascending list of ids held in memory, EG: result of a redis set operation
+    The cursor holds the boundary id
+    """
+
+    def fetch_page(self, queryset, size, position, reverse):
+        if position is not None and (
+                len(position) != 1 or not isinstance(position[0], int) or isinstance(position[0], bool)
+        ):
+            raise NotFound(self.invalid_cursor_message)
+        ids = queryset
+        if reverse:
+            end = bisect_left(ids, position[0]) if position else len(ids)
+            page = ids[max(end - size, 0):end][::-1]
+        else:
+            start = bisect_right(ids, position[0]) if position else 0
+            page = ids[start:start + size]
+        return page, [[pk] for pk in page]
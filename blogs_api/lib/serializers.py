@@ -1,5 +1,13 @@
+import math
+import os.path
+from uuid import uuid4
+
+from botocore.exceptions import ClientError
+from django.conf import settings
 from rest_framework import serializers
 
+from lib.backends import StorageError, StorageService
+
 
 class RequestUserCreateMixin:
     """
@@ -8,3 +16,103 @@ class RequestUserCreateMixin:
     def create(self, validated_data):
         validated_data[self.Meta.user_key] = self.context.get("request").user
         return super().create(validated_data)
+
+
+def get_max_size(context: dict) -> int:
+    """
+    Size limit of a direct upload in bytes, views pass a tighter one in context["max_size"]
+    """
+    return context.get("max_size", settings.MAX_UPLOAD_FILE_SIZE_BYTES)
+
+
+class DirectUploadSerializer(serializers.Serializer):
+    """
+    Issues a presigned upload to the bucket, scoped to context["key_prefix"]
+    and limited to context["max_size"] bytes, MAX_UPLOAD_FILE_SIZE_BYTES by default
+    post: Browser form upload, the size limit is enforced by the bucket
+    put: Single PUT request
+    multipart: Presigned PUT url per MULTIPART_UPLOAD_PART_SIZE part, for large files
+    """
+    file_name = serializers.CharField(max_length=255, write_only=True)
+    content_type = serializers.ChoiceField(choices=settings.UPLOAD_CONTENT_TYPES, write_only=True)
+    size = serializers.IntegerField(min_value=1, write_only=True)
+    method = serializers.ChoiceField(choices=["post", "put", "multipart"], default="post", write_only=True)
+
+    def validate_size(self, value):
+        max_size = get_max_size(self.context)
+        if value > max_size:
+            raise serializers.ValidationError(f"Ensure this value is less than or equal to {max_size}.")
+        return value
+
+    def create(self, validated_data):
+        key_prefix = self.context["key_prefix"]
+        key = f"{key_prefix}{uuid4()}{os.path.splitext(validated_data['file_name'])[1].lower()}"
+        content_type, method = validated_data["content_type"], validated_data["method"]
+        expires_in = settings.UPLOAD_URL_EXPIRES_IN
+        try:
+            details = self.generate(
+                key, key_prefix, content_type, method, validated_data["size"], get_max_size(self.context), expires_in
+            )
+        except StorageError as exc:
+            raise serializers.ValidationError({"method": [str(exc)]})
+        return {"key": key, "method": method, "expires_in": expires_in, **details}
+
+    @staticmethod
+    def generate(key: str, key_prefix: str, content_type: str, method: str, size: int, max_size: int,
+                 expires_in: int) -> dict:
+        if method == "post":
+            details = StorageService.generate_presigned_post(
+                key, key_prefix, content_type, max_size, expires_in=expires_in
+            )
+        elif method == "put":
+            details = StorageService.generate_presigned_put(key, content_type, expires_in=expires_in)
+        else:
+            part_count = math.ceil(size / settings.MULTIPART_UPLOAD_PART_SIZE)
+            details = StorageService.create_multipart_upload(key, content_type, part_count, expires_in=expires_in)
+            details["part_size"] = settings.MULTIPART_UPLOAD_PART_SIZE
+        return details
+
+
+class UploadPartSerializer(serializers.Serializer):
+    part_number = serializers.IntegerField(min_value=1, max_value=10000)
+    etag = serializers.CharField(max_length=128)
+
+
+class DirectUploadConfirmSerializer(serializers.Serializer):
+    """
+    Confirms a presigned upload once the client is done
+    Multipart uploads are completed first, then the object is checked with a HEAD request,
+    files over context["max_size"] bytes, MAX_UPLOAD_FILE_SIZE_BYTES by default, or of another content type are deleted
+    Validated data has the url and size of the file
+    """
+    key = serializers.CharField(max_length=1024)
+    upload_id = serializers.CharField(max_length=1024, required=False)
+    parts = serializers.ListField(child=UploadPartSerializer(), required=False, allow_empty=False, max_length=10000)
+
+    def validate_key(self, value):
+        if not value.startswith(self.context["key_prefix"]) or ".." in value:
+            raise serializers.ValidationError("Invalid key")
+        return value
+
+    def validate(self, attrs):
+        key = attrs["key"]
+        if "upload_id" in attrs:
+            if "parts" not in attrs:
+                raise serializers.ValidationError({"parts": ["Parts of the multipart upload are required"]})
+            try:
+                StorageService.complete_multipart_upload(
+                    key,
+                    attrs["upload_id"],
+                    [{"PartNumber": part["part_number"], "ETag": part["etag"]} for part in attrs["parts"]]
+                )
+            except (ClientError, StorageError):
+                raise serializers.ValidationError({"upload_id": ["Multipart upload could not be completed"]})
+        head = StorageService.head_file(key)
+        if head is None:
+            raise serializers.ValidationError({"key": ["File was not uploaded"]})
+        if head["size"] > get_max_size(self.context) or head["content_type"] not in settings.UPLOAD_CONTENT_TYPES:
+            StorageService.delete_file(key)
+            raise serializers.ValidationError({"key": ["File is too large or of an unsupported type"]})
+        attrs["url"] = StorageService.get_file_url(key)
+        attrs["size"] = head["size"]
+        return attrs
@@ -0,0 +1,428 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from base64 import urlsafe_b64encode
+from unittest import mock
+
+import boto3
+import fakeredis
+from botocore.exceptions import ClientError
+from redis import RedisError
+from django.test import SimpleTestCase, override_settings
+from moto import mock_aws
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from core.management.commands.benchmark_storage import RssSampler
+from lib.backends import LocalStorage, MemoryStorage, S3Storage, S3UploadError, StorageFileNotFound
+from lib.pagination import SortedIdsPagination
+from lib.throttling import SlidingWindowThrottle
+from lib.serializers import DirectUploadConfirmSerializer, DirectUploadSerializer
+
+logger = logging.getLogger(__name__)
+
+MB = 2 ** 20
+BUCKET = "test-bucket"
+
+
+class GeneratedFile(io.RawIOBase):
+    """
+    Readable file of `size` bytes repeating a random block, never held in memory as a whole
+    """
+
+    def __init__(self, size: int, block: bytes = None):
+        self.size = size
+        self.position = 0
+        self.block = block or os.urandom(MB)
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        size = self.size - self.position if size < 0 else min(size, self.size - self.position)
+        chunks, remaining = [], size
+        while remaining:
+            offset = self.position % len(self.block)
+            chunk = self.block[offset:offset + remaining]
+            chunks.append(chunk)
+            self.position += len(chunk)
+            remaining -= len(chunk)
+        return b"".join(chunks)
+
+
+class MotoS3Mixin:
+    """
+    S3Storage of an in-process moto S3
+    """
+
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        redis_patch = mock.patch("lib.metrics.get_redis", return_value=fakeredis.FakeRedis())
+        redis_patch.start()
+        self.addCleanup(redis_patch.stop)
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket=BUCKET)
+        self.storage = S3Storage("test", {
+            "bucket": BUCKET,
+            "endpoint_url": None,
+            "access_key_id": "testing",
+            "access_key": "testing",
+            "region": "us-east-1",
+            "acl": "private",
+            "default_location": "tests",
+        })
+        self.client = self.storage.client
+
+
+@override_settings(STORAGE_MULTIPART_PART_SIZE=5 * MB, STORAGE_MULTIPART_CONCURRENCY=4)
+class S3UploadStreamTestCase(MotoS3Mixin, SimpleTestCase):
+    """
+    S3Storage.upload_stream against an in-process moto S3
+    """
+
+    def get_object(self, key: str) -> dict:
+        return self.client.get_object(Bucket=BUCKET, Key=key)
+
+    def spy_upload_part(self, side_effect=None) -> list[int]:
+        """
+        Records the part numbers sent by upload_part, side_effect runs before each call
+        """
+        sent, upload_part = [], self.client.upload_part
+
+        def wrapper(**kwargs):
+            if side_effect:
+                side_effect(**kwargs)
+            sent.append(kwargs["PartNumber"])
+            return upload_part(**kwargs)
+
+        patcher = mock.patch.object(self.client, "upload_part", side_effect=wrapper)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return sent
+
+    def test_parts_are_assembled_in_order(self):
+        data = os.urandom(12 * MB)
+        self.storage.upload_stream(io.BytesIO(data), "file.bin", content_type="application/octet-stream")
+        response = self.get_object("tests/file.bin")
+        self.assertEqual(response["Body"].read(), data)
+        self.assertEqual(response["ContentType"], "application/octet-stream")
+        digests = b"".join(hashlib.md5(data[start:start + 5 * MB]).digest() for start in range(0, len(data), 5 * MB))
+        self.assertEqual(response["ETag"].strip('"'), f"{hashlib.md5(digests).hexdigest()}-3")
+
+    def test_part_size_is_at_least_5mb(self):
+        sent = self.spy_upload_part()
+        self.storage.upload_stream(io.BytesIO(os.urandom(11 * MB)), "file.bin", part_size=MB)
+        self.assertEqual(sorted(sent), [1, 2, 3])
+
+    def test_concurrency_bounds_parts_in_flight(self):
+        lock = threading.Lock()
+        state = {"running": 0, "running_peak": 0, "held": 0, "held_peak": 0}
+        upload_part = self.client.upload_part
+        file = GeneratedFile(40 * MB)
+        read = file.read
+
+        def counting_read(size: int = -1) -> bytes:
+            data = read(size)
+            if data:
+                with lock:
+                    state["held"] += 1
+                    state["held_peak"] = max(state["held_peak"], state["held"])
+            return data
+
+        def slow_upload_part(**kwargs):
+            with lock:
+                state["running"] += 1
+                state["running_peak"] = max(state["running_peak"], state["running"])
+            try:
+                time.sleep(0.05)
+                return upload_part(**kwargs)
+            finally:
+                with lock:
+                    state["running"] -= 1
+                    state["held"] -= 1
+
+        with mock.patch.object(self.client, "upload_part", side_effect=slow_upload_part), \
+                mock.patch.object(file, "read", side_effect=counting_read):
+            self.storage.upload_stream(file, "file.bin", concurrency=2)
+
+        self.assertEqual(state["running_peak"], 2)
+        # Parts read and not uploaded yet, one more than the parts being uploaded
+        self.assertLessEqual(state["held_peak"], 3)
+        self.assertEqual(self.get_object("tests/file.bin")["ContentLength"], 40 * MB)
+
+    def test_part_checksum_mismatch_raises(self):
+        upload_part = self.client.upload_part
+
+        def corrupt(**kwargs):
+            response = upload_part(**kwargs)
+            response["ETag"] = '"00000000000000000000000000000000"'
+            return response
+
+        with mock.patch.object(self.client, "upload_part", side_effect=corrupt):
+            with self.assertRaisesMessage(S3UploadError, "checksum mismatch") as context:
+                self.storage.upload_stream(io.BytesIO(os.urandom(6 * MB)), "file.bin")
+        self.assertEqual(context.exception.key, "tests/file.bin")
+        self.assertTrue(context.exception.upload_id)
+
+    def test_object_checksum_mismatch_raises(self):
+        complete = self.client.complete_multipart_upload
+
+        def corrupt(**kwargs):
+            response = complete(**kwargs)
+            response["ETag"] = '"00000000000000000000000000000000-2"'
+            return response
+
+        with mock.patch.object(self.client, "complete_multipart_upload", side_effect=corrupt):
+            with self.assertRaisesMessage(S3UploadError, "Object checksum mismatch"):
+                self.storage.upload_stream(io.BytesIO(os.urandom(6 * MB)), "file.bin")
+
+    def test_failed_upload_resumes_with_missing_parts(self):
+        data = os.urandom(16 * MB)
+
+        upload_part = self.client.upload_part
+
+        def fail_third_part(**kwargs):
+            if kwargs["PartNumber"] == 3:
+                raise ClientError({"Error": {"Code": "InternalError", "Message": "Boom"}}, "UploadPart")
+            return upload_part(**kwargs)
+
+        with mock.patch.object(self.client, "upload_part", side_effect=fail_third_part):
+            with self.assertRaises(S3UploadError) as context:
+                self.storage.upload_stream(io.BytesIO(data), "file.bin", concurrency=1)
+        upload_id = context.exception.upload_id
+        uploaded = {
+            part["PartNumber"]
+            for part in self.client.list_parts(Bucket=BUCKET, Key="tests/file.bin", UploadId=upload_id)["Parts"]
+        }
+        self.assertNotIn(3, uploaded)
+
+        sent = self.spy_upload_part()
+        self.storage.upload_stream(io.BytesIO(data), "file.bin", upload_id=upload_id)
+        self.assertEqual(set(sent), {1, 2, 3, 4} - uploaded)
+        self.assertEqual(self.get_object("tests/file.bin")["Body"].read(), data)
+
+    def test_empty_file_is_uploaded_without_multipart(self):
+        url = self.storage.upload_stream(io.BytesIO(b""), "empty.bin")
+        self.assertTrue(url.endswith("tests/empty.bin"))
+        self.assertEqual(self.get_object("tests/empty.bin")["ContentLength"], 0)
+        self.assertNotIn("Uploads", self.client.list_multipart_uploads(Bucket=BUCKET))
+
+
+class DownloadMissingFileTestCase(MotoS3Mixin, SimpleTestCase):
+    """
+    Every backend raises StorageFileNotFound for a missing key
+    """
+
+    def get_backends(self) -> list:
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        return [
+            self.storage,
+            LocalStorage("local", {"location": location, "base_url": "/media/", "default_location": "tests"}),
+            MemoryStorage("memory", {"default_location": "tests"}),
+        ]
+
+    def test_missing_file_is_not_found(self):
+        for backend in self.get_backends():
+            with self.subTest(backend=type(backend).__name__):
+                with self.assertRaises(StorageFileNotFound) as context:
+                    backend.download_file("tests/missing.png")
+                self.assertEqual(context.exception.key, "tests/missing.png")
+                backend.upload_file(b"content", "stored.png")
+                self.assertEqual(backend.download_file("tests/stored.png"), b"content")
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@override_settings(STORAGE_MULTIPART_PART_SIZE=8 * MB, STORAGE_MULTIPART_CONCURRENCY=4)
+class S3UploadStreamServerTestCase(SimpleTestCase):
+    """
+    S3Storage.upload_stream against moto's server in its own process,
+    so the resident memory of the test process is the memory held by the upload
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        port = get_free_port()
+        cls.server = subprocess.Popen(
+            [sys.executable, "-m", "moto.server", "-p", str(port)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        cls.endpoint_url = f"http://127.0.0.1:{port}"
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if cls.server.poll() is not None or time.monotonic() > deadline:
+                    cls.server.kill()
+                    raise unittest.SkipTest("moto server could not be started")
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+        super().tearDownClass()
+
+    def setUp(self):
+        redis_patch = mock.patch("lib.metrics.get_redis", return_value=fakeredis.FakeRedis())
+        redis_patch.start()
+        self.addCleanup(redis_patch.stop)
+        self.storage = S3Storage("test", {
+            "bucket": BUCKET,
+            "endpoint_url": self.endpoint_url,
+            "access_key_id": "testing",
+            "access_key": "testing",
+            "region": "us-east-1",
+            "acl": "private",
+            "default_location": "tests",
+        })
+        self.storage.client.create_bucket(Bucket=BUCKET)
+
+    def test_100mb_upload_memory_is_bounded(self):
+        size = 100 * MB
+        sampler = RssSampler()
+        sampler.start()
+        started = time.perf_counter()
+        self.storage.upload_stream(GeneratedFile(size), "large.bin")
+        elapsed = time.perf_counter() - started
+        peak = sampler.stop()
+
+        head = self.storage.head_file("tests/large.bin")
+        self.assertEqual(head["size"], size)
+        logger.info("100MB upload_stream: %.1f MB/s, peak RSS +%.1f MB", size / MB / elapsed, peak / MB)
+        # concurrency + 1 parts of 8MB are held at once, the rest is request buffers of botocore
+        self.assertLess(peak, (4 + 1) * 8 * MB * 2)
+
+
+@mock.patch("lib.serializers.StorageService")
+class DirectUploadSizeTestCase(SimpleTestCase):
+    """
+    Size limit of direct uploads passed by the view in context["max_size"]
+    """
+    context = {"key_prefix": "uploads/users/1/", "max_size": 10 * MB}
+
+    def request_upload(self, size: int, context: dict) -> DirectUploadSerializer:
+        return DirectUploadSerializer(
+            data={"file_name": "picture.png", "content_type": "image/png", "size": size}, context=context
+        )
+
+    def test_size_over_the_limit_is_rejected(self, storage):
+        serializer = self.request_upload(10 * MB + 1, self.context)
+        self.assertFalse(serializer.is_valid())
+        self.assertIn("size", serializer.errors)
+
+    def test_limit_defaults_to_max_upload_size(self, storage):
+        self.assertTrue(self.request_upload(10 * MB + 1, {"key_prefix": "uploads/users/1/"}).is_valid())
+
+    def test_presigned_post_is_limited(self, storage):
+        serializer = self.request_upload(MB, self.context)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        storage.generate_presigned_post.assert_called_once_with(
+            mock.ANY, "uploads/users/1/", "image/png", 10 * MB, expires_in=mock.ANY
+        )
+
+    def test_uploaded_file_over_the_limit_is_deleted(self, storage):
+        storage.head_file.return_value = {"size": 10 * MB + 1, "content_type": "image/png"}
+        serializer = DirectUploadConfirmSerializer(data={"key": "uploads/users/1/picture.png"}, context=self.context)
+        self.assertFalse(serializer.is_valid())
+        storage.delete_file.assert_called_once_with("uploads/users/1/picture.png")
+
+
+class SortedIdsPaginationTestCase(SimpleTestCase):
+    ids = list(range(1, 11))
+
+    def paginate(self, position: list = None) -> list[int]:
+        params = {"page_size": 3}
+        if position is not None:
+            params["cursor"] = urlsafe_b64encode(json.dumps({"p": position}).encode("utf-8")).decode("ascii")
+        request = Request(APIRequestFactory().get("/mutual/", params))
+        return SortedIdsPagination().paginate_queryset(self.ids, request)
+
+    def test_page_after_the_cursor(self):
+        self.assertEqual(self.paginate(), [1, 2, 3])
+        self.assertEqual(self.paginate([3]), [4, 5, 6])
+
+    def test_crafted_cursor_is_not_found(self):
+        for position in ([], ["x"], [1.5], [True], [None], [1, 2]):
+            with self.subTest(position=position):
+                with self.assertRaises(NotFound):
+                    self.paginate(position)
+
+
+@mock.patch.object(SlidingWindowThrottle, "THROTTLE_RATES", {"test": "60/min", "off": None})
+class SlidingWindowThrottleTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch("lib.throttling.get_redis", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.view = mock.Mock(throttle_scope="test")
+        # 10 seconds into a window
+        self.now = 600.0 * 60 + 10
+
+    def allow(self, view=None) -> SlidingWindowThrottle:
+        throttle = SlidingWindowThrottle()
+        request = Request(APIRequestFactory().get("/", REMOTE_ADDR="10.0.0.1"))
+        with mock.patch("lib.throttling.time.time", return_value=self.now):
+            throttle.allowed = throttle.allow_request(request, view or self.view)
+        return throttle
+
+    def test_requests_over_the_rate_are_denied(self):
+        self.assertTrue(all(self.allow().allowed for _ in range(60)))
+        throttle = self.allow()
+        self.assertFalse(throttle.allowed)
+        self.assertEqual(throttle.wait(), 50 + 1)
+
+    def test_request_after_retry_after_is_allowed(self):
+        for _ in range(60):
+            self.allow()
+        throttle = self.allow()
+        # The full window weighs as the previous one until a 60th of it slid out
+        self.now += throttle.wait() - 0.001
+        self.assertFalse(self.allow().allowed)
+        self.now += 0.001
+        self.assertTrue(self.allow().allowed)
+
+    def test_previous_window_counts_in_proportion(self):
+        for _ in range(60):
+            self.allow()
+        # Half of the previous window overlaps, 30 of its requests count
+        self.now += 50 + 30
+        self.assertTrue(all(self.allow().allowed for _ in range(30)))
+        throttle = self.allow()
+        self.assertFalse(throttle.allowed)
+        self.assertGreater(throttle.wait(), 0)
+
+    def test_requests_are_allowed_when_redis_fails(self):
+        self.redis = mock.Mock(**{"register_script.side_effect": RedisError("Connection refused")})
+        with mock.patch("lib.throttling.get_redis", return_value=self.redis), \
+                self.assertLogs("lib.throttling", "WARNING"):
+            self.assertTrue(self.allow().allowed)
+
+    def test_views_without_a_rate_are_not_throttled(self):
+        for scope in (None, "off"):
+            with self.subTest(scope=scope):
+                self.assertTrue(all(self.allow(mock.Mock(throttle_scope=scope)).allowed for _ in range(61)))
@@ -0,0 +1,94 @@
+import logging
+import time
+
+from redis import RedisError
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.throttling import ScopedRateThrottle
+
+from lib.cache import get_redis, make_key
+
+logger = logging.getLogger(__name__)
+
+# Sliding window counter: requests of the previous window count in proportion to how much of it
+# still overlaps the sliding window. Returns 0 and counts the request when allowed,
+# otherwise the milliseconds until it would be allowed. A full current window still weighs
+# as the previous one once it ends, the wait runs until enough of it slid out
+SLIDING_WINDOW_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local elapsed = tonumber(ARGV[3])
+local current = tonumber(redis.call('get', KEYS[1]) or '0')
+local previous = tonumber(redis.call('get', KEYS[2]) or '0')
+local remaining = limit - 1 - current
+if remaining >= 0 and previous * (window - elapsed) <= remaining * window then
+    redis.call('incr', KEYS[1])
+    redis.call('pexpire', KEYS[1], window * 2)
+    return 0
+end
+if remaining < 0 then
+    return window - elapsed + math.ceil(window * (current - limit + 1) / current)
+end
+return math.max(1, math.ceil(window - remaining * window / previous - elapsed))
+"""
+
+
+class SlidingWindowThrottle(ScopedRateThrottle):
+    """
+    Limits requests per `throttle_scope` of the view, rates are read from DEFAULT_THROTTLE_RATES
+    Requests are counted per user, per client IP for anonymous requests, with a sliding window in redis.
+    A request costs one redis round trip, the script is run with EVALSHA.
+    Views without a scope are not throttled, a scope missing from DEFAULT_THROTTLE_RATES raises
+    ImproperlyConfigured and a scope whose rate is None is not throttled.
+    Requests are not throttled when redis is unavailable
+    Example: throttle_classes = [SlidingWindowThrottle], throttle_scope = "votes", rate "votes": "60/min"
+    """
+    wait_seconds = None
+
+    def get_cache_key(self, request, view) -> str:
+        if request.user and request.user.is_authenticated:
+            ident = f"user:{request.user.pk}"
+        else:
+            ident = f"ip:{self.get_ident(request)}"
+        return make_key("throttle", self.scope, ident)
+
+    def allow_request(self, request, view) -> bool:
+        self.scope = getattr(view, self.scope_attr, None)
+        if not self.scope:
+            return True
+        self.rate = self.get_rate()
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        if self.num_requests is None:
+            return True
+
+        window = self.duration * 1000
+        now = int(time.time() * 1000)
+        start = now - now % window
+        key = self.get_cache_key(request, view)
+        try:
+            redis = get_redis()
+            wait = redis.register_script(SLIDING_WINDOW_SCRIPT)(
+                keys=[f"{key}:{start}", f"{key}:{start - window}"],
+                args=[self.num_requests, window, now - start]
+            )
+        except RedisError:
+            logger.warning("Throttle '%s' unavailable, request allowed", self.scope, exc_info=True)
+            return True
+        self.wait_seconds = wait / 1000
+        return not wait
+
+    def wait(self) -> float | None:
+        """
+        Seconds until a request would be allowed, sent as Retry-After
+        """
+        return self.wait_seconds
+
+
+class WriteRateThrottle(SlidingWindowThrottle):
+    """
+    Throttles unsafe methods only, reads of the view are not limited
+    """
+
+    def allow_request(self, request, view) -> bool:
+        if request.method in SAFE_METHODS:
+            return True
+        return super().allow_request(request, view)